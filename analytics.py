@@ -0,0 +1,337 @@
+"""
+This module defines the columnar store of the numeric fields of books and authors
+rating, rating_count and review_count are parsed once into typed NumPy arrays
+with a mask of the values that could be parsed, keyed by book_id/author_id,
+and cached on disk as .npy files so reports reload them without parsing
+The books of every author are kept in CSR form over an interned table of book ids,
+cached as .npy files too (memory-mapped on load like the columns)
+Run as a script to print the top books, the top authors and the distributions
+"""
+import argparse
+import json
+import os
+import re
+
+from db import KEYS, URL_KEYS, connect_to_db, iter_json_records
+from registry import canonical_id
+
+try:
+    import numpy as np  # optional, only needed by this module
+except ImportError:
+    np = None
+
+curr_dir = os.path.dirname(os.path.abspath(__file__))
+ANALYTICS_DIR = os.path.join(curr_dir, "data", "analytics")
+SOURCES = {kind: os.path.join(curr_dir, "data", kind + ".json") for kind in KEYS}
+
+# column -> dtype
+COLUMNS = {
+    "rating": "float64",
+    "rating_count": "int64",
+    "review_count": "int64",
+}
+FORMAT = 2  # version of the cache files, older caches are rebuilt
+
+
+class Table:
+    """
+    Numeric columns of one collection, one row per book_id/author_id
+    valid[column] is False where the scraped value was missing or couldn't be parsed
+    (the column holds 0 there)
+    """
+
+    def __init__(self, ids, columns, valid, links=None):
+        """
+        :param ids: list of book_id/author_id, one per row
+        :param columns: dict of column -> array
+        :param valid: dict of column -> bool array
+        :param links: (indptr, indices, book_ids) of the books of every author, indices
+            are rows of the book_ids string array (authors only, see build_table)
+        """
+        self.ids = ids
+        self.rows = {id_: row for row, id_ in enumerate(ids)}
+        self.columns = columns
+        self.valid = valid
+        self.links = links
+
+    def __len__(self):
+        return len(self.ids)
+
+    def values(self, column):
+        """
+        :return: the valid values of a column
+        """
+        return self.columns[column][self.valid[column]]
+
+    def save(self, path, source=None):
+        """
+        Saves the table as .npy files in the directory path
+        :param path: directory, created if needed
+        :param source: (mtime, size) of the file the table was built from
+        """
+        os.makedirs(path, exist_ok=True)
+        for column in self.columns:
+            np.save(os.path.join(path, column + ".npy"), self.columns[column])
+            np.save(os.path.join(path, column + "_valid.npy"), self.valid[column])
+        meta = {"ids": self.ids, "source": source, "links": self.links is not None,
+                "format": FORMAT}
+        if self.links is not None:
+            for name, array in zip(("indptr", "indices", "ids"), self.links):
+                np.save(os.path.join(path, "links_%s.npy" % name), array)
+        with open(os.path.join(path, "meta.json"), "w") as file:
+            json.dump(meta, file)
+
+
+def load_table(path, mmap=True):
+    """
+    Loads a table saved by Table.save
+    :param path: directory of the table
+    :param mmap: whether to memory-map the arrays instead of reading them
+    :return: (Table, source of the table), (None, None) for a cache of an older format
+    """
+    require_numpy()
+    mode = "r" if mmap else None
+    with open(os.path.join(path, "meta.json")) as file:
+        meta = json.load(file)
+    if meta.get("format") != FORMAT:
+        return None, None
+    columns = {column: np.load(os.path.join(path, column + ".npy"), mmap_mode=mode)
+               for column in COLUMNS}
+    valid = {column: np.load(os.path.join(path, column + "_valid.npy"), mmap_mode=mode)
+             for column in COLUMNS}
+    links = None
+    if meta["links"]:
+        links = tuple(np.load(os.path.join(path, "links_%s.npy" % name), mmap_mode=mode)
+                      for name in ("indptr", "indices", "ids"))
+    return Table(meta["ids"], columns, valid, links), meta["source"]
+
+
+def parse_number(value):
+    """
+    :param value: scraped value, e.g. "4.57", "2,422,944" or ""
+    :return: value as float, None when it isn't a number
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not isinstance(value, str):
+        return None
+    text = value.strip().replace(",", "")
+    if not re.match("[0-9]+(\\.[0-9]*)?$", text):
+        return None
+    return float(text)
+
+
+def build_table(records, kind):
+    """
+    Builds the table of one collection
+    Records without an id fall back to the canonical id of their url, the first
+    record of every id wins (like the db sync)
+    :param records: iterable of book or author records
+    :param kind: "books" or "authors"
+    :return: Table
+    """
+    require_numpy()
+    ids = []
+    seen = set()
+    values = {column: [] for column in COLUMNS}
+    counts = []  # number of books of every author
+    indices = []  # rows of book_ids of the books of all the authors
+    book_ids = {}  # book id -> row, the interned book ids of the links
+    for record in records:
+        id_ = record.get(KEYS[kind])
+        if not id_ and record.get(URL_KEYS[kind]):
+            id_ = canonical_id(record[URL_KEYS[kind]])
+        if not id_ or id_ in seen:
+            continue
+        seen.add(id_)
+        ids.append(id_)
+        for column in COLUMNS:
+            values[column].append(parse_number(record.get(column)))
+        if kind == "authors":
+            urls = record.get("author_books")
+            urls = urls if isinstance(urls, list) else []
+            counts.append(len(urls))
+            indices.extend(book_ids.setdefault(canonical_id(url), len(book_ids)) for url in urls)
+    columns = {}
+    valid = {}
+    for column, dtype in COLUMNS.items():
+        valid[column] = np.array([value is not None for value in values[column]], dtype=bool)
+        columns[column] = np.array([value or 0 for value in values[column]], dtype=dtype)
+    links = None
+    if kind == "authors":
+        indptr = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+        links = (indptr, np.array(indices, dtype=np.int64), np.array(list(book_ids), dtype=str))
+    return Table(ids, columns, valid, links)
+
+
+def load_tables(path=ANALYTICS_DIR, sources=None, rebuild=False):
+    """
+    Gets the books and authors tables, from the cache when it is up to date
+    :param path: cache directory
+    :param sources: dict of kind -> json file, None for data/*.json
+    :param rebuild: whether to ignore the cache
+    :return: dict of kind -> Table
+    """
+    tables = {}
+    for kind, source in (sources or SOURCES).items():
+        stat = os.stat(source)
+        stamp = [stat.st_mtime, stat.st_size]
+        cached = os.path.join(path, kind)
+        if not rebuild and os.path.exists(os.path.join(cached, "meta.json")):
+            table, built_from = load_table(cached)
+            if table is not None and built_from == stamp:
+                tables[kind] = table
+                continue
+        tables[kind] = build_table(iter_json_records(source), kind)
+        tables[kind].save(cached, stamp)
+    return tables
+
+
+def tables_from_db(path=ANALYTICS_DIR):
+    """
+    Builds the books and authors tables from the db (only the needed fields are read)
+    and caches them
+    :param path: cache directory
+    :return: dict of kind -> Table
+    """
+    db, client = connect_to_db()
+    tables = {}
+    try:
+        for kind in KEYS:
+            projection = dict.fromkeys([KEYS[kind], URL_KEYS[kind]] + list(COLUMNS), 1)
+            if kind == "authors":
+                projection["author_books"] = 1
+            projection["_id"] = 0
+            tables[kind] = build_table(db[kind].find({}, projection, batch_size=1000), kind)
+            tables[kind].save(os.path.join(path, kind))
+    finally:
+        client.close()
+    return tables
+
+
+def weighted_ratings(table, min_count=None):
+    """
+    Bayesian average rating, pulls the ratings of rarely rated rows toward the mean:
+    (v * R + m * C) / (v + m), v = rating_count, R = rating, C = mean rating
+    :param table: books or authors Table
+    :param min_count: m, None for the median rating_count
+    :return: float array, NaN where rating or rating_count is missing
+    """
+    valid = table.valid["rating"] & table.valid["rating_count"]
+    scores = np.full(len(table), np.nan)
+    if not valid.any():
+        return scores
+    ratings = table.columns["rating"][valid]
+    counts = table.columns["rating_count"][valid].astype(np.float64)
+    if min_count is None:
+        min_count = float(np.median(counts))
+    mean = float(np.average(ratings, weights=counts)) if counts.sum() else float(ratings.mean())
+    scores[valid] = (counts * ratings + min_count * mean) / np.maximum(counts + min_count, 1e-12)
+    return scores
+
+
+def top(table, scores, n=10):
+    """
+    :param table: Table the scores are of
+    :param scores: float array, NaN rows are left out
+    :param n: number of rows
+    :return: list of (id, score), best first
+    """
+    rows = np.flatnonzero(~np.isnan(scores))
+    if len(rows) > n:
+        rows = rows[np.argpartition(-scores[rows], n - 1)[:n]]
+    rows = rows[np.lexsort((rows, -scores[rows]))]
+    return [(table.ids[row], float(scores[row])) for row in rows]
+
+
+def author_aggregates(authors, books):
+    """
+    Aggregates the books of every author (author_books found in the books table)
+    :param authors: authors Table
+    :param books: books Table
+    :return: dict of name -> array with one value per author: "books" (books found),
+        "rated_books", "mean_rating" (NaN without rated books), "total_rating_count",
+        "total_review_count"
+    """
+    indptr, indices, book_ids = authors.links
+    rows = book_rows(books, book_ids)[indices]
+    owners = np.repeat(np.arange(len(authors)), np.diff(indptr))  # author of every link
+    found = rows >= 0
+    owners, rows = owners[found], rows[found]
+    n = len(authors)
+    rated = books.valid["rating"][rows]
+    rated_books = np.bincount(owners[rated], minlength=n)
+    rating_sum = np.bincount(owners[rated], weights=books.columns["rating"][rows][rated],
+                             minlength=n)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_rating = np.where(rated_books > 0, rating_sum / np.maximum(rated_books, 1), np.nan)
+    totals = {}
+    for column in ("rating_count", "review_count"):
+        ok = books.valid[column][rows]
+        totals[column] = np.bincount(owners[ok], weights=books.columns[column][rows][ok],
+                                     minlength=n).astype(np.int64)
+    return {
+        "books": np.bincount(owners, minlength=n),
+        "rated_books": rated_books,
+        "mean_rating": mean_rating,
+        "total_rating_count": totals["rating_count"],
+        "total_review_count": totals["review_count"],
+    }
+
+
+def book_rows(books, book_ids):
+    """
+    Finds book ids in the books table, with a binary search over the sorted ids
+    :param books: books Table
+    :param book_ids: string array of book ids
+    :return: int array of the rows of the ids in books, -1 for ids it doesn't have
+    """
+    ids = np.array(books.ids, dtype=str)
+    if not len(ids) or not len(book_ids):
+        return np.full(len(book_ids), -1, dtype=np.int64)
+    order = np.argsort(ids)
+    positions = np.minimum(np.searchsorted(ids[order], book_ids), len(ids) - 1)
+    rows = order[positions]
+    return np.where(ids[rows] == book_ids, rows, -1).astype(np.int64)
+
+
+def distribution(table, column, q=(5, 25, 50, 75, 95)):
+    """
+    :param table: Table
+    :param column: one of COLUMNS
+    :param q: percentiles
+    :return: dict with count, missing, mean and one entry per percentile ("p50", ...)
+    """
+    values = table.values(column)
+    result = {"count": int(len(values)), "missing": int(len(table) - len(values))}
+    if len(values):
+        result["mean"] = float(values.mean())
+        for p, value in zip(q, np.percentile(values, q)):
+            result["p%g" % p] = float(value)
+    return result
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError("analytics.py needs numpy (pip install numpy)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ratings reports over data/*.json or the db")
+    parser.add_argument("--db", action="store_true", help="read the db instead of data/*.json")
+    parser.add_argument("--rebuild", action="store_true", help="ignore the cached columns")
+    parser.add_argument("--top", type=int, default=10, help="number of rows in the top lists")
+    args = parser.parse_args()
+    loaded = tables_from_db() if args.db else load_tables(rebuild=args.rebuild)
+    for kind_name in KEYS:
+        print("top %s by weighted rating:" % kind_name)
+        for row_id, score in top(loaded[kind_name], weighted_ratings(loaded[kind_name]), args.top):
+            print("  %-12s %.3f" % (row_id, score))
+    aggregates = author_aggregates(loaded["authors"], loaded["books"])
+    print("authors with the most rated books:")
+    for row_id, count in top(loaded["authors"], aggregates["rated_books"].astype(float), args.top):
+        print("  %-12s %d books" % (row_id, count))
+    for kind_name in KEYS:
+        for column_name in COLUMNS:
+            print("%s %s: %s" % (kind_name, column_name,
+                                 json.dumps(distribution(loaded[kind_name], column_name))))
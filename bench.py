@@ -0,0 +1,434 @@
+"""
+Offline benchmark of the scraper
+Serves synthetic Goodreads pages built from data/books.json and data/authors.json
+from a local http server (with optional latency and error injection), runs
+scrape_n_books/scrape_n_authors against it and writes the results to a json file
+"""
+import argparse
+import html
+import http.server
+import json
+import os
+import random
+import resource
+import threading
+import time
+from urllib.parse import urlparse
+
+import settings
+from db import BatchWriter, iter_json_records
+from extract import extract_page
+from fetcher import Fetcher, set_fetcher
+from registry import GOODREADS_HOST, canonical_id
+from throttle import RetryingFetcher, Throttle
+
+curr_dir = os.path.dirname(os.path.abspath(__file__))
+BOOKS_PATH = os.path.join(curr_dir, "data", "books.json")
+AUTHORS_PATH = os.path.join(curr_dir, "data", "authors.json")
+FILLER = "<div class=\"filler\"><p>%s</p></div>\n" % ("lorem ipsum " * 40)
+
+
+class FixtureSite:
+    """
+    Synthetic Goodreads pages, generated from the scraped records
+    Urls that have no scraped record get a page with made up values and no links
+    """
+
+    def __init__(self, books_path=BOOKS_PATH, authors_path=AUTHORS_PATH, page_kb=100):
+        """
+        :param books_path: json file of books
+        :param authors_path: json file of authors
+        :param page_kb: approximate size of every page in KB (filled with padding)
+        """
+        self.books = {}
+        self.authors = {}
+        for book in iter_json_records(books_path):
+            self.books.setdefault(canonical_id(book["book_url"]), book)
+        for author in iter_json_records(authors_path):
+            if "author_url" in author:
+                self.authors.setdefault(canonical_id(author["author_url"]), author)
+        self.padding = FILLER * max(0, page_kb * 1024 // len(FILLER))
+
+    def page(self, path):
+        """
+        :param path: path of the requested url
+        :return: html as string, None for unknown paths
+        """
+        parts = path.split("/")
+        if len(parts) < 4:
+            return None
+        id_ = canonical_id(path)
+        if parts[1:3] == ["book", "show"]:
+            return self.book_page(id_)
+        if parts[1:3] == ["author", "show"]:
+            return self.author_page(id_)
+        if parts[1:3] == ["author", "similar"]:
+            return self.similar_authors_page(id_)
+        return None
+
+    def book_page(self, id_):
+        book = self.books.get(id_, {})
+        names = book.get("author") or ["Author %s" % id_]
+        author_urls = book.get("author_url") or []
+        authors = "".join(
+            '<a class="authorName" href="%s"><span itemprop="name">%s</span></a>\n'
+            % (attr(url), text(name)) for name, url in zip(names, author_urls))
+        similar = "".join(
+            '<li class="cover"><a href="%s"><img src="/cover.jpg"></a></li>\n' % attr(url)
+            for url in book.get("similar_books") or [])
+        return (
+            "<html><head>\n"
+            '<meta property="books:isbn" content="%s">\n'
+            '<meta itemprop="ratingCount" content="%s">\n'
+            '<meta itemprop="reviewCount" content="%s">\n'
+            "</head><body>\n%s"
+            '<h1 id="bookTitle">\n  %s\n</h1>\n%s'
+            '<span itemprop="ratingValue">\n  %s\n</span>\n'
+            '<img id="coverImage" src="%s">\n'
+            '<div id="relatedWorks-%s"><ul>\n%s</ul></div>\n'
+            "%s</body></html>"
+            % (attr(book.get("isbn", "null")), attr(book.get("rating_count", "0")),
+               attr(book.get("review_count", "0")), self.padding,
+               text(book.get("title", "Book %s" % id_)), authors,
+               text(book.get("rating", "0.00")), attr(book.get("image_url", "/cover.jpg")),
+               id_, similar, self.padding))
+
+    def author_page(self, id_):
+        author = self.authors.get(id_, {})
+        name = author.get("name") or "Author %s" % id_
+        rows = "".join(
+            '<tr itemtype="http://schema.org/Book"><td><a href="%s">'
+            '<span itemprop="name">Book</span></a></td></tr>\n' % attr(urlparse(url).path)
+            for url in author.get("author_books") or [])
+        return (
+            "<html><body>\n%s"
+            '<img alt="%s" src="%s">\n'
+            '<span class="average">%s</span>\n'
+            '<span itemprop="ratingCount" content="%s"></span>\n'
+            '<span itemprop="reviewCount" content="%s"></span>\n'
+            '<a href="/author/similar/%s">Similar authors</a>\n'
+            "<table>\n%s</table>\n%s</body></html>"
+            % (self.padding, attr(name_text(name)), attr(author.get("image_url", "/a.jpg")),
+               text(author.get("rating", "0.00")), attr(author.get("rating_count", "0")),
+               attr(author.get("review_count", "0")), id_, rows, self.padding))
+
+    def similar_authors_page(self, id_):
+        author = self.authors.get(id_, {})
+        links = ""
+        for url in author.get("related_authors") or []:
+            related = self.authors.get(canonical_id(url), {})
+            links += '<a href="%s"><span itemprop="name">%s</span></a>\n' % (
+                attr(url), text(name_text(related.get("name") or "Author")))
+        return ('<html><body>\n<span itemprop="name">%s</span>\n%s</body></html>'
+                % (text(name_text(author.get("name") or "Author")), links))
+
+
+def name_text(name):
+    """
+    :param name: author name (older records store it as a list)
+    :return: name as string
+    """
+    return "".join(name) if isinstance(name, list) else name
+
+
+def text(value):
+    return html.escape(str(value), quote=False)
+
+
+def attr(value):
+    return html.escape(str(value), quote=True)
+
+
+class FixtureServer:
+    """
+    Local http server for a FixtureSite
+    Every response is delayed by latency seconds (+-50% jitter), a share
+    of the requests (error_rate) fail with 503 and requests above capacity
+    per second are answered with 429 and a Retry-After header
+    """
+
+    def __init__(self, site, latency=0.0, error_rate=0.0, seed=0, capacity=None):
+        self.site = site
+        self.latency = latency
+        self.error_rate = error_rate
+        self.capacity = capacity
+        self.window = []  # start times of the requests of the last second
+        self.rejected = 0
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.served = []  # (path, html) of the pages served, for parse timing
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with server.lock:
+                    delay = server.latency * server.random.uniform(0.5, 1.5)
+                    fail = server.random.random() < server.error_rate
+                    overloaded = server.overloaded()
+                if overloaded:
+                    self.send_response(429)
+                    self.send_header("Retry-After", "1")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                time.sleep(delay)
+                page = None if fail else server.site.page(urlparse(self.path).path)
+                if page is None:
+                    status = 503 if fail else 404
+                    self.send_response(status)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                with server.lock:
+                    server.served.append((self.path, page))
+                body = page.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # keep the benchmark output clean
+
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.origin = "http://127.0.0.1:%d" % self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def overloaded(self):
+        """
+        Counts a request against capacity, called with lock held
+        :return: whether the request is over capacity
+        """
+        if self.capacity is None:
+            return False
+        now = time.monotonic()
+        self.window = [start for start in self.window if start > now - 1.0]
+        if len(self.window) >= self.capacity:
+            self.rejected += 1
+            return True
+        self.window.append(now)
+        return False
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class TimedFetcher:
+    """
+    Wraps a fetcher and records the latency of every fetch
+    """
+
+    def __init__(self, fetcher):
+        self.fetcher = fetcher
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+
+    def fetch(self, url, headers=None):
+        start = time.perf_counter()
+        try:
+            return self.fetcher.fetch(url, headers)
+        except Exception:
+            with self.lock:
+                self.errors += 1
+            raise
+        finally:
+            with self.lock:
+                self.latencies.append(time.perf_counter() - start)
+
+    def stats(self):
+        return self.fetcher.stats()
+
+
+def percentiles(values):
+    """
+    :param values: list of numbers
+    :return: dict of p50, p99, mean and max (None when values is empty)
+    """
+    if not values:
+        return {"p50": None, "p99": None, "mean": None, "max": None}
+    values = sorted(values)
+    return {
+        "p50": values[int(0.50 * (len(values) - 1))],
+        "p99": values[int(0.99 * (len(values) - 1))],
+        "mean": sum(values) / len(values),
+        "max": values[-1],
+    }
+
+
+def measure_parse(served, name_of):
+    """
+    Times the extraction of every page served during the crawl
+    :param served: list of (path, html)
+    :param name_of: function(path) -> author name for author pages
+    :return: list of latencies in seconds
+    """
+    latencies = []
+    for path, page in served:
+        if path.startswith("/book/show/"):
+            kind, name = "book", None
+        elif path.startswith("/author/show/"):
+            kind, name = "author", name_of(path)
+        else:
+            continue
+        start = time.perf_counter()
+        extract_page(kind, page, name)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def measure_db_writes(records, mongo_uri=None, batch_size=500):
+    """
+    Times writing records through the BatchWriter
+    :param records: list of (dict, collection name)
+    :param mongo_uri: uri of a local mongod, None to use mongomock
+    :param batch_size: documents per bulk write
+    :return: dict of backend, docs, elapsed and docs_per_sec (None when no backend)
+    """
+    if mongo_uri is not None:
+        from pymongo import MongoClient
+        client = MongoClient(mongo_uri)
+        client.drop_database("library")
+        backend = "mongod"
+    else:
+        try:
+            import mongomock
+        except ImportError:
+            return None
+        client = mongomock.MongoClient()
+        backend = "mongomock"
+    writer = BatchWriter(client=client, batch_size=batch_size)
+    start = time.perf_counter()
+    for record, collection_name in records:
+        writer.write(record, collection_name)
+    writer.close()
+    elapsed = time.perf_counter() - start
+    return {"backend": backend, "docs": writer.counters["written"],
+            "failed": writer.counters["failed"], "elapsed": elapsed,
+            "docs_per_sec": writer.counters["written"] / elapsed if elapsed else None}
+
+
+def run_benchmark(num_books, num_authors, workers=4, latency=0.05, error_rate=0.0,
+                  page_kb=100, parse_processes=0, mongo_uri=None, seed=0, compact=False,
+                  capacity=None, retries=0, adaptive=False, rate=None):
+    """
+    Crawls the fixture site and measures the scraper
+    With retries or adaptive, requests go through a RetryingFetcher (throttle.py),
+    adaptive starts at rate requests per second and adapts it to the server
+    :return: dict of results
+    """
+    from pipeline import ParsePool
+    from scrape_authors import scrape_n_authors
+    from scrape_books import scrape_n_books
+
+    site = FixtureSite(page_kb=page_kb)
+    start_url = next(iter(site.books.values()))["book_url"]
+    with FixtureServer(site, latency, error_rate, seed, capacity) as server:
+        fetcher = Fetcher(max_connections=workers,
+                          hosts={GOODREADS_HOST: server.origin, "goodreads.com": server.origin})
+        crawl_rate = rate
+        if retries or adaptive:
+            throttle = Throttle(rate or 1.0, adaptive=True) if adaptive else Throttle()
+            fetcher = RetryingFetcher(fetcher, throttle, retries)
+            crawl_rate = None if adaptive else rate
+        fetcher = TimedFetcher(fetcher)
+        set_fetcher(fetcher)
+        settings.init(compact)
+        parse_pool = ParsePool(parse_processes) if parse_processes else None
+        start = time.perf_counter()
+        try:
+            scrape_n_books(num_books, start_url, False, workers, crawl_rate, None, None,
+                           parse_pool)
+            books_elapsed = time.perf_counter() - start
+            scrape_n_authors(num_authors, False, workers, crawl_rate, None, None, parse_pool)
+        finally:
+            if parse_pool is not None:
+                parse_pool.close()
+        elapsed = time.perf_counter() - start
+        served = list(server.served)
+        rejected = server.rejected
+
+    def name_of(path):
+        author = settings.authors.get(path)
+        return author["name"] if author else ""
+
+    scraped = [(book, "books") for book in settings.books if "title" in book]
+    scraped += [(author, "authors") for author in settings.authors if "author_id" in author]
+    pages = len(fetcher.latencies)
+    return {
+        "config": {"num_books": num_books, "num_authors": num_authors, "workers": workers,
+                   "latency": latency, "error_rate": error_rate, "page_kb": page_kb,
+                   "parse_processes": parse_processes, "seed": seed, "compact": compact,
+                   "capacity": capacity, "retries": retries, "adaptive": adaptive,
+                   "rate": rate},
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "elapsed": elapsed,
+        "books_elapsed": books_elapsed,
+        "pages": pages,
+        "pages_per_sec": pages / elapsed if elapsed else None,
+        "fetch_errors": fetcher.errors,
+        "rejected": rejected,
+        "records": {"books": len(settings.books), "authors": len(settings.authors),
+                    "scraped": len(scraped)},
+        "fetch_latency": percentiles(fetcher.latencies),
+        "parse_latency": percentiles(measure_parse(served, name_of)),
+        "fetcher": fetcher.stats(),
+        "db": measure_db_writes(scraped, mongo_uri),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def get_args():
+    """
+    Gets command line inputs from user
+    """
+    parser = argparse.ArgumentParser(description="offline benchmark of the scraper")
+    parser.add_argument("--num_books", type=int, default=200, help="number of books to scrape")
+    parser.add_argument("--num_authors", type=int, default=50,
+                        help="number of authors to scrape")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="number of pages downloaded concurrently")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="mean server latency in seconds")
+    parser.add_argument("--error_rate", type=float, default=0.0,
+                        help="share of requests answered with 503")
+    parser.add_argument("--page_kb", type=int, default=100, help="size of every page in KB")
+    parser.add_argument("--parse_processes", type=int, default=0,
+                        help="number of processes extracting pages, 0 for none")
+    parser.add_argument("--mongo_uri", default=None,
+                        help="local mongod to measure db writes against (default: mongomock)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the injected latency/errors")
+    parser.add_argument("--compact", action="store_true",
+                        help="keep records as compact records (store.py) instead of dicts")
+    parser.add_argument("--capacity", type=float, default=None,
+                        help="requests per second the server accepts, more are answered "
+                             "with 429 and Retry-After (default: no limit)")
+    parser.add_argument("--retries", type=int, default=0,
+                        help="retries of a failed request (throttle.py), 0 for none")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="adapt the request rate to the server (throttle.py)")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="max requests per second, the starting rate with --adaptive")
+    parser.add_argument("--output", default="bench_results.json",
+                        help="json file the results are appended to (one run per line)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    results = run_benchmark(args.num_books, args.num_authors, args.workers, args.latency,
+                            args.error_rate, args.page_kb, args.parse_processes,
+                            args.mongo_uri, args.seed, args.compact, args.capacity,
+                            args.retries, args.adaptive, args.rate)
+    with open(args.output, "a") as file:
+        file.write(json.dumps(results) + "\n")
+    print(json.dumps(results, indent=4))
@@ -0,0 +1,260 @@
+"""
+This module defines the on-disk page cache
+Pages are stored gzip compressed and content addressed (by sha256 of the html),
+an sqlite index maps each canonical url to its page and validators
+(ETag / Last-Modified) so pages can be revalidated with conditional GETs
+"""
+import gzip
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from fetcher import FetchError
+from metrics import METRICS
+from registry import canonical_url
+
+curr_dir = os.path.dirname(os.path.abspath(__file__))
+CACHE_DIR = os.path.join(curr_dir, "data", "cache")
+MAX_BYTES = 1024 * 1024 * 1024  # 1 GB of compressed pages
+MAX_AGE = 30 * 24 * 60 * 60  # 30 days
+EVICT_EVERY = 1000  # puts between two eviction passes
+
+
+class CacheMiss(Exception):
+    """
+    Raised in replay mode when a page is not in the cache
+    """
+
+
+class CacheEntry:
+    """
+    One cached page
+    """
+
+    def __init__(self, url, html, etag, last_modified, fetched_at):
+        self.url = url
+        self.html = html
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+
+
+class PageCache:
+    """
+    Persistent, thread safe cache of html pages keyed by canonical url
+    Evicts pages older than max_age, then the oldest pages until the
+    compressed size is under max_bytes
+    """
+
+    def __init__(self, path=CACHE_DIR, max_bytes=MAX_BYTES, max_age=MAX_AGE):
+        """
+        :param path: directory of the cache
+        :param max_bytes: max total size of the compressed pages
+        :param max_age: max age of a page in seconds
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.puts = 0
+        os.makedirs(os.path.join(path, "blobs"), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(path, "index.db"),
+                                    check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "url TEXT PRIMARY KEY, digest TEXT NOT NULL, etag TEXT, "
+            "last_modified TEXT, fetched_at REAL NOT NULL, size INTEGER NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS pages_fetched_at ON pages (fetched_at)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS pages_digest ON pages (digest)")
+        self.conn.commit()
+
+    def get(self, url):
+        """
+        Gets a cached page
+        :param url: url of page
+        :return: CacheEntry if cached, None otherwise
+        """
+        key = canonical_url(url)
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT digest, etag, last_modified, fetched_at FROM pages WHERE url = ?",
+                (key,)).fetchone()
+        if row is None:
+            return None
+        digest, etag, last_modified, fetched_at = row
+        try:
+            with gzip.open(self.blob_path(digest), "rb") as file:
+                html = file.read().decode("utf-8")
+        except OSError:
+            return None  # blob evicted or damaged, treat as a miss
+        return CacheEntry(key, html, etag, last_modified, fetched_at)
+
+    def put(self, url, html, etag=None, last_modified=None):
+        """
+        Stores a page (identical pages share one blob)
+        :param url: url of page
+        :param html: html as string
+        :param etag: ETag response header
+        :param last_modified: Last-Modified response header
+        """
+        data = html.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+        tmp_path = None
+        if not os.path.exists(path):
+            # compressed outside the lock, only the rename and the row are locked
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = "%s.%d.tmp" % (path, threading.get_ident())
+            with gzip.open(tmp_path, "wb", compresslevel=6) as file:
+                file.write(data)
+        with self.lock:  # evict() can't delete the blob before its row is inserted
+            if tmp_path is not None:
+                os.replace(tmp_path, path)  # atomic, readers never see half a blob
+            elif not os.path.exists(path):
+                # evicted since the check, written again under the lock (rare)
+                with gzip.open(path + ".tmp", "wb", compresslevel=6) as file:
+                    file.write(data)
+                os.replace(path + ".tmp", path)
+            size = os.path.getsize(path)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)",
+                (canonical_url(url), digest, etag, last_modified, time.time(), size))
+            self.conn.commit()
+            self.puts += 1
+            evict = self.puts % EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def touch(self, url):
+        """
+        Marks a page as fresh after a successful revalidation
+        :param url: url of page
+        """
+        with self.lock:
+            self.conn.execute("UPDATE pages SET fetched_at = ? WHERE url = ?",
+                              (time.time(), canonical_url(url)))
+            self.conn.commit()
+
+    def evict(self):
+        """
+        Drops pages older than max_age, then the oldest pages while the cache
+        is bigger than max_bytes, and deletes blobs no page refers to anymore
+        :return: number of pages evicted
+        """
+        with self.lock:
+            cur = self.conn.execute("DELETE FROM pages WHERE fetched_at < ?",
+                                    (time.time() - self.max_age,))
+            evicted = cur.rowcount
+            total = 0
+            for url, size in self.conn.execute(
+                    "SELECT url, size FROM pages ORDER BY fetched_at DESC").fetchall():
+                total += size
+                if total > self.max_bytes:
+                    self.conn.execute("DELETE FROM pages WHERE url = ?", (url,))
+                    evicted += 1
+            self.conn.commit()
+            live = {row[0] for row in self.conn.execute("SELECT DISTINCT digest FROM pages")}
+        # the walk runs unlocked, every delete rechecks under the lock that no
+        # put() inserted a row for the blob meanwhile
+        blobs = os.path.join(self.path, "blobs")
+        for sub_dir in os.listdir(blobs):
+            for name in os.listdir(os.path.join(blobs, sub_dir)):
+                digest = name[:-len(".html.gz")]
+                if not name.endswith(".html.gz") or digest in live:
+                    continue
+                with self.lock:
+                    if self.conn.execute("SELECT 1 FROM pages WHERE digest = ? LIMIT 1",
+                                         (digest,)).fetchone() is None:
+                        try:
+                            os.remove(os.path.join(blobs, sub_dir, name))
+                        except OSError:
+                            pass
+        return evicted
+
+    def blob_path(self, digest):
+        """
+        :param digest: sha256 of the html
+        :return: path of the compressed page
+        """
+        return os.path.join(self.path, "blobs", digest[:2], digest + ".html.gz")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class CachedFetcher:
+    """
+    Wraps a Fetcher with a PageCache
+    Cached pages are revalidated with conditional GETs, in replay mode
+    pages are served from the cache only and the network is never used
+    """
+
+    def __init__(self, fetcher, cache, replay=False):
+        """
+        :param fetcher: Fetcher used for network requests (None in replay mode)
+        :param cache: PageCache
+        :param replay: whether to serve pages from the cache only
+        """
+        self.fetcher = fetcher
+        self.cache = cache
+        self.replay = replay
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "revalidated": 0}
+
+    def fetch(self, url, headers=None):
+        """
+        Gets the html of a page, from the cache when it is still valid
+        :param url: url of page
+        :param headers: extra headers for this request
+        :return: html as string
+        """
+        with METRICS.timer("cache_read"):
+            entry = self.cache.get(url)
+        if self.replay:
+            self.count("hits" if entry else "misses")
+            if entry is None:
+                raise CacheMiss(url)
+            return entry.html
+
+        request_headers = dict(headers or {})
+        if entry is not None:
+            if entry.etag:
+                request_headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                request_headers["If-Modified-Since"] = entry.last_modified
+        with METRICS.timer("fetch"):
+            response = self.fetcher.get(url, request_headers)
+        if response.status == 304 and entry is not None:
+            self.count("revalidated")
+            self.cache.touch(url)
+            return entry.html
+        if response.status != 200:
+            raise FetchError(url, response.status)
+        self.count("misses")
+        html = response.text()
+        self.cache.put(url, html, response.headers.get("etag"),
+                       response.headers.get("last-modified"))
+        return html
+
+    def count(self, name):
+        METRICS.incr("cache_" + name)
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        """
+        :return: dict of cache counters merged with the fetcher's counters
+        """
+        stats = self.fetcher.stats() if self.fetcher is not None else {}
+        with self.lock:
+            stats.update(self.counters)
+        return stats
+
+    def close(self):
+        if self.fetcher is not None:
+            self.fetcher.close()
+        self.cache.close()
@@ -0,0 +1,86 @@
+"""
+This module defines the concurrent fetch engine used by the scrapers
+Pages are downloaded by a thread pool with a per-host rate limit
+and handed back to the caller in discovery order
+"""
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+
+class RateLimiter:
+    """
+    Limits the number of requests per second sent to each host
+    Thread safe, requests to the same host are spaced evenly
+    """
+
+    def __init__(self, rate=None):
+        """
+        :param rate: max requests per second per host (None or 0 for no limit)
+        """
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_time = {}  # host -> earliest time the next request may start
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        """
+        Blocks until a request to the host of url is allowed
+        :param url: url about to be requested
+        """
+        if not self.interval:
+            return
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time.get(host, now))
+            self.next_time[host] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def crawl(next_url, count, fetch, process, workers=1, rate=None, skip=None):
+    """
+    Crawls count pages from a frontier that grows while it is being crawled
+    fetch runs in worker threads (in a copy of the caller's context, so they see
+    the caller's fetcher, see fetcher.use_fetcher), process runs in the calling
+    thread in frontier order, so results are deterministic for any number of workers
+    :param next_url: function(index) -> url at that frontier index, None if not discovered yet
+    :param count: number of pages to crawl, None to crawl until next_url runs out
+    :param fetch: function(url) -> page, must not touch shared state
+    :param process: function(index, url, page), merges the page into shared state
+    :param workers: number of pages downloaded at the same time
+    :param rate: max requests per second per host (None for no limit)
+    :param skip: function(index) -> True if the page is already done (counted, not fetched)
+    :return: number of pages processed
+    """
+    limiter = RateLimiter(rate)
+
+    def fetch_limited(url):
+        limiter.wait(url)
+        return fetch(url)
+
+    pending = {}  # frontier index -> (url, future)
+    next_index = 0  # next frontier index to submit
+    index = 0  # next frontier index to process
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        while count is None or index < count:
+            # keep up to workers downloads in flight ahead of the parser
+            while (count is None or next_index < count) and len(pending) < max(1, workers):
+                url = next_url(next_index)
+                if url is None:
+                    break
+                if skip is not None and skip(next_index):
+                    pending[next_index] = (url, None)
+                else:
+                    pending[next_index] = (url, pool.submit(
+                        contextvars.copy_context().run, fetch_limited, url))
+                next_index += 1
+            if index not in pending:
+                break  # frontier exhausted, nothing left to crawl
+            url, future = pending.pop(index)
+            if future is not None:
+                process(index, url, future.result())
+            index += 1
+    return index
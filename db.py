@@ -1,11 +1,27 @@
 """
 Module handles all db related functions
+pymongo is imported when the db is first used
 """
+import atexit
+import contextvars
+import gzip
+import itertools
 import json
 import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from dotenv import load_dotenv
-from pymongo import MongoClient
+from metrics import METRICS
+from registry import canonical_id, canonical_url
+from store import to_dict
+
+COLLECTIONS = ("books", "authors")
+KEYS = {"books": "book_id", "authors": "author_id"}  # unique id of each collection
+URL_KEYS = {"books": "book_url", "authors": "author_url"}
 
 
 def connect_to_db():
@@ -13,6 +29,9 @@ def connect_to_db():
     Connects to database (library)
     :return: db, client
     """
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+
     load_dotenv()
     client_string = os.getenv("CLIENT_STRING")
     client = MongoClient(client_string)
@@ -20,13 +39,17 @@ def connect_to_db():
     return db, client
 
 
-def update_db_from_json(json_file, collection_name):
+def update_db_from_json(json_file, collection_name, sync=False):
     """
     Updates the db by importing a json file
     Updates one collection at a time
     :param json_file: json file to write into db
     :param collection_name: collection to add docs into
+    :param sync: whether to upsert by book_id/author_id instead of inserting
+    :return: dict of inserted/updated/unchanged counts when syncing
     """
+    from pymongo import MongoClient
+
     client_string = os.getenv("CLIENT_STRING")
     client = MongoClient(client_string)
     db = client.library
@@ -37,57 +60,621 @@ def update_db_from_json(json_file, collection_name):
         collection = db.authors
     else:
         return None # Unacceptable collection name
-    insert_into_collection(json_file, collection)
+    counts = None
+    if sync:
+        counts = sync_from_json(json_file, collection)
+    else:
+        insert_into_collection(json_file, collection)
     client.close()
+    return counts
 
 
 def update_db_from_data(data, collection_name):
     """
     Updates the db by inserting one document (one dictionary object) into db
-    Updates one document in one collection at a time
+    The document is queued on the BatchWriter (see get_writer) and written in a batch
     :param data: dict to write into db
     :param collection_name: name of collection to add doc into
     """
-    client_string = os.getenv("CLIENT_STRING")
-    client = MongoClient(client_string)
-    db = client.library
-    collection = None
-    if collection_name == "books":
-        collection = db.books
-    elif collection_name == "authors":
-        collection = db.authors
-    else:
+    if collection_name not in COLLECTIONS:
         return None # Unacceptable collection name
-    collection.insert_one(data)  # inserts one document into db.collection
-    client.close()
+    get_writer().write(data, collection_name)
 
 
-def insert_into_collection(json_file, collection):
+class BatchWriter:
+    """
+    Long-lived db writer for real time updates
+    Documents are queued and inserted by a background thread with one client,
+    in unordered bulk writes of up to batch_size documents or every
+    flush_interval seconds. The queue is bounded, so a slow db blocks
+    the scraper instead of buffering without limit
+    """
+
+    def __init__(self, client=None, batch_size=500, flush_interval=1.0, max_queue=10000):
+        """
+        :param client: MongoClient to use, None to connect with CLIENT_STRING
+        :param batch_size: max number of documents per bulk write
+        :param flush_interval: max seconds a document waits in the buffer
+        :param max_queue: max number of documents waiting to be written
+        """
+        from pymongo import MongoClient
+
+        self.client = client if client is not None else MongoClient(os.getenv("CLIENT_STRING"))
+        self.db = self.client.library
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.counters = {"written": 0, "failed": 0, "batches": 0}
+        self.errors = []  # last bulk write errors, for inspection
+        self.error = None  # unexpected exception that stopped the thread
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name="db-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)  # flush whatever is left on exit, also after a crash
+
+    def write(self, data, collection_name):
+        """
+        Queues one document, blocks while the queue is full
+        Raises the exception that stopped the thread, if any
+        :param data: dict or store.CompactRecord to write into db (copied, later
+            changes are not written)
+        :param collection_name: name of collection to add doc into
+        """
+        if self.closed:
+            raise RuntimeError("BatchWriter is closed")
+        item = (collection_name, dict(to_dict(data)))
+        while True:
+            if self.error is not None:
+                raise self.error
+            try:
+                self.queue.put(item, timeout=0.1)  # wakes up to notice a dead thread
+                return
+            except queue.Full:
+                pass
+
+    def run(self):
+        """
+        Background loop, buffers documents per collection and flushes them
+        An unexpected exception stops it, it is kept in self.error and raised by
+        write() and close()
+        """
+        buffers = {name: [] for name in COLLECTIONS}
+        last_flush = time.monotonic()
+        done = False
+        try:
+            while not done:
+                timeout = max(0.0, last_flush + self.flush_interval - time.monotonic())
+                try:
+                    item = self.queue.get(timeout=timeout)
+                    if item is None:
+                        done = True  # close() was called
+                    else:
+                        collection_name, data = item
+                        buffers[collection_name].append(data)
+                except queue.Empty:
+                    pass
+                full = any(len(docs) >= self.batch_size for docs in buffers.values())
+                if done or full or time.monotonic() - last_flush >= self.flush_interval:
+                    for collection_name, docs in buffers.items():
+                        while docs:
+                            self.flush(collection_name, docs[:self.batch_size])
+                            del docs[:self.batch_size]
+                    last_flush = time.monotonic()
+        except Exception as error:
+            for collection_name, docs in buffers.items():  # not written
+                self.counters["failed"] += len(docs)
+                METRICS.incr("db_docs_failed", len(docs), collection=collection_name)
+            self.error = error
+
+    def flush(self, collection_name, docs):
+        """
+        Inserts one batch of documents, documents that fail don't stop the others
+        :param collection_name: name of collection to add docs into
+        :param docs: list of dicts
+        """
+        from pymongo import InsertOne
+        from pymongo.errors import BulkWriteError, PyMongoError
+
+        try:
+            with METRICS.timer("db_write", collection=collection_name):
+                result = self.db[collection_name].bulk_write(
+                    [InsertOne(doc) for doc in docs], ordered=False)
+            self.counters["written"] += result.inserted_count
+            METRICS.incr("db_docs_written", result.inserted_count, collection=collection_name)
+        except BulkWriteError as error:
+            written = error.details.get("nInserted", 0)
+            self.counters["written"] += written
+            self.counters["failed"] += len(docs) - written
+            METRICS.incr("db_docs_written", written, collection=collection_name)
+            METRICS.incr("db_docs_failed", len(docs) - written, collection=collection_name)
+            self.errors = error.details.get("writeErrors", [])
+        except PyMongoError as error:
+            self.counters["failed"] += len(docs)
+            METRICS.incr("db_docs_failed", len(docs), collection=collection_name)
+            self.errors = [str(error)]
+        self.counters["batches"] += 1
+
+    def close(self):
+        """
+        Flushes all queued documents, stops the thread and closes the client
+        Raises the exception that stopped the thread, if any
+        """
+        if self.closed:
+            return
+        self.closed = True
+        while self.error is None:
+            try:
+                self.queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.thread.join()
+        self.client.close()
+        atexit.unregister(self.close)
+        if self.error is not None:
+            raise self.error
+
+
+_writer = None
+_writer_lock = threading.Lock()
+_scoped_writer = contextvars.ContextVar("writer", default=None)  # of the running Scraper
+
+
+def get_writer():
+    """
+    Gets the BatchWriter of the running Scraper (see use_writer), or else the one
+    shared by the scrapers, created on first use
+    :return: BatchWriter
+    """
+    global _writer
+    scoped = _scoped_writer.get()
+    if scoped is not None:
+        return scoped
+    with _writer_lock:
+        if _writer is None or _writer.closed:
+            _writer = BatchWriter()
+        return _writer
+
+
+def use_writer(writer):
+    """
+    Uses a BatchWriter for the real time updates of the current context only
+    :param writer: BatchWriter, None to use the shared one
+    :return: token for reset_writer
+    """
+    return _scoped_writer.set(writer)
+
+
+def reset_writer(token):
+    """
+    Undoes use_writer
+    :param token: token returned by use_writer
+    """
+    _scoped_writer.reset(token)
+
+
+def close_writer():
+    """
+    Flushes and closes the shared BatchWriter if it was used
+    """
+    global _writer
+    with _writer_lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        writer.close()
+
+
+def insert_into_collection(json_file, collection, batch_size=1000):
     """
     Reads from json file and inserts all the documents
     in the json file into the specified collection
-    :param json_file: json file to write into db
+    The file is streamed, only batch_size documents are in memory at a time
+    :param json_file: json file (json array or ndjson) to write into db
     :param collection: collection to write into
+    :param batch_size: number of documents per insert
+    """
+    batch = []
+    for doc in iter_json_records(json_file):
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+
+
+def iter_json_records(json_file, chunk_size=64 * 1024):
+    """
+    Streams the records of a json file without loading the whole file
+    Supports json arrays (data_to_json output) and ndjson (one record per line)
+    :param json_file: path of the file
+    :param chunk_size: number of characters read at a time
+    :return: generator of dicts
     """
-    # read json
     with open(json_file) as file:
-        data = json.load(file)
-    # insert all the docs
-    collection.insert_many(data)
+        head = file.read(chunk_size)
+        if head.lstrip()[:1] != "[":
+            yield from iter_ndjson(head, file)
+        else:
+            yield from iter_json_array(head, file, chunk_size)
 
 
-def export_from_collection(json_file, collection, filter):
-    cursor = collection.find(filter, {'_id': 0})
-    list_cur = list(cursor)
-    with open(json_file, "a+") as write_file:
-        json.dump(list_cur, write_file, indent=4)
+def iter_ndjson(head, file):
+    """
+    Yields the records of an ndjson file, skips blank lines and a torn last line
+    :param head: text already read from the file
+    :param file: file object positioned after head
+    """
+    lines = iter((head + file.readline()).splitlines(keepends=True))
+    for line in itertools.chain(lines, file):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError:
+            if line.endswith("\n"):
+                raise
+            # last line cut short by a crash while it was being written
+
+
+def iter_json_array(head, file, chunk_size):
+    """
+    Yields the elements of a json array one at a time
+    :param head: text already read from the file, starts with the array
+    :param file: file object positioned after head
+    :param chunk_size: number of characters read at a time
+    """
+    decoder = json.JSONDecoder()
+    buffer = head
+    pos = buffer.index("[") + 1
+    eof = False
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+        try:
+            if pos >= len(buffer):
+                raise ValueError("need more data")
+            record, pos = decoder.raw_decode(buffer, pos)
+        except ValueError:
+            if eof:
+                raise
+            chunk = file.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        yield record
+
+
+class NdjsonWriter:
+    """
+    Appends records to an ndjson file as soon as they are scraped
+    Every line is flushed, so a crash loses at most the record being written
+    """
+
+    def __init__(self, filename, append=False):
+        """
+        :param filename: path of the ndjson file
+        :param append: whether to keep the records already in the file
+        """
+        self.file = open(filename, "a" if append else "w")
+        self.written = set()  # python ids of the records written so far
+
+    def write(self, record):
+        """
+        Writes one record as one line
+        :param record: dict or store.CompactRecord
+        """
+        self.file.write(json.dumps(to_dict(record)) + "\n")
+        self.file.flush()
+        self.written.add(id(record))
+
+    def write_remaining(self, records):
+        """
+        Writes the records that haven't been written yet
+        (e.g. books and authors discovered but not scraped)
+        :param records: iterable of dicts
+        """
+        for record in records:
+            if id(record) not in self.written:
+                self.write(record)
+
+    def write_all(self, records):
+        """
+        Writes records that can't have been written yet, e.g. the discovered pages
+        queued on disk (see Registry.queued_records), new dicts whose ids may be the
+        ones of records written before
+        :param records: iterable of dicts
+        """
+        for record in records:
+            self.file.write(json.dumps(to_dict(record)) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def ensure_indexes(db):
+    """
+    Creates the unique indexes sync relies on (book_id in books, author_id in authors)
+    and the index on author, so filtered exports scan indexes instead of collections
+    :param db: database (library)
+    """
+    for collection_name, key in KEYS.items():
+        db[collection_name].create_index(key, unique=True)
+    db.books.create_index("author")
+
+
+def sync_from_json(json_file, collection, batch_size=1000):
+    """
+    Reads from json file and syncs all the documents into the collection
+    :param json_file: json file (json array or ndjson) to write into db
+    :param collection: collection to write into (books or authors)
+    :param batch_size: number of documents compared and written per round trip
+    :return: dict of inserted/updated/unchanged counts
+    """
+    return sync_documents(iter_json_records(json_file), collection, batch_size)
+
+
+def sync_documents(docs, collection, batch_size=1000):
+    """
+    Upserts documents by book_id/author_id, writing only the fields that changed
+    Documents without an id (books/authors only discovered, not scraped yet)
+    get the id from their url and are only inserted, they never overwrite a
+    stored document, so syncing the same file twice changes nothing
+    Urls are stored in canonical form
+    :param docs: iterable of dicts or store.CompactRecord
+    :param collection: collection to write into (books or authors)
+    :param batch_size: number of documents compared and written per round trip
+    :return: dict of inserted/updated/unchanged counts
+    """
+    key = KEYS[collection.name]
+    collection.create_index(key, unique=True)
+    counts = {"inserted": 0, "updated": 0, "unchanged": 0}
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            sync_batch(batch, collection, key, counts)
+            batch = []
+    if batch:
+        sync_batch(batch, collection, key, counts)
+    return counts
+
+
+def sync_batch(docs, collection, key, counts):
+    """
+    Syncs one batch of documents, see sync_documents
+    :param docs: list of dicts or store.CompactRecord
+    :param collection: collection to write into
+    :param key: id field (book_id or author_id)
+    :param counts: dict of inserted/updated/unchanged counts to update
+    """
+    from pymongo import UpdateOne
+
+    url_key = URL_KEYS[collection.name]
+    ids = []
+    for doc in docs:
+        ids.append(doc.get(key) or canonical_id(doc[url_key]))
+    stored = {}
+    for existing in collection.find({key: {"$in": ids}}, {"_id": 0}):
+        stored[existing[key]] = existing
+
+    inserts = {}  # id -> [document, scraped], documents new in this batch
+    updates = {}  # id -> changed fields of stored documents
+    for id_, doc in zip(ids, docs):
+        scraped = bool(doc.get(key))
+        doc = {field: value for field, value in to_dict(doc).items() if field != "_id"}
+        if doc.get(url_key):
+            doc[url_key] = canonical_url(doc[url_key])  # same record under both hosts
+        existing = stored.get(id_)
+        if existing is None and id_ not in inserts:
+            inserts[id_] = [dict(doc, **{key: id_}), scraped]
+            counts["inserted"] += 1
+            continue
+        if not scraped:
+            counts["unchanged"] += 1  # a discovered only record adds nothing
+            continue
+        if existing is None:
+            # already inserted by this batch, later duplicates win like in the db
+            inserts[id_][0].update(doc)
+            inserts[id_][1] = True
+            counts["unchanged"] += 1
+            continue
+        changed = {field: value for field, value in doc.items()
+                   if field not in existing or existing[field] != value}
+        if changed:
+            updates.setdefault(id_, {}).update(changed)
+            counts["updated"] += 1
+            existing.update(changed)  # later duplicates in the batch diff against this
+        else:
+            counts["unchanged"] += 1
+
+    operations = []
+    for id_, (doc, scraped) in inserts.items():
+        # discovered only records don't overwrite a document written since the find
+        operations.append(UpdateOne({key: id_}, {"$set" if scraped else "$setOnInsert": doc},
+                                    upsert=True))
+    for id_, changed in updates.items():
+        operations.append(UpdateOne({key: id_}, {"$set": changed}))
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+
+
+def export_from_collection(json_file, collection, filter=None, batch_size=1000, fields=None,
+                           partitions=1):
+    """
+    Exports the documents of a collection into a file
+    Documents are streamed from batched cursors into a temporary file that replaces
+    json_file once complete, so the file is always valid and never appended to
+    The format follows the file name: .json (array) or .ndjson, plus .gz for gzip
+    Filters on book_id/author_id or author use the indexes of ensure_indexes
+    :param json_file: path of the output file
+    :param collection: collection to export (books or authors)
+    :param filter: query of the documents to export, None for all
+    :param batch_size: number of documents per cursor round trip
+    :param fields: list of fields to export (projection done by the db), None for all
+    :param partitions: number of book_id/author_id ranges exported in parallel
+        (the output is then sorted by id, in string order, see partition_queries)
+    :return: number of exported documents
+    """
+    filter = filter or {}
+    projection = {"_id": 0}
+    if fields:
+        projection.update(dict.fromkeys(fields, 1))
+    ndjson = ".ndjson" in os.path.basename(json_file)
+    directory = os.path.dirname(os.path.abspath(json_file))
+    handle, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    os.close(handle)
+    parts = []
+    try:
+        if partitions > 1:
+            key = KEYS[collection.name]
+            queries = partition_queries(collection, key, filter, partitions)
+            parts = [temp_path + ".%d" % i for i in range(len(queries))]
+            with ThreadPoolExecutor(max_workers=len(queries)) as pool:
+                counts = list(pool.map(
+                    lambda part, query: export_part(part, collection.find(
+                        query, projection, batch_size=batch_size).sort(key, 1), ndjson),
+                    parts, queries))
+        else:
+            parts = [temp_path + ".0"]
+            counts = [export_part(parts[0], collection.find(
+                filter, projection, batch_size=batch_size), ndjson)]
+        open_file = gzip.open if json_file.endswith(".gz") else open
+        with open_file(temp_path, "wt") as write_file:
+            if not ndjson:
+                write_file.write("[\n" if sum(counts) else "[]")
+            first = True
+            for part, count in zip(parts, counts):
+                if not count:
+                    continue
+                if not (first or ndjson):
+                    write_file.write(",\n")
+                first = False
+                with open(part) as part_file:
+                    shutil.copyfileobj(part_file, write_file)
+            if not ndjson and sum(counts):
+                write_file.write("\n]")
+        os.chmod(temp_path, 0o666 & ~current_umask())  # mkstemp creates files as 0600
+        os.replace(temp_path, json_file)
+    finally:
+        for path in parts + [temp_path]:
+            if os.path.exists(path):
+                os.remove(path)
+    return sum(counts)
+
+
+def partition_queries(collection, key, filter, partitions):
+    """
+    Splits the documents matching filter into ranges of key of about the same size
+    The bounds are read from the index on key
+    Ids are strings, so the ranges are in string order ("10" < "9"): the ranges
+    are not numeric intervals, but the bounds are taken at every total / partitions
+    documents in that same order, so the ranges hold about as many documents
+    :param collection: collection to export
+    :param key: book_id or author_id
+    :param filter: query of the documents to export
+    :param partitions: number of ranges
+    :return: list of queries, in key order
+    """
+    total = collection.count_documents(filter)
+    bounds = []
+    for i in range(1, partitions):
+        docs = list(collection.find(filter, {key: 1, "_id": 0}).sort(key, 1)
+                    .skip(i * total // partitions).limit(1))
+        if docs and docs[0].get(key) is not None and docs[0][key] not in bounds:
+            bounds.append(docs[0][key])
+    queries = []
+    for i in range(len(bounds) + 1):
+        range_ = {}
+        if i > 0:
+            range_["$gte"] = bounds[i - 1]
+        if i < len(bounds):
+            range_["$lt"] = bounds[i]
+        if not range_:
+            queries.append(filter)
+        elif i == 0:
+            # documents without an id sort first
+            queries.append({"$and": [filter, {"$or": [{key: {"$lt": bounds[0]}},
+                                                      {key: None}]}]})
+        else:
+            queries.append({"$and": [filter, {key: range_}]})
+    return queries
+
+
+def current_umask():
+    """
+    :return: umask of the process
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def export_part(path, cursor, ndjson):
+    """
+    Writes the documents of a cursor as json array items or ndjson lines
+    :param path: path of the part file
+    :param cursor: cursor (or iterable) of documents
+    :param ndjson: whether to write ndjson lines instead of array items
+    :return: number of documents written
+    """
+    with open(path, "w") as write_file:
+        if ndjson:
+            count = 0
+            for doc in cursor:
+                write_file.write(json.dumps(doc) + "\n")
+                count += 1
+            return count
+        return write_json_items(write_file, cursor)
+
+
+def write_json_items(write_file, records):
+    """
+    Writes records as the items of a json array indented like json.dump(indent=4),
+    without the brackets
+    :param write_file: file to write into
+    :param records: iterable of records
+    :return: number of records written
+    """
+    count = 0
+    for record in records:
+        if count:
+            write_file.write(",\n")
+        text = json.dumps(to_dict(record), indent=4)
+        write_file.write("    " + text.replace("\n", "\n    "))
+        count += 1
+    return count
 
 
 def data_to_json(filename, data):
     """
     Dumps data into a json file
+    Records are converted and written one at a time, the output is the same as
+    json.dump(data, indent=4)
+    :param filename: filename of the file to dump data into
+    :param data: iterable of records to be dumped
+    """
+    data = iter(data)
+    first = next(data, None)
+    with open(filename, "w+") as write_file:
+        if first is None:
+            write_file.write("[]")
+            return
+        write_file.write("[\n")
+        write_json_items(write_file, itertools.chain([first], data))
+        write_file.write("\n]")
+
+
+def data_to_ndjson(filename, data):
+    """
+    Dumps data into an ndjson file, one record per line
     :param filename: filename of the file to dump data into
-    :param data: data to be dumped
+    :param data: iterable of records to be dumped
     """
     with open(filename, "w+") as write_file:
-        json.dump(data, write_file, indent=4)
+        for record in data:
+            write_file.write(json.dumps(to_dict(record)) + "\n")
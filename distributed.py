@@ -0,0 +1,412 @@
+"""
+This module defines the distributed crawl, several scraper processes (on one or
+more machines) sharing a queue collection in the library database
+Every book and author url is one queue document with a unique _id, so
+discovered urls are deduplicated atomically by upserts. Pages are sharded by a
+hash of book_id/author_id, a worker leases pages of its shards for a visibility
+timeout and renews its leases with a heartbeat, pages of a dead worker are
+leased again once their lease expires
+Scraped records are upserted into the books and authors collections
+Run as a script to seed the queue, run a worker or show the queue state
+"""
+import argparse
+import hashlib
+import os
+import socket
+import threading
+import time
+import uuid
+
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+
+import settings
+from crawler import crawl
+from db import KEYS, connect_to_db, sync_documents
+from metrics import METRICS
+from registry import canonical_id, canonical_url
+from scrape_authors import fetch_and_extract_author, fetch_and_extract_similar_authors, \
+    merge_author_page, merge_related_authors
+from scrape_books import fetch_and_extract_book, merge_book
+
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+def shard_of(id_, num_shards):
+    """
+    :param id_: book_id/author_id
+    :param num_shards: number of shards
+    :return: shard of the page, stable across processes and machines
+    """
+    return int(hashlib.md5(id_.encode("utf-8")).hexdigest()[:8], 16) % num_shards
+
+
+def reset_queue(db, num_books, num_authors, start_url, num_shards=1):
+    """
+    Starts a new distributed crawl, forgets the previous queue
+    :param db: database (library)
+    :param num_books: max number of books scraped by all the workers
+    :param num_authors: max number of authors scraped by all the workers
+    :param start_url: url of the first book
+    :param num_shards: number of shards the pages are split into
+    """
+    db.crawl_queue.drop()
+    db.crawl_counters.drop()
+    db.crawl_queue.create_index([("state", ASCENDING), ("kind", ASCENDING),
+                                 ("shard", ASCENDING), ("depth", ASCENDING),
+                                 ("discovered_at", ASCENDING)])
+    db.crawl_queue.create_index([("owner", ASCENDING), ("state", ASCENDING)])
+    db.crawl_counters.insert_many([
+        {"_id": "config", "num_shards": num_shards},
+        {"_id": "books", "used": 0, "budget": num_books},
+        {"_id": "authors", "used": 0, "budget": num_authors},
+    ])
+    LeaseQueue(db).add("books", [(start_url, None)], 0)
+
+
+class LeaseQueue:
+    """
+    Shared queue of the pages of a distributed crawl
+    Every page is leased by one worker at a time, budgets are reserved
+    atomically, so all the workers together scrape at most num_books books
+    and num_authors authors
+    """
+
+    def __init__(self, db, owner=None, shards=None, lease_seconds=60.0, max_attempts=3):
+        """
+        :param db: database (library)
+        :param owner: name of this worker, None for host:pid:random
+        :param shards: shards this worker leases pages of, None for all
+        :param lease_seconds: visibility timeout, a page whose lease isn't renewed
+            for that long is handed out again
+        :param max_attempts: leases of a page before it is marked failed
+        """
+        self.queue = db.crawl_queue
+        self.counters = db.crawl_counters
+        config = self.counters.find_one({"_id": "config"}) or {"num_shards": 1}
+        self.num_shards = config["num_shards"]
+        self.owner = owner or "%s:%d:%s" % (socket.gethostname(), os.getpid(),
+                                            uuid.uuid4().hex[:6])
+        self.shards = list(range(self.num_shards)) if shards is None else list(shards)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.heartbeat_thread = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.leased = set()  # _id of the pages this worker is processing
+
+    def add(self, kind, items, depth):
+        """
+        Queues pages, pages already queued (by any worker) are left alone
+        :param kind: "books" or "authors"
+        :param items: list of (url, name), name is the author name or None
+        :param depth: number of links from start_url
+        :return: number of new pages
+        """
+        operations = []
+        seen = set()
+        now = time.time()
+        for url, name in items:
+            id_ = canonical_id(url)
+            if id_ in seen:
+                continue
+            seen.add(id_)
+            page = {"kind": kind, "id": id_, "url": canonical_url(url), "name": name,
+                    "shard": shard_of(id_, self.num_shards), "depth": depth,
+                    "state": QUEUED, "owner": None, "lease_until": 0.0, "attempts": 0,
+                    "reserved": False, "discovered_at": now}
+            operations.append(UpdateOne({"_id": "%s:%s" % (kind, id_)},
+                                        {"$setOnInsert": page}, upsert=True))
+        if not operations:
+            return 0
+        result = self.queue.bulk_write(operations, ordered=False)
+        METRICS.incr("queue_added", result.upserted_count, kind=kind)
+        return result.upserted_count
+
+    def claim(self, kinds=("books", "authors")):
+        """
+        Leases the next page of this worker's shards: pages whose lease expired
+        first, then pages given back by release, then new pages
+        Expired pages that had max_attempts leases are marked failed
+        :param kinds: kinds of pages to lease, in order of preference
+        :return: queue document of the page, None if there is none (for now)
+        """
+        for kind in kinds:
+            lease = {"$set": {"state": LEASED, "owner": self.owner,
+                              "lease_until": time.time() + self.lease_seconds},
+                     "$inc": {"attempts": 1}}
+            base = {"kind": kind, "shard": {"$in": self.shards}}
+            self.fail_expired(base)
+            # expired leases, then released pages, their budget is reserved already
+            page = self.queue.find_one_and_update(
+                dict(base, state=LEASED, lease_until={"$lt": time.time()}), lease,
+                sort=[("lease_until", ASCENDING)], return_document=ReturnDocument.AFTER)
+            if page is not None:
+                METRICS.incr("queue_reclaimed", kind=kind)
+                return self.track(page)
+            page = self.queue.find_one_and_update(
+                dict(base, state=QUEUED, reserved=True), lease,
+                sort=[("depth", ASCENDING), ("discovered_at", ASCENDING)],
+                return_document=ReturnDocument.AFTER)
+            if page is not None:
+                return self.track(page)
+            budget = self.counters.find_one_and_update(
+                {"_id": kind, "$expr": {"$lt": ["$used", "$budget"]}}, {"$inc": {"used": 1}})
+            if budget is None:
+                continue  # budget spent
+            lease["$set"]["reserved"] = True
+            page = self.queue.find_one_and_update(
+                dict(base, state=QUEUED, reserved=False), lease,
+                sort=[("depth", ASCENDING), ("discovered_at", ASCENDING)],
+                return_document=ReturnDocument.AFTER)
+            if page is not None:
+                return self.track(page)
+            self.counters.update_one({"_id": kind}, {"$inc": {"used": -1}})
+        return None
+
+    def fail_expired(self, base):
+        """
+        Marks the expired pages that had max_attempts leases as failed (e.g. pages
+        that crash the workers), their budget is given back
+        :param base: query of the kind and shards
+        """
+        while True:
+            page = self.queue.find_one_and_update(
+                dict(base, state=LEASED, lease_until={"$lt": time.time()},
+                     attempts={"$gte": self.max_attempts}),
+                {"$set": {"state": FAILED, "owner": None, "lease_until": 0.0}})
+            if page is None:
+                return
+            METRICS.incr("queue_failed", kind=page["kind"])
+            self.counters.update_one({"_id": page["kind"]}, {"$inc": {"used": -1}})
+
+    def track(self, page):
+        with self.lock:
+            self.leased.add(page["_id"])
+        return page
+
+    def untrack(self, pages):
+        with self.lock:
+            self.leased.difference_update(page["_id"] for page in pages)
+
+    def complete(self, pages):
+        """
+        Marks pages as done
+        :param pages: list of queue documents leased by this worker
+        """
+        if pages:
+            self.untrack(pages)
+            self.queue.update_many({"_id": {"$in": [page["_id"] for page in pages]}},
+                                   {"$set": {"state": DONE, "owner": None}})
+
+    def release(self, page):
+        """
+        Gives a page that couldn't be scraped back, it is queued again (keeping
+        its budget) until it has had max_attempts leases
+        :param page: queue document leased by this worker
+        """
+        self.untrack([page])
+        if page["attempts"] >= self.max_attempts:
+            self.queue.update_one({"_id": page["_id"]},
+                                  {"$set": {"state": FAILED, "owner": None}})
+            self.counters.update_one({"_id": page["kind"]}, {"$inc": {"used": -1}})
+        else:
+            self.queue.update_one({"_id": page["_id"], "owner": self.owner},
+                                  {"$set": {"state": QUEUED, "owner": None, "lease_until": 0.0,
+                                            "reserved": True}})
+
+    def heartbeat(self):
+        """
+        Renews the leases of the pages this worker is processing
+        """
+        with self.lock:
+            ids = list(self.leased)
+        if ids:
+            self.queue.update_many({"_id": {"$in": ids}, "owner": self.owner, "state": LEASED},
+                                   {"$set": {"lease_until": time.time() + self.lease_seconds}})
+
+    def start_heartbeat(self):
+        """
+        Renews the leases of this worker every third of the visibility timeout
+        """
+        def run():
+            while not self.stopped.wait(self.lease_seconds / 3):
+                self.heartbeat()
+
+        self.stopped.clear()
+        self.heartbeat_thread = threading.Thread(target=run, name="queue-heartbeat", daemon=True)
+        self.heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        self.stopped.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
+
+    def unfinished(self):
+        """
+        :return: number of pages that can still be scraped by this worker or lead to
+            pages it can scrape: pages queued in its shards (of kinds with budget
+            left, or released with their budget) and pages leased in any shard
+            (they may link to its shards)
+        """
+        kinds = [counter["_id"] for counter in self.counters.find({"_id": {"$in": list(KEYS)}})
+                 if counter["used"] < counter["budget"]]
+        return (self.queue.count_documents({"state": QUEUED, "shard": {"$in": self.shards},
+                                            "$or": [{"kind": {"$in": kinds}},
+                                                    {"reserved": True}]})
+                + self.queue.count_documents({"state": LEASED}))
+
+    def status(self):
+        """
+        :return: dict of kind -> dict of state -> number of pages
+        """
+        counts = {kind: {QUEUED: 0, LEASED: 0, DONE: 0, FAILED: 0} for kind in KEYS}
+        for row in self.queue.aggregate([{"$group": {"_id": {"kind": "$kind", "state": "$state"},
+                                                     "count": {"$sum": 1}}}]):
+            counts[row["_id"]["kind"]][row["_id"]["state"]] = row["count"]
+        return counts
+
+
+def merge_page(page, extracted, similar):
+    """
+    Turns an extracted page into its record and the pages it links to
+    Uses the merge functions of the scrapers on fresh settings registries, so
+    records are the same as in a single process crawl
+    :param page: queue document
+    :param extracted: extracted page (see extract.extract_page)
+    :param similar: extracted "Similar authors" page of an author, None if there is none
+    :return: (record, dict of kind -> list of (url, name) of the linked pages)
+    """
+    settings.init()
+    if page["kind"] == "books":
+        record = merge_book(page["url"], extracted)
+    else:
+        settings.authors.add(page["url"], name=page["name"])
+        record = merge_author_page(0, extracted)
+        if extracted["fields"].get("similar_authors_url"):
+            record["related_authors"] = merge_related_authors(similar, record["author_url"])
+    discovered = {}
+    for kind, registry in (("books", settings.books), ("authors", settings.authors)):
+        discovered[kind] = [(linked[registry.url_key], linked.get("name"))
+                            for linked in registry if linked is not record]
+    return record, discovered
+
+
+def run_worker(db, queue, workers=1, rate=None, parse_pool=None, batch_size=50,
+               poll_interval=1.0):
+    """
+    Scrapes pages leased from the queue until none is left (see LeaseQueue.unfinished)
+    Records are upserted in batches, their pages are marked done afterwards,
+    so a worker that dies loses leases but never records
+    Resets settings (the registries are per page, see merge_page)
+    :param db: database (library)
+    :param queue: LeaseQueue
+    :param workers: number of pages downloaded at the same time
+    :param rate: max requests per second per host (None for no limit)
+    :param parse_pool: ParsePool to extract pages in, None to extract in the fetch threads
+    :param batch_size: number of records upserted at a time
+    :param poll_interval: seconds to wait for new pages when the queue is empty
+    :return: dict of kind -> number of records scraped by this worker
+    """
+    leased = {}  # url -> queue document, read by the fetch threads
+    scraped = []  # (queue document, record) not written yet
+    counts = {kind: 0 for kind in KEYS}
+
+    def next_url(index):
+        page = queue.claim()
+        if page is None:
+            return None
+        leased[page["url"]] = page
+        return page["url"]
+
+    def fetch(url):
+        page = leased[url]
+        if page["kind"] == "books":
+            return fetch_and_extract_book(url, parse_pool), None
+        extracted = fetch_and_extract_author(url, page["name"], parse_pool)
+        if extracted is None or not extracted["fields"].get("similar_authors_url"):
+            return extracted, None
+        return extracted, fetch_and_extract_similar_authors(
+            extracted["fields"].get("similar_authors_url"), parse_pool)
+
+    def process(index, url, result):
+        page = leased.pop(url)
+        extracted, similar = result
+        METRICS.incr("pages_fetched" if extracted is not None else "fetch_errors",
+                     kind=page["kind"])
+        if extracted is None:
+            queue.release(page)
+            return
+        record, discovered = merge_page(page, extracted, similar)
+        for kind, items in discovered.items():
+            queue.add(kind, items, page["depth"] + 1)
+        scraped.append((page, dict(record)))
+        if len(scraped) >= batch_size:
+            flush()
+
+    def flush():
+        for kind in KEYS:
+            records = [record for page, record in scraped if page["kind"] == kind]
+            if records:
+                sync_documents(records, db[kind])
+                counts[kind] += len(records)
+        queue.complete([page for page, _ in scraped])
+        del scraped[:]
+
+    queue.start_heartbeat()
+    try:
+        while True:
+            crawl(next_url, None, fetch, process, workers, rate)
+            flush()
+            if not queue.unfinished():
+                break
+            time.sleep(poll_interval)  # other workers may still link new pages
+    finally:
+        queue.stop_heartbeat()
+    return counts
+
+
+def get_args():
+    """
+    Gets command line inputs from user
+    """
+    parser = argparse.ArgumentParser(description="distributed crawl over a queue in the db")
+    commands = parser.add_subparsers(dest="command", required=True)
+    seed = commands.add_parser("seed", help="start a new crawl, forgets the previous queue")
+    seed.add_argument("num_books", type=int, help="number of books to scrape in total")
+    seed.add_argument("num_authors", type=int, help="number of authors to scrape in total")
+    seed.add_argument("start_url", help="url to start scraping from")
+    seed.add_argument("--num_shards", type=int, default=16,
+                      help="number of shards the pages are split into (default: 16)")
+    work = commands.add_parser("work", help="scrape pages until the crawl is finished")
+    work.add_argument("--shards", type=int, nargs="+", default=None,
+                      help="shards of this worker (default: all)")
+    work.add_argument("--workers", type=int, default=1,
+                      help="number of pages downloaded concurrently (default: 1)")
+    work.add_argument("--rate", type=float, default=None,
+                      help="max requests per second per host (default: no limit)")
+    work.add_argument("--lease_seconds", type=float, default=60,
+                      help="visibility timeout of a lease (default: 60)")
+    commands.add_parser("status", help="number of pages per kind and state")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    args = get_args()
+    library, client = connect_to_db()
+    try:
+        if args.command == "seed":
+            reset_queue(library, args.num_books, args.num_authors, args.start_url,
+                        args.num_shards)
+        elif args.command == "work":
+            print(run_worker(library, LeaseQueue(library, shards=args.shards,
+                                                 lease_seconds=args.lease_seconds),
+                             args.workers, args.rate))
+        print(LeaseQueue(library).status())
+    finally:
+        client.close()
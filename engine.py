@@ -0,0 +1,398 @@
+"""
+This module defines the Scraper engine, one crawl with its own registries,
+fetcher, error logs and db writer
+Nothing is set up when the module is imported, the fetch stack, the db client
+and the optional modules (cache, graph, metrics server, parse processes) are
+created when a crawl first needs them. Several Scrapers can run in one process,
+one after the other or in threads of their own
+"""
+import contextlib
+import os
+
+import settings
+from db import BatchWriter, NdjsonWriter, data_to_json, reset_writer, update_db_from_json, \
+    use_writer
+from eventlog import EventLog, reset_logs, use_logs
+from fetcher import Fetcher, reset_fetcher, use_fetcher
+from profiles import get_profile, reset_profile, use_profile
+
+curr_dir = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(curr_dir, "data")
+LOG_DIR = os.path.join(curr_dir, "logs")
+LOGS = ("scrape_books", "scrape_authors")  # logs of the scraper modules, see eventlog.ScopedLog
+
+
+class Scraper:
+    """
+    Scrapes books and authors into registries of its own
+    While a crawl runs, settings.books/settings.authors, the fetcher, the
+    real time db writer and the error logs of the scraper modules are the
+    Scraper's in the running thread (and its fetch threads), see active
+    The parser engine and the metrics are shared by the whole process
+    """
+
+    def __init__(self, compact=False, workers=1, rate=None, adaptive=False, max_rate=20.0,
+                 retries=2, connections=10, timeout=30, cache=False, replay=False,
+                 cache_max_mb=1024, cache_max_age_days=30, parser="auto", parse_processes=0,
+                 parse_chunk_size=4, profile="full", seen=False, seen_capacity=1_000_000,
+                 data_dir=DATA_DIR, log_dir=LOG_DIR, fetcher=None, writer=None):
+        """
+        :param compact: whether to keep records as store.CompactRecord instead of dicts
+        :param workers: number of pages downloaded at the same time
+        :param rate: max requests per second per host (None for no limit), the
+            starting rate with adaptive
+        :param adaptive: whether to adapt the rate of every host to its responses
+        :param max_rate: max requests per second per host with adaptive
+        :param retries: retries of a request failing with a connection error, 429 or 5xx
+        :param connections: max number of open http connections
+        :param timeout: http timeout in seconds
+        :param cache: whether to cache pages under data_dir/cache and revalidate them
+        :param replay: whether to scrape from the page cache only, without network access
+        :param cache_max_mb: max size of the page cache in MB
+        :param cache_max_age_days: max age of a cached page in days
+        :param parser: html parser engine ("auto", "lxml" or "bs4")
+        :param parse_processes: number of processes extracting pages, 0 to extract
+            in the fetch threads
+        :param parse_chunk_size: number of pages sent to a parse process at a time
+        :param profile: Profile or name of the profile of the crawl, which fields are
+            extracted and whether "Similar authors" pages are fetched (see profiles.py)
+        :param seen: whether pages discovered but not crawled yet are kept out of memory,
+            in Bloom filters (data_dir/seen_*.bloom, see seen.py) and the frontier,
+            instead of as registry records (phases policy only)
+        :param seen_capacity: number of urls of the first stage of the Bloom filters
+        :param data_dir: directory of the output files, frontier, cache and graphs
+        :param log_dir: directory of the error logs
+        :param fetcher: fetcher to use instead of building one from the options above
+        :param writer: BatchWriter for the real time updates, None to create one
+            when needed
+        """
+        self.books, self.authors = settings.make_registries(compact)
+        self.workers = workers
+        self.rate = rate
+        self.adaptive = adaptive
+        self.max_rate = max_rate
+        self.retries = retries
+        self.connections = connections
+        self.timeout = timeout
+        self.use_cache = cache or replay
+        self.replay = replay
+        self.cache_max_mb = cache_max_mb
+        self.cache_max_age_days = cache_max_age_days
+        self.parser = parser
+        self.parse_processes = parse_processes
+        self.parse_chunk_size = parse_chunk_size
+        self.profile = get_profile(profile) if isinstance(profile, str) else profile
+        self.use_seen = seen
+        self.seen_capacity = seen_capacity
+        self.frontier = None  # with seen, the frontier of the last crawl, read by save
+        self.data_dir = data_dir
+        self.logs = {name: EventLog(os.path.join(log_dir, name + "_log.log")) for name in LOGS}
+        self.cache = None
+        self._fetcher = fetcher
+        self.own_fetcher = fetcher is None
+        self._writer = writer
+        self.own_writer = writer is None
+
+    @property
+    def registries(self):
+        """
+        :return: dict of kind ("books" or "authors") -> Registry
+        """
+        return {"books": self.books, "authors": self.authors}
+
+    @property
+    def fetcher(self):
+        """
+        Fetch stack of this Scraper, built on first use:
+        Fetcher, RetryingFetcher (throttle.py), CachedFetcher with cache or replay
+        """
+        if self._fetcher is None:
+            from throttle import RetryingFetcher, Throttle
+
+            fetcher = Fetcher(max_connections=self.connections, timeout=self.timeout)
+            # with adaptive the throttle paces the requests instead of the crawlers
+            if self.adaptive:
+                throttle = Throttle(self.rate or 1.0, self.max_rate, adaptive=True)
+            else:
+                throttle = Throttle()
+            fetcher = RetryingFetcher(fetcher, throttle, self.retries)
+            if self.use_cache:
+                from cache import CachedFetcher, PageCache
+
+                self.cache = PageCache(os.path.join(self.data_dir, "cache"),
+                                       max_bytes=self.cache_max_mb * 1024 * 1024,
+                                       max_age=self.cache_max_age_days * 24 * 60 * 60)
+                fetcher = CachedFetcher(fetcher, self.cache, self.replay)
+            self._fetcher = fetcher
+        return self._fetcher
+
+    @property
+    def writer(self):
+        """
+        BatchWriter of the real time updates, connects on first use
+        """
+        if self._writer is None or self._writer.closed:
+            self._writer = BatchWriter()
+        return self._writer
+
+    @property
+    def crawl_rate(self):
+        """
+        :return: rate limit of the crawlers (None with adaptive, the throttle paces)
+        """
+        return None if self.adaptive else self.rate
+
+    @contextlib.contextmanager
+    def active(self, real_time=False):
+        """
+        Makes the scraper modules use this Scraper's registries, fetcher, logs,
+        profile and (with real_time) db writer in the current context
+        :param real_time: whether records are written to the db while scraping
+        """
+        tokens = [settings.use_registries(self.books, self.authors),
+                  use_fetcher(self.fetcher), use_logs(self.logs), use_profile(self.profile)]
+        writer_token = use_writer(self.writer) if real_time else None
+        try:
+            yield self
+        finally:
+            if writer_token is not None:
+                reset_writer(writer_token)
+            reset_profile(tokens[3])
+            reset_logs(tokens[2])
+            reset_fetcher(tokens[1])
+            settings.reset_registries(tokens[0])
+
+    def crawl(self, num_books, num_authors, start_url, policy="phases", real_time=False,
+              ndjson=False, resume=False, max_pages=None, max_seconds=None, max_depth=None,
+              graph_dir=None, metrics_interval=0, metrics_port=0, checkpoint_interval=5.0):
+        """
+        Scrapes books and authors into the registries
+        The crawl is recorded in data_dir/frontier.db, resume picks up where it stopped
+        :param num_books: max number of books to scrape
+        :param num_authors: max number of authors to scrape
+        :param start_url: url to start scraping from
+        :param policy: "phases" scrapes all the books then all the authors, the
+            scheduler.POLICIES interleave them
+        :param real_time: whether to update the db after every scrape
+        :param ndjson: whether to stream records to data_dir/*.ndjson while scraping
+        :param resume: whether to resume the crawl recorded in the frontier
+        :param max_pages: max number of book and author pages (not with phases)
+        :param max_seconds: seconds after which no new page is started (not with phases)
+        :param max_depth: max number of links from start_url (not with phases)
+        :param graph_dir: directory of the graphs read by the pagerank policy,
+            None for data_dir/graph
+        :param metrics_interval: seconds between two metrics snapshots appended to
+            data_dir/metrics.ndjson, 0 for none
+        :param metrics_port: port of the Prometheus metrics endpoint, 0 for none
+        :param checkpoint_interval: max seconds between two checkpoints of the frontier,
+            the pages finished since the last one are fetched again on resume
+        """
+        from extract import set_default_engine
+        from frontier import Frontier
+        from scheduler import scrape_all
+        from scrape_authors import scrape_n_authors
+        from scrape_books import scrape_n_books
+
+        set_default_engine(self.parser)
+        if self.use_seen and policy != "phases":
+            raise ValueError("seen needs the phases policy, the others rank every "
+                             "discovered page in memory")
+        self.close_seen()
+        frontier = Frontier(self.registries, os.path.join(self.data_dir, "frontier.db"),
+                            checkpoint_interval=checkpoint_interval, queue=self.use_seen)
+        if resume:
+            frontier.load()
+        else:
+            frontier.reset()
+        if self.use_seen:
+            self.open_seen(frontier, resume)
+
+        # with ndjson, every record is written as soon as it is scraped
+        books_out = authors_out = None
+        if ndjson:
+            books_out = NdjsonWriter(self.output_path("books", ndjson))
+            authors_out = NdjsonWriter(self.output_path("authors", ndjson))
+            if resume:
+                # records finished by the previous run go first
+                books_out.write_remaining(book for book in self.books
+                                          if frontier.is_done("books", book["book_url"]))
+                authors_out.write_remaining(author for author in self.authors
+                                            if frontier.is_done("authors", author["author_url"]))
+        # stage timings and counters, see metrics.py
+        snapshots = metrics_server = None
+        if metrics_interval or metrics_port:
+            from metrics import SnapshotWriter, serve_metrics
+
+            if metrics_interval:
+                snapshots = SnapshotWriter(os.path.join(self.data_dir, "metrics.ndjson"),
+                                           metrics_interval)
+            if metrics_port:
+                metrics_server = serve_metrics(metrics_port)
+        parse_pool = None
+        if self.parse_processes:
+            from pipeline import ParsePool
+
+            parse_pool = ParsePool(self.parse_processes, self.parse_chunk_size)
+        try:
+            with self.active(real_time):
+                if policy == "phases":
+                    # all the books, then all the authors
+                    scrape_n_books(num_books, start_url, real_time, self.workers,
+                                   self.crawl_rate, books_out and books_out.write, frontier,
+                                   parse_pool)
+                    scrape_n_authors(num_authors, real_time, self.workers, self.crawl_rate,
+                                     authors_out and authors_out.write, frontier, parse_pool)
+                else:
+                    # books and authors in one priority queue
+                    scores = None
+                    if policy == "pagerank":
+                        from graph import load_scores
+
+                        scores = load_scores(self.graph_dir(graph_dir))
+                    scrape_all(num_books, num_authors, start_url, real_time, self.workers,
+                               self.crawl_rate, books_out and books_out.write,
+                               authors_out and authors_out.write, frontier, parse_pool,
+                               policy, max_pages, max_seconds, max_depth, scores)
+        finally:
+            if parse_pool is not None:
+                parse_pool.close()
+            if self.own_writer and self._writer is not None:
+                self._writer.close()  # flush the real time updates, even after a crash
+            if self.use_seen:
+                frontier.checkpoint()  # stays open, save writes the queued pages
+                self.report_seen()
+            else:
+                frontier.close()
+            if ndjson:
+                # discovered but not scraped records, like in the json output
+                books_out.write_remaining(self.books)
+                books_out.write_all(self.books.queued_records())
+                authors_out.write_remaining(self.authors)
+                authors_out.write_all(self.authors.queued_records())
+                books_out.close()
+                authors_out.close()
+            if snapshots is not None:
+                snapshots.stop()
+            if metrics_server is not None:
+                metrics_server.shutdown()
+        if self.cache is not None:
+            self.cache.evict()
+
+    def open_seen(self, frontier, resume=False):
+        """
+        Opens the Bloom filters of the registries in front of the frontier queue,
+        a new crawl empties them, a resumed one rebuilds a missing one
+        :param frontier: Frontier with queue of the crawl
+        :param resume: whether the crawl resumes, the filters then keep their urls
+        """
+        from seen import Discovered, SeenSet
+
+        self.frontier = frontier
+        for kind, registry in self.registries.items():
+            path = os.path.join(self.data_dir, "seen_%s.bloom" % kind)
+            missing = not os.path.exists(path)
+            registry.discovered = Discovered(kind, SeenSet(path, self.seen_capacity), frontier)
+            if not resume:
+                registry.discovered.seen.clear()
+            elif missing:
+                registry.discovered.rebuild()
+
+    def seen_stats(self):
+        """
+        :return: dict of kind -> SeenSet.stats with the number of queued pages,
+            empty without seen
+        """
+        return {kind: dict(registry.discovered.seen.stats(), queued=len(registry.discovered))
+                for kind, registry in self.registries.items()
+                if registry.discovered is not None}
+
+    def report_seen(self):
+        """
+        Flushes the Bloom filters and reports their stats as metrics gauges
+        :return: dict of kind -> stats (see seen_stats)
+        """
+        from metrics import METRICS
+
+        for registry in self.registries.values():
+            registry.discovered.seen.flush()
+        stats = self.seen_stats()
+        for kind, values in stats.items():
+            for name in ("keys", "queued", "expected_error_rate", "false_positive_rate"):
+                METRICS.set_gauge("seen_" + name, values[name], kind=kind)
+        return stats
+
+    def close_seen(self):
+        """
+        Closes the Bloom filters and the frontier of the last crawl with seen
+        """
+        for registry in self.registries.values():
+            if registry.discovered is not None:
+                registry.discovered.seen.close()
+                registry.discovered = None
+        if self.frontier is not None:
+            self.frontier.close()
+            self.frontier = None
+
+    def save(self, real_time=False, ndjson=False, sync=False, save_graph=False,
+             graph_dir=None):
+        """
+        Writes the results of crawl
+        :param real_time: whether the db was updated while scraping
+        :param ndjson: whether the records were streamed to data_dir/*.ndjson
+        :param sync: whether to upsert by book_id/author_id instead of inserting
+        :param save_graph: whether to save the similarity graphs and their PageRank
+        :param graph_dir: directory of the graphs, None for data_dir/graph
+        """
+        if save_graph:
+            # similar books / related authors graphs with their PageRank, see graph.py
+            from graph import build_graphs, save_graphs
+
+            save_graphs(build_graphs(self.books.output_records(),
+                                     self.authors.output_records()),
+                        self.graph_dir(graph_dir))
+        # store data in json, then update the db from the files
+        if not real_time:
+            if not ndjson:
+                data_to_json(self.output_path("books", ndjson), self.books.output_records())
+                data_to_json(self.output_path("authors", ndjson),
+                             self.authors.output_records())
+            update_db_from_json(self.output_path("books", ndjson), "books", sync)
+            update_db_from_json(self.output_path("authors", ndjson), "authors", sync)
+
+    def run(self, num_books, num_authors, start_url, real_time=False, ndjson=False,
+            sync=False, save_graph=False, graph_dir=None, **options):
+        """
+        Crawls and saves the results, see crawl and save
+        :param options: other options of crawl (policy, resume, max_pages, ...)
+        """
+        self.crawl(num_books, num_authors, start_url, real_time=real_time, ndjson=ndjson,
+                   graph_dir=graph_dir, **options)
+        self.save(real_time, ndjson, sync, save_graph, graph_dir)
+
+    def output_path(self, kind, ndjson=False):
+        """
+        :return: path of the output file of kind ("books" or "authors")
+        """
+        return os.path.join(self.data_dir, kind + (".ndjson" if ndjson else ".json"))
+
+    def graph_dir(self, graph_dir=None):
+        return graph_dir or os.path.join(self.data_dir, "graph")
+
+    def close(self):
+        """
+        Closes the fetcher and writer the Scraper created and flushes its logs
+        """
+        if self.own_fetcher and self._fetcher is not None:
+            self._fetcher.close()
+            self._fetcher = None
+        if self.own_writer and self._writer is not None:
+            self._writer.close()
+        self.close_seen()
+        for log in self.logs.values():
+            log.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
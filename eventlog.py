@@ -0,0 +1,131 @@
+"""
+This module defines the structured, buffered error log of the scrapers
+Every entry is one json object per line, entries are kept in memory and
+written in blocks, the file is only opened on the first write
+"""
+import atexit
+import contextvars
+import json
+import os
+import threading
+import time
+
+from metrics import METRICS
+
+_scoped_logs = contextvars.ContextVar("logs", default=None)  # name -> EventLog of a Scraper
+
+
+class EventLog:
+    """
+    Buffered json lines log
+    Errors are also counted in the metrics (scrape_errors by event and field)
+    """
+
+    def __init__(self, path, buffer_size=1000, metrics=METRICS):
+        """
+        :param path: path of the log file, truncated on the first write
+        :param buffer_size: number of entries kept in memory before writing
+        :param metrics: Metrics the errors are counted in
+        """
+        self.path = path
+        self.buffer_size = buffer_size
+        self.metrics = metrics
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.file_lock = threading.Lock()
+        self.file = None
+        self.mode = "w+"  # the previous run's log is replaced, later opens append
+        atexit.register(self.flush)
+
+    def error(self, message, url=None, event="error", **fields):
+        """
+        Logs one error
+        :param message: human readable message, e.g. "Error getting book title"
+        :param url: url of the page
+        :param event: kind of error, e.g. "fetch" or "extract"
+        :param fields: extra fields of the entry, e.g. field="title"
+        """
+        entry = {"time": time.time(), "level": "error", "event": event,
+                 "message": message, "url": url}
+        entry.update(fields)
+        self.metrics.incr("scrape_errors", event=event, field=fields.get("field", ""))
+        with self.lock:
+            self.buffer.append(entry)
+            full = len(self.buffer) >= self.buffer_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered entries
+        """
+        with self.lock:
+            entries, self.buffer = self.buffer, []
+        if not entries:
+            return
+        lines = "".join(json.dumps(entry) + "\n" for entry in entries)
+        with self.file_lock:
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.file = open(self.path, self.mode)
+                self.mode = "a"
+            self.file.write(lines)
+            self.file.flush()
+
+    def close(self):
+        self.flush()
+        with self.file_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        atexit.unregister(self.flush)
+
+
+class ScopedLog:
+    """
+    Log of a scraper module, writes to the EventLog the running Scraper has
+    under this name (see use_logs), or else to a default EventLog
+    """
+
+    def __init__(self, name, path):
+        """
+        :param name: name of the log, e.g. "scrape_books"
+        :param path: path of the default EventLog
+        """
+        self.name = name
+        self.default = EventLog(path)
+
+    def current(self):
+        """
+        :return: EventLog the entries go to in the current context
+        """
+        logs = _scoped_logs.get()
+        if logs is not None and self.name in logs:
+            return logs[self.name]
+        return self.default
+
+    def error(self, message, url=None, event="error", **fields):
+        """
+        Logs one error, see EventLog.error
+        """
+        self.current().error(message, url, event, **fields)
+
+    def flush(self):
+        self.current().flush()
+
+
+def use_logs(logs):
+    """
+    Uses other EventLogs in the current context only (thread, or contextvars.Context)
+    :param logs: dict of name -> EventLog
+    :return: token for reset_logs
+    """
+    return _scoped_logs.set(logs)
+
+
+def reset_logs(token):
+    """
+    Undoes use_logs
+    :param token: token returned by use_logs
+    """
+    _scoped_logs.reset(token)
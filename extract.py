@@ -0,0 +1,574 @@
+"""
+This module defines the parser engines that extract all the fields of a page at once
+The lxml engine collects every element it needs in a single pass over the tree,
+the bs4 engine (used when lxml isn't installed) only builds the parts of the tree
+the extractors look at (SoupStrainer)
+Run as a script to check that the engines agree with the original extractors
+over the pages in the page cache
+"""
+import importlib.util
+import re
+import time
+
+from registry import canonical_url
+
+# lxml is optional (fast path), imported on the first page parsed with it
+HAS_LXML = importlib.util.find_spec("lxml") is not None
+_lxml_parser = None
+
+# field -> (value on failure, name used in error logs)
+BOOK_FIELDS = {
+    "title": ("", "book title"),
+    "isbn": ("", "book isbn"),
+    "author": ("", "author"),
+    "author_url": ("", "author url"),
+    "rating": ("", "book rating"),
+    "rating_count": ("", "book rating count"),
+    "review_count": ("", "book review count"),
+    "image_url": ("", "book image url"),
+    "similar_books": ([], "similar books"),
+}
+AUTHOR_FIELDS = {
+    "rating": ("", "author rating"),
+    "rating_count": ("", "author rating count"),
+    "review_count": ("", "author review count"),
+    "image_url": ("", "author image url"),
+    "similar_authors_url": ("", "related author"),
+    "author_books": ([], "author books"),
+}
+SIMILAR_AUTHORS_FIELDS = {
+    "related_authors": ([], "related author"),
+}
+
+# field -> tags its extractor reads (with everything inside them)
+BOOK_TAGS = {
+    "title": ("h1",),
+    "isbn": ("meta",),
+    "author": ("span",),
+    "author_url": ("a",),
+    "rating": ("span",),
+    "rating_count": ("meta",),
+    "review_count": ("meta",),
+    "image_url": ("img",),
+    "similar_books": ("div",),
+}
+AUTHOR_TAGS = {
+    "rating": ("span",),
+    "rating_count": ("span",),
+    "review_count": ("span",),
+    "image_url": ("img",),
+    "similar_authors_url": ("a",),
+    "author_books": ("tr",),
+}
+
+RELATED_WORKS = re.compile("^relatedWorks")
+BOOK_SCHEMA = "http://schema.org/Book"
+
+
+def extract_book(html, engine=None, fields=None, timings=None):
+    """
+    Extracts the fields of a book page
+    :param html: html of the book page
+    :param engine: engine name ("lxml" or "bs4"), None for the default
+    :param fields: fields to extract, None for all of BOOK_FIELDS
+    :param timings: dict filled with the seconds spent parsing ("parse") and per field
+    :return: (dict of field -> value, list of names of the fields that failed)
+    """
+    start = time.perf_counter()
+    page = get_engine(engine).book_page(html, fields)
+    if timings is not None:
+        timings["parse"] = time.perf_counter() - start
+    return extract_fields(page, BOOK_FIELDS, fields, timings)
+
+
+def extract_author(html, name, engine=None, fields=None, timings=None):
+    """
+    Extracts the fields of an author page
+    similar_authors_url is the url of the "Similar authors" page
+    :param html: html of the author page
+    :param name: name of the author (used to find the author image)
+    :param engine: engine name ("lxml" or "bs4"), None for the default
+    :param fields: fields to extract, None for all of AUTHOR_FIELDS
+    :param timings: dict filled with the seconds spent parsing ("parse") and per field
+    :return: (dict of field -> value, list of names of the fields that failed)
+    """
+    start = time.perf_counter()
+    page = get_engine(engine).author_page(html, name, fields)
+    if timings is not None:
+        timings["parse"] = time.perf_counter() - start
+    return extract_fields(page, AUTHOR_FIELDS, fields, timings)
+
+
+def extract_similar_authors(html, engine=None, timings=None):
+    """
+    Extracts the authors listed on a "Similar authors" page
+    related_authors is a list of (name, author_url), the name is a list of
+    text nodes like in the records of the original scraper
+    :param html: html of the similar authors page
+    :param engine: engine name ("lxml" or "bs4"), None for the default
+    :param timings: dict filled with the seconds spent parsing ("parse") and per field
+    :return: (dict of field -> value, list of names of the fields that failed)
+    """
+    start = time.perf_counter()
+    page = get_engine(engine).similar_authors_page(html)
+    if timings is not None:
+        timings["parse"] = time.perf_counter() - start
+    return extract_fields(page, SIMILAR_AUTHORS_FIELDS, None, timings)
+
+
+def extract_page(kind, html, name=None, engine=None, fields=None):
+    """
+    Extracts a book or author page into plain data
+    Pure function of its arguments, safe to run in a worker process
+    :param kind: "book", "author" or "similar_authors"
+    :param html: html of the page
+    :param name: name of the author (author pages only)
+    :param engine: engine name ("lxml" or "bs4"), None for the default
+    :param fields: fields to extract (book and author pages), None for all,
+        see profiles.Profile.fields
+    :return: dict with the extracted fields, the names of the fields that failed,
+        the book urls discovered on the page and the timings (see extract_book)
+    """
+    timings = {}
+    if kind == "book":
+        fields, errors = extract_book(html, engine, fields, timings)
+        discovered = fields.get("similar_books", [])
+    elif kind == "author":
+        fields, errors = extract_author(html, name, engine, fields, timings)
+        discovered = fields.get("author_books", [])
+    else:
+        fields, errors = extract_similar_authors(html, engine, timings=timings)
+        discovered = []
+    return {"fields": fields, "errors": errors, "discovered": list(discovered),
+            "timings": timings}
+
+
+def extract_fields(page, spec, fields, timings=None):
+    """
+    Calls the extractor of every requested field, failed fields get their default
+    :param page: parsed page with one method per field
+    :param spec: dict of field -> (default, error name)
+    :param fields: fields to extract, None for all of spec
+    :param timings: dict filled with the seconds spent on every field
+    :return: (dict of field -> value, list of names of the fields that failed)
+    """
+    values = {}
+    errors = []
+    for field in spec if fields is None else fields:
+        start = time.perf_counter()
+        try:
+            values[field] = getattr(page, field)()
+        except Exception:
+            default = spec[field][0]
+            values[field] = list(default) if isinstance(default, list) else default
+            errors.append(field)
+        if timings is not None:
+            timings[field] = time.perf_counter() - start
+    return values, errors
+
+
+def plan_tags(tags, fields):
+    """
+    Gets the tags the parser engines collect for a set of fields
+    :param tags: dict of field -> tags, BOOK_TAGS or AUTHOR_TAGS
+    :param fields: fields to extract, None for all
+    :return: list of tag names, in the order of tags
+    """
+    names = []
+    for field, field_tags in tags.items():
+        if fields is None or field in fields:
+            names.extend(tag for tag in field_tags if tag not in names)
+    return names
+
+
+def has_class(element, class_name):
+    """
+    :param element: lxml element
+    :param class_name: css class
+    :return: True if class_name is one of the classes of element
+    """
+    return class_name in element.get("class", "").split()
+
+
+def first(elements):
+    """
+    :param elements: list of elements
+    :return: first element, raises IndexError when there is none
+    """
+    return elements[0]
+
+
+class LxmlBookPage:
+    """
+    Book page parsed with lxml, the elements of interest are collected in one pass
+    over the tags of the fields to extract
+    """
+
+    def __init__(self, html, fields=None):
+        root = lxml_document(html)
+        self.titles, self.isbns, self.rating_counts, self.review_counts = [], [], [], []
+        self.ratings, self.names, self.covers, self.related, self.author_links = [], [], [], [], []
+        for element in root.iter(*plan_tags(BOOK_TAGS, fields)):
+            tag = element.tag
+            if tag == "meta":
+                if element.get("property") == "books:isbn":
+                    self.isbns.append(element)
+                itemprop = element.get("itemprop")
+                if itemprop == "ratingCount":
+                    self.rating_counts.append(element)
+                elif itemprop == "reviewCount":
+                    self.review_counts.append(element)
+            elif tag == "span":
+                itemprop = element.get("itemprop")
+                if itemprop == "ratingValue":
+                    self.ratings.append(element)
+                elif itemprop == "name":
+                    self.names.append(element)
+            elif tag == "a":
+                if has_class(element, "authorName"):
+                    self.author_links.append(element)
+            elif tag == "h1":
+                if element.get("id") == "bookTitle":
+                    self.titles.append(element)
+            elif tag == "img":
+                if element.get("id") == "coverImage":
+                    self.covers.append(element)
+            elif RELATED_WORKS.match(element.get("id", "")):
+                self.related.append(element)
+
+    def title(self):
+        return first(self.titles).text.strip()
+
+    def isbn(self):
+        return first(self.isbns).attrib["content"]
+
+    def rating(self):
+        return first(self.ratings).text.strip()
+
+    def rating_count(self):
+        return first(self.rating_counts).attrib["content"]
+
+    def review_count(self):
+        return first(self.review_counts).attrib["content"]
+
+    def image_url(self):
+        return first(self.covers).attrib["src"]
+
+    def similar_books(self):
+        urls = []
+        for item in first(self.related).iter("li"):
+            if has_class(item, "cover"):
+                image = next(item.iter("img"))
+                urls.append(image.getparent().attrib["href"])
+        return urls
+
+    def author(self):
+        return [lxml_string(element) for element in self.names]
+
+    def author_url(self):
+        return [element.attrib["href"] for element in self.author_links]
+
+
+class LxmlAuthorPage:
+    """
+    Author page parsed with lxml, the elements of interest are collected in one pass
+    over the tags of the fields to extract
+    """
+
+    def __init__(self, html, name, fields=None):
+        root = lxml_document(html)
+        names = name if isinstance(name, list) else [name]
+        self.averages, self.rating_counts, self.review_counts = [], [], []
+        self.images, self.similar_links, self.book_rows = [], [], []
+        for element in root.iter(*plan_tags(AUTHOR_TAGS, fields)):
+            tag = element.tag
+            if tag == "span":
+                itemprop = element.get("itemprop")
+                if itemprop == "ratingCount":
+                    self.rating_counts.append(element)
+                elif itemprop == "reviewCount":
+                    self.review_counts.append(element)
+                if has_class(element, "average"):
+                    self.averages.append(element)
+            elif tag == "img":
+                if element.get("alt") in names:
+                    self.images.append(element)
+            elif tag == "a":
+                if element.text_content() == "Similar authors":
+                    self.similar_links.append(element)
+            elif element.get("itemtype") == BOOK_SCHEMA:
+                self.book_rows.append(element)
+
+    def rating(self):
+        return lxml_string(first(self.averages))
+
+    def rating_count(self):
+        return first(self.rating_counts).attrib["content"]
+
+    def review_count(self):
+        return first(self.review_counts).attrib["content"]
+
+    def image_url(self):
+        return first(self.images).attrib["src"]
+
+    def similar_authors_url(self):
+        return canonical_url(first(self.similar_links).attrib["href"])
+
+    def author_books(self):
+        urls = []
+        for row in self.book_rows:
+            tag = next(span for span in row.iter("span") if span.get("itemprop") == "name")
+            urls.append(canonical_url(tag.getparent().attrib["href"]))
+        return urls
+
+
+class LxmlSimilarAuthorsPage:
+    """
+    "Similar authors" page parsed with lxml
+    """
+
+    def __init__(self, html):
+        root = lxml_document(html)
+        self.names = [element for element in root.iter("span")
+                      if element.get("itemprop") == "name"]
+
+    def related_authors(self):
+        # the first name on the page is the author the page is about
+        return [([element.text], element.getparent().attrib["href"])
+                for element in self.names[1:]]
+
+
+def lxml_document(html):
+    """
+    Parses a page with lxml
+    :param html: html of the page
+    :return: root element
+    """
+    global _lxml_parser
+    import lxml.html
+
+    if _lxml_parser is None:
+        _lxml_parser = lxml.html.HTMLParser(encoding="utf-8")
+    return lxml.html.document_fromstring(html.encode("utf-8"), parser=_lxml_parser)
+
+
+def lxml_string(element):
+    """
+    Gets the first child of an element as string, like bs4's tag.contents[0]
+    :param element: lxml element
+    :return: text before the first child tag
+    """
+    if element.text is None:
+        raise ValueError("element doesn't start with text")
+    return element.text
+
+
+class LxmlEngine:
+    name = "lxml"
+    book_page = LxmlBookPage
+    author_page = LxmlAuthorPage
+    similar_authors_page = LxmlSimilarAuthorsPage
+
+
+class SoupBookPage:
+    """
+    Book page parsed with BeautifulSoup, only the tags the extractors need are built
+    """
+
+    def __init__(self, html, fields=None):
+        self.soup = make_soup(html, plan_tags(BOOK_TAGS, fields))
+
+    def title(self):
+        return self.soup.find("h1", id="bookTitle").contents[0].strip()
+
+    def isbn(self):
+        return self.soup.find("meta", property="books:isbn")["content"]
+
+    def rating(self):
+        return self.soup.find("span", itemprop="ratingValue").contents[0].strip()
+
+    def rating_count(self):
+        return self.soup.find("meta", itemprop="ratingCount")["content"]
+
+    def review_count(self):
+        return self.soup.find("meta", itemprop="reviewCount")["content"]
+
+    def image_url(self):
+        return self.soup.find("img", id="coverImage")["src"]
+
+    def similar_books(self):
+        related_work_tag = self.soup.find("div", id=RELATED_WORKS)
+        return [tag.find("img").parent["href"]
+                for tag in related_work_tag.find_all("li", class_="cover")]
+
+    def author(self):
+        return [str(tag.contents[0]) for tag in self.soup.find_all("span", itemprop="name")]
+
+    def author_url(self):
+        return [tag["href"] for tag in self.soup.find_all("a", class_="authorName")]
+
+
+class SoupAuthorPage:
+    """
+    Author page parsed with BeautifulSoup, only the tags the extractors need are built
+    """
+
+    def __init__(self, html, name, fields=None):
+        self.soup = make_soup(html, plan_tags(AUTHOR_TAGS, fields))
+        self.name = name
+
+    def rating(self):
+        return str(self.soup.find("span", class_="average").contents[0])
+
+    def rating_count(self):
+        return self.soup.find("span", itemprop="ratingCount")["content"]
+
+    def review_count(self):
+        return self.soup.find("span", itemprop="reviewCount")["content"]
+
+    def image_url(self):
+        return self.soup.find("img", alt=self.name)["src"]
+
+    def similar_authors_url(self):
+        return canonical_url(self.soup.find("a", string="Similar authors")["href"])
+
+    def author_books(self):
+        urls = []
+        for parent in self.soup.find_all("tr", itemtype=BOOK_SCHEMA):
+            tag = parent.find("span", itemprop="name")
+            urls.append(canonical_url(tag.parent["href"]))
+        return urls
+
+
+class SoupSimilarAuthorsPage:
+    """
+    "Similar authors" page parsed with BeautifulSoup
+    """
+
+    def __init__(self, html):
+        self.soup = make_soup(html, ["a", "span"])
+
+    def related_authors(self):
+        tags = self.soup.find_all("span", itemprop="name")
+        # the first name on the page is the author the page is about
+        return [([str(node) for node in tag.contents], tag.parent["href"])
+                for tag in tags[1:]]
+
+
+def make_soup(html, tags):
+    """
+    Parses only the given tags (and everything inside them)
+    :param html: html of the page
+    :param tags: names of the tags to keep
+    :return: soup object
+    """
+    from bs4 import BeautifulSoup, SoupStrainer
+    features = "lxml" if HAS_LXML else "html.parser"
+    return BeautifulSoup(html, features, parse_only=SoupStrainer(tags))
+
+
+class SoupEngine:
+    name = "bs4"
+    book_page = SoupBookPage
+    author_page = SoupAuthorPage
+    similar_authors_page = SoupSimilarAuthorsPage
+
+
+ENGINES = {"lxml": LxmlEngine, "bs4": SoupEngine}
+_default_engine = "lxml" if HAS_LXML else "bs4"
+
+
+def get_engine(name=None):
+    """
+    :param name: engine name ("lxml" or "bs4"), None for the default
+    :return: engine class
+    """
+    if name is None or name == "auto":
+        name = _default_engine
+    if name == "lxml" and not HAS_LXML:
+        raise ValueError("lxml engine requested but lxml is not installed")
+    return ENGINES[name]
+
+
+def set_default_engine(name):
+    """
+    Selects the engine used when none is given
+    :param name: engine name ("lxml", "bs4" or "auto")
+    """
+    global _default_engine
+    _default_engine = get_engine(name).name
+
+
+def check_parity(pages, names=None, engines=None):
+    """
+    Compares extract_page on every engine with the original extractors of
+    scrape_books/scrape_authors
+    :param pages: iterable of (url, html) of book and author pages
+    :param names: dict of canonical author url -> author name (for author images)
+    :param engines: engine names to check, None for all available engines
+    :return: list of (url, engine, field, expected, actual) mismatches
+    """
+    from bs4 import BeautifulSoup
+    import scrape_authors
+    import scrape_books
+    import settings
+
+    if engines is None:
+        engines = [name for name in ENGINES if name != "lxml" or HAS_LXML]
+    mismatches = []
+    for url, html in pages:
+        settings.init()  # the original extractors register discovered urls
+        soup = BeautifulSoup(html, "html.parser")
+        if "/author/show/" in url:
+            name = (names or {}).get(canonical_url(url), "")
+            expected = {
+                "rating": scrape_authors.get_author_rating(soup, url),
+                "rating_count": scrape_authors.get_author_rating_count(soup, url),
+                "review_count": scrape_authors.get_author_review_count(soup, url),
+                "image_url": scrape_authors.get_author_image_url(soup, name, url),
+                "author_books": scrape_authors.get_author_books(soup, url),
+            }
+        else:
+            name = None
+            expected = {field: getattr(scrape_books, function)(soup, url) for field, function in (
+                ("title", "get_title"), ("isbn", "get_isbn"), ("author", "get_author"),
+                ("author_url", "get_author_url"), ("rating", "get_book_rating"),
+                ("rating_count", "get_book_rating_count"),
+                ("review_count", "get_book_review_count"),
+                ("image_url", "get_book_image_url"), ("similar_books", "get_similar_books"))}
+            expected["author"] = [str(value) for value in expected["author"]]
+        kind = "book" if name is None else "author"
+        for engine in engines:
+            actual = extract_page(kind, html, name, engine)["fields"]
+            for field, value in expected.items():
+                if actual[field] != value:
+                    mismatches.append((url, engine, field, value, actual[field]))
+    return mismatches
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    import os
+    from cache import CACHE_DIR, PageCache
+
+    parser = argparse.ArgumentParser(description="check the parser engines against "
+                                                 "the original extractors over cached pages")
+    parser.add_argument("--limit", type=int, default=100, help="max number of pages to check")
+    args = parser.parse_args()
+
+    authors_path = os.path.join(os.path.dirname(CACHE_DIR), "authors.json")
+    with open(authors_path) as file:
+        author_names = {canonical_url(author["author_url"]): author["name"]
+                        for author in json.load(file) if "author_url" in author}
+
+    page_cache = PageCache(CACHE_DIR)
+    urls = [row[0] for row in page_cache.conn.execute(
+        "SELECT url FROM pages WHERE url LIKE '%/book/show/%' OR url LIKE '%/author/show/%' "
+        "LIMIT ?", (args.limit,))]
+    cached = ((url, page_cache.get(url)) for url in urls)
+    results = check_parity(((url, entry.html) for url, entry in cached if entry is not None),
+                           author_names)
+    for mismatch in results:
+        print("MISMATCH %s [%s] %s: expected %r, got %r" % mismatch)
+    print("%d pages checked, %d mismatches" % (len(urls), len(results)))
@@ -0,0 +1,324 @@
+"""
+This module defines the shared http fetch layer used by all the scrapers
+Connections are pooled and kept alive per host, responses are requested
+compressed and decoded transparently
+"""
+import contextvars
+import gzip
+import http.client
+import queue
+import threading
+import zlib
+from urllib.parse import urljoin, urlparse
+
+from metrics import METRICS
+
+try:
+    import brotli  # optional, enables br decoding
+except ImportError:
+    brotli = None
+
+USER_AGENT = "Mozilla/5.0 (compatible; GoodReads-Web-Scraper)"
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+
+class FetchError(Exception):
+    """
+    Raised when a page can't be fetched (bad status code or too many redirects)
+    """
+
+    def __init__(self, url, status, message=""):
+        super().__init__("%s %s %s" % (status, url, message))
+        self.url = url
+        self.status = status
+
+
+class Response:
+    """
+    A fully read http response with the body already decoded
+    """
+
+    def __init__(self, url, status, headers, body):
+        """
+        :param url: final url of the response (after redirects)
+        :param status: http status code
+        :param headers: dict of response headers (lower case names)
+        :param body: decoded body as bytes
+        """
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def text(self, encoding="utf-8"):
+        """
+        :param encoding: encoding of the body
+        :return: body decoded as string
+        """
+        return self.body.decode(encoding)
+
+
+class Fetcher:
+    """
+    Thread safe http client with a bounded pool of keep-alive connections
+    Keeps counters of requests, bytes transferred and connection reuse
+    """
+
+    def __init__(self, max_connections=10, timeout=30, headers=None, hosts=None):
+        """
+        :param max_connections: max number of open connections across all hosts
+        :param timeout: socket timeout in seconds
+        :param headers: extra headers sent with every request
+        :param hosts: dict of host -> origin to send its requests to instead,
+            e.g. {"www.goodreads.com": "http://127.0.0.1:8000"} for a local fixture server
+        """
+        self.timeout = timeout
+        self.hosts = {host: urlparse(origin) for host, origin in (hosts or {}).items()}
+        self.headers = {
+            "User-Agent": USER_AGENT,
+            "Accept-Encoding": accept_encoding(),
+            "Connection": "keep-alive",
+        }
+        self.headers.update(headers or {})
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.idle = {}  # (scheme, host, port) -> queue of idle connections
+        self.lock = threading.Lock()
+        self.counters = {
+            "requests": 0,
+            "connections_opened": 0,
+            "connections_reused": 0,
+            "bytes_received": 0,  # bytes on the wire (compressed)
+            "bytes_decoded": 0,  # bytes after decompression
+        }
+
+    def get(self, url, headers=None):
+        """
+        Sends a GET request, follows redirects
+        :param url: url to request
+        :param headers: extra headers for this request
+        :return: Response
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self.request(url, headers)
+            location = response.headers.get("location")
+            if response.status not in REDIRECT_CODES or not location:
+                return response
+            url = urljoin(url, location)
+        raise FetchError(url, response.status, "too many redirects")
+
+    def fetch(self, url, headers=None):
+        """
+        Gets the html of a page
+        :param url: url of page
+        :param headers: extra headers for this request
+        :return: html as string
+        """
+        with METRICS.timer("fetch"):
+            response = self.get(url, headers)
+        if response.status != 200:
+            raise FetchError(url, response.status)
+        return response.text()
+
+    def request(self, url, headers=None):
+        """
+        Sends one GET request on a pooled connection, does not follow redirects
+        A stale keep-alive connection is retried once on a fresh connection
+        :param url: url to request
+        :param headers: extra headers for this request
+        :return: Response
+        """
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        origin = self.hosts.get(parsed.hostname)
+        if origin is not None:
+            key = (origin.scheme, origin.hostname, origin.port)
+        path = parsed.path or "/"
+        if parsed.query:
+            path += "?" + parsed.query
+        request_headers = dict(self.headers)
+        request_headers.update(headers or {})
+
+        with self.slots:
+            conn, reused = self.checkout(key)
+            try:
+                conn.request("GET", path, headers=request_headers)
+                raw = conn.getresponse()
+            except (http.client.HTTPException, ConnectionError):
+                conn.close()
+                if not reused:
+                    raise
+                conn, reused = self.connect(key), False
+                conn.request("GET", path, headers=request_headers)
+                raw = conn.getresponse()
+            try:
+                body = raw.read()
+            except Exception:
+                conn.close()
+                raise
+            if raw.will_close:
+                conn.close()
+            else:
+                self.checkin(key, conn)
+
+        response_headers = {name.lower(): value for name, value in raw.getheaders()}
+        with METRICS.timer("decode"):
+            decoded = decode_body(body, response_headers.get("content-encoding", ""))
+        METRICS.incr("bytes_received", len(body))
+        METRICS.incr("http_responses", status=raw.status)
+        with self.lock:
+            self.counters["requests"] += 1
+            self.counters["connections_reused"] += int(reused)
+            self.counters["bytes_received"] += len(body)
+            self.counters["bytes_decoded"] += len(decoded)
+        return Response(url, raw.status, response_headers, decoded)
+
+    def checkout(self, key):
+        """
+        Takes an idle connection for the host, opens a new one if there is none
+        :param key: (scheme, host, port)
+        :return: (connection, whether it was reused)
+        """
+        with self.lock:
+            idle = self.idle.get(key)
+        if idle is not None:
+            try:
+                return idle.get_nowait(), True
+            except queue.Empty:
+                pass
+        return self.connect(key), False
+
+    def checkin(self, key, conn):
+        """
+        Returns a connection to the idle pool of its host
+        :param key: (scheme, host, port)
+        :param conn: connection to keep alive
+        """
+        with self.lock:
+            idle = self.idle.setdefault(key, queue.LifoQueue())
+        idle.put(conn)
+
+    def connect(self, key):
+        """
+        Opens a new connection
+        :param key: (scheme, host, port)
+        :return: http.client connection
+        """
+        scheme, host, port = key
+        with self.lock:
+            self.counters["connections_opened"] += 1
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def stats(self):
+        """
+        Gets a snapshot of the transfer counters
+        :return: dict of counters plus connection reuse and compression ratios
+        """
+        with self.lock:
+            stats = dict(self.counters)
+        requests = stats["requests"]
+        stats["reuse_rate"] = stats["connections_reused"] / requests if requests else 0.0
+        decoded = stats["bytes_decoded"]
+        stats["compression_ratio"] = stats["bytes_received"] / decoded if decoded else 0.0
+        return stats
+
+    def close(self):
+        """
+        Closes all idle connections
+        """
+        with self.lock:
+            pools = list(self.idle.values())
+            self.idle = {}
+        for idle in pools:
+            while not idle.empty():
+                idle.get_nowait().close()
+
+
+def accept_encoding():
+    """
+    Gets the Accept-Encoding header value for the decoders available
+    :return: header value as string
+    """
+    if brotli is not None:
+        return "gzip, deflate, br"
+    return "gzip, deflate"
+
+
+def decode_body(body, encoding):
+    """
+    Decompresses a response body
+    :param body: raw body as bytes
+    :param encoding: value of the Content-Encoding header
+    :return: decompressed body as bytes
+    """
+    encoding = encoding.strip().lower()
+    if encoding in ("gzip", "x-gzip"):
+        return gzip.decompress(body)
+    if encoding == "deflate":
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body, -zlib.MAX_WBITS)  # raw deflate stream
+    if encoding == "br" and brotli is not None:
+        return brotli.decompress(body)
+    return body
+
+
+_fetcher = None
+_fetcher_lock = threading.Lock()
+_scoped_fetcher = contextvars.ContextVar("fetcher", default=None)  # of the running Scraper
+
+
+def get_fetcher():
+    """
+    Gets the fetcher of the running Scraper (see use_fetcher), or else the one
+    shared by all the scrapers, created on first use
+    :return: Fetcher
+    """
+    global _fetcher
+    scoped = _scoped_fetcher.get()
+    if scoped is not None:
+        return scoped
+    with _fetcher_lock:
+        if _fetcher is None:
+            _fetcher = Fetcher()
+        return _fetcher
+
+
+def set_fetcher(fetcher):
+    """
+    Replaces the shared fetcher, e.g. to change the pool size or timeout
+    :param fetcher: Fetcher to use from now on
+    """
+    global _fetcher
+    with _fetcher_lock:
+        _fetcher = fetcher
+
+
+def use_fetcher(fetcher):
+    """
+    Uses a fetcher in the current context only (thread, or contextvars.Context),
+    crawler.crawl runs the fetches in the context of its caller
+    :param fetcher: Fetcher, None to use the shared one
+    :return: token for reset_fetcher
+    """
+    return _scoped_fetcher.set(fetcher)
+
+
+def reset_fetcher(token):
+    """
+    Undoes use_fetcher
+    :param token: token returned by use_fetcher
+    """
+    _scoped_fetcher.reset(token)
+
+
+def fetch_html(url):
+    """
+    Gets the html of a page with the shared fetcher
+    :param url: url of page
+    :return: html as string
+    """
+    return get_fetcher().fetch(url)
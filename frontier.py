@@ -0,0 +1,306 @@
+"""
+This module defines the persistent crawl frontier
+Every book and author url is recorded in an sqlite database (WAL mode) with its
+state (discovered, in_flight, done, failed) and its record, so a crawl that dies
+can be resumed without fetching the finished pages again
+Writes are buffered and applied in one transaction per checkpoint: at the first
+finished page, then every checkpoint_every changes or checkpoint_interval seconds,
+so a crash loses at most the pages finished since the last checkpoint
+With queue, the frontier is also the on-disk queue of the pages discovered but
+not crawled yet, which then have no registry records (see seen.Discovered)
+"""
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from registry import canonical_id
+from store import to_dict
+
+curr_dir = os.path.dirname(os.path.abspath(__file__))
+FRONTIER_PATH = os.path.join(curr_dir, "data", "frontier.db")
+
+DISCOVERED = "discovered"
+IN_FLIGHT = "in_flight"
+DONE = "done"
+FAILED = "failed"
+POP_BATCH = 256  # queued pages read from the database at a time
+
+
+class Frontier:
+    """
+    Durable record of the crawl frontier of the books and authors registries
+    New registry records are picked up at every checkpoint, page states are
+    reported with mark_* and written at the next checkpoint
+    With queue, discovered pages are pushed by the registries instead, and the
+    registry records are the pages popped off the queue, in discovery order
+    """
+
+    def __init__(self, registries, path=FRONTIER_PATH, checkpoint_every=100,
+                 checkpoint_interval=5.0, queue=False):
+        """
+        :param registries: dict of kind ("books" or "authors") -> Registry
+        :param path: path of the sqlite database
+        :param checkpoint_every: max number of buffered state changes
+        :param checkpoint_interval: max seconds between two checkpoints
+        :param queue: whether discovered pages are queued in the database by push
+            instead of picked up from the registries
+        """
+        self.registries = registries
+        self.queue = queue
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_interval = checkpoint_interval
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS frontier ("
+            "kind TEXT NOT NULL, id TEXT NOT NULL, seq INTEGER NOT NULL, url TEXT NOT NULL, "
+            "state TEXT NOT NULL, record TEXT NOT NULL, updated_at REAL NOT NULL, "
+            "PRIMARY KEY (kind, id))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS frontier_seq ON frontier (kind, seq)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS frontier_names ("
+            "kind TEXT NOT NULL, name TEXT NOT NULL, PRIMARY KEY (kind, name))")
+        self.conn.commit()
+        self.synced = {kind: 0 for kind in registries}  # registry records already stored
+        self.next_seq = {kind: 0 for kind in registries}  # seq of the next pushed page
+        self.popped = {kind: -1 for kind in registries}  # seq of the last popped page
+        self.popping = {kind: collections.deque() for kind in registries}  # read ahead
+        self.done = {kind: set() for kind in registries}  # canonical ids of done pages
+        self.pending = []  # buffered (kind, url, state, record)
+        self.last_checkpoint = None  # monotonic time of the last checkpoint, None before the first
+
+    def reset(self):
+        """
+        Forgets the previous crawl
+        """
+        with self.lock:
+            self.conn.execute("DELETE FROM frontier")
+            self.conn.execute("DELETE FROM frontier_names")
+            self.conn.commit()
+            self.pending = []
+            self.synced = {kind: 0 for kind in self.registries}
+            self.next_seq = {kind: 0 for kind in self.registries}
+            self.popped = {kind: -1 for kind in self.registries}
+            self.popping = {kind: collections.deque() for kind in self.registries}
+            self.done = {kind: set() for kind in self.registries}
+
+    def load(self):
+        """
+        Restores the registries from the database, in discovery order
+        Done pages come back with their scraped records
+        With queue, only the pages up to the last one the crawl got to get
+        records, the ones after it stay queued
+        :return: dict of kind -> dict of state -> count (of the restored records)
+        """
+        counts = {}
+        with self.lock:
+            for kind, registry in self.registries.items():
+                counts[kind] = {DISCOVERED: 0, IN_FLIGHT: 0, DONE: 0, FAILED: 0}
+                last, reached = self.conn.execute(
+                    "SELECT MAX(seq), MAX(CASE WHEN state != ? THEN seq END) FROM frontier "
+                    "WHERE kind = ?", (DISCOVERED, kind)).fetchone()
+                if self.queue:
+                    self.next_seq[kind] = 0 if last is None else last + 1
+                    self.popped[kind] = -1 if reached is None else reached
+                    upto = self.popped[kind]
+                else:
+                    upto = -1 if last is None else last
+                rows = self.conn.execute(
+                    "SELECT id, state, record FROM frontier WHERE kind = ? AND seq <= ? "
+                    "ORDER BY seq", (kind, upto))
+                for id_, state, record in rows:
+                    registry.append(json.loads(record))
+                    counts[kind][state] += 1
+                    if state == DONE:
+                        self.done[kind].add(id_)
+                self.synced[kind] = len(registry)
+        return counts
+
+    def push(self, kind, record, name=None):
+        """
+        Queues a discovered page, with queue
+        The row is written now and committed at the next checkpoint, with the
+        pages that discovered it
+        :param kind: "books" or "authors"
+        :param record: record of the page (its url and the fields known so far)
+        :param name: name key of the page (see has_name), None for none
+        """
+        url = record[self.registries[kind].url_key]
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO frontier VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kind, canonical_id(url), self.next_seq[kind], url, DISCOVERED,
+                 json.dumps(to_dict(record)), time.time()))
+            self.next_seq[kind] += 1
+            if name is not None:
+                self.conn.execute("INSERT OR IGNORE INTO frontier_names VALUES (?, ?)",
+                                  (kind, name))
+
+    def pop(self, kind):
+        """
+        Takes the next queued page, with queue
+        :param kind: "books" or "authors"
+        :return: record of the page as a dict, None if the queue is empty
+        """
+        with self.lock:
+            popping = self.popping[kind]
+            if not popping:
+                popping.extend(self.conn.execute(
+                    "SELECT seq, record FROM frontier WHERE kind = ? AND seq > ? "
+                    "ORDER BY seq LIMIT ?", (kind, self.popped[kind], POP_BATCH)))
+            if not popping:
+                return None
+            seq, record = popping.popleft()
+            self.popped[kind] = seq
+        return json.loads(record)
+
+    def queued(self, kind):
+        """
+        Iterates over the pages still queued, with queue, without popping them
+        :param kind: "books" or "authors"
+        :return: iterator of records as dicts, in discovery order
+        """
+        after = self.popped[kind]
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT seq, record FROM frontier WHERE kind = ? AND seq > ? "
+                    "ORDER BY seq LIMIT ?", (kind, after, POP_BATCH)).fetchall()
+            if not rows:
+                return
+            for after, record in rows:
+                yield json.loads(record)
+
+    def count_queued(self, kind):
+        """
+        :param kind: "books" or "authors"
+        :return: number of pages still queued, with queue
+        """
+        with self.lock:
+            return self.next_seq[kind] - 1 - self.popped[kind]
+
+    def has(self, kind, url):
+        """
+        :param kind: "books" or "authors"
+        :param url: url of page
+        :return: True if the page is in the frontier (queued or with a record)
+        """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT 1 FROM frontier WHERE kind = ? AND id = ?",
+                (kind, canonical_id(url))).fetchone() is not None
+
+    def has_name(self, kind, name):
+        """
+        :param kind: "books" or "authors"
+        :param name: name key passed to push
+        :return: True if a page was pushed with that name
+        """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT 1 FROM frontier_names WHERE kind = ? AND name = ?",
+                (kind, name)).fetchone() is not None
+
+    def keys(self, kind):
+        """
+        Iterates over the canonical ids and name keys of the pages of kind, e.g.
+        to rebuild a seen set before a crawl (not while one runs, it reads
+        without the lock)
+        :param kind: "books" or "authors"
+        :return: iterator of (canonical id or None, name key or None)
+        """
+        for (id_,) in self.conn.execute("SELECT id FROM frontier WHERE kind = ?", (kind,)):
+            yield id_, None
+        for (name,) in self.conn.execute("SELECT name FROM frontier_names WHERE kind = ?",
+                                         (kind,)):
+            yield None, name
+
+    def is_done(self, kind, url):
+        """
+        :param kind: "books" or "authors"
+        :param url: url of page
+        :return: True if the page was scraped in this or a previous run
+        """
+        return canonical_id(url) in self.done[kind]
+
+    def mark_in_flight(self, kind, url):
+        """
+        Records that a page is being fetched
+        Thread safe, only buffers the change (records are serialized by the
+        thread that owns the registries, at checkpoints)
+        """
+        self.mark(kind, url, IN_FLIGHT, None)
+
+    def mark_done(self, kind, record):
+        """
+        Records that a page was scraped, with its record
+        :param kind: "books" or "authors"
+        :param record: scraped record
+        """
+        url = record[self.registries[kind].url_key]
+        self.done[kind].add(canonical_id(url))
+        self.mark(kind, url, DONE, json.dumps(to_dict(record)))
+        self.maybe_checkpoint()
+
+    def mark_failed(self, kind, url):
+        """
+        Records that a page couldn't be scraped, it is retried on resume
+        """
+        self.mark(kind, url, FAILED, None)
+        self.maybe_checkpoint()
+
+    def mark(self, kind, url, state, record):
+        with self.lock:
+            self.pending.append((kind, url, state, record))
+
+    def maybe_checkpoint(self):
+        """
+        Checkpoints when no checkpoint was written yet, enough changes are buffered
+        or enough time has passed
+        """
+        with self.lock:
+            due = (self.last_checkpoint is None
+                   or len(self.pending) >= self.checkpoint_every
+                   or time.monotonic() - self.last_checkpoint >= self.checkpoint_interval)
+        if due:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Stores the new registry records and the buffered state changes in one transaction
+        """
+        with self.lock:
+            now = time.time()
+            new_rows = []
+            # with queue, the pages were pushed when they were discovered
+            for kind, registry in ({} if self.queue else self.registries).items():
+                for seq in range(self.synced[kind], len(registry)):
+                    record = registry[seq]
+                    url = record.get(registry.url_key)
+                    if url:
+                        new_rows.append((kind, canonical_id(url), seq, url, DISCOVERED,
+                                         json.dumps(to_dict(record)), now))
+                self.synced[kind] = len(registry)
+            updates = [(state, record, now, kind, canonical_id(url))
+                       for kind, url, state, record in self.pending]
+            self.pending = []
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO frontier VALUES (?, ?, ?, ?, ?, ?, ?)", new_rows)
+                self.conn.executemany(
+                    "UPDATE frontier SET state = ?, record = COALESCE(?, record), "
+                    "updated_at = ? WHERE kind = ? AND id = ?", updates)
+            self.last_checkpoint = time.monotonic()
+
+    def close(self):
+        """
+        Writes the last checkpoint and closes the database
+        """
+        self.checkpoint()
+        with self.lock:
+            self.conn.close()
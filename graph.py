@@ -0,0 +1,274 @@
+"""
+This module defines the similarity graphs of the scraped records in CSR form
+Books are linked by similar_books and authors by related_authors, every graph
+is two NumPy arrays (indptr, indices) with k-hop neighbor, in-degree and
+PageRank queries, saved as .npy files that are loaded memory-mapped
+PageRank scores of a saved graph can order the next crawl (scheduler "pagerank")
+Run as a script to build the graphs of data/*.json and save them under data/graph
+"""
+import argparse
+import json
+import os
+
+from registry import canonical_id
+
+try:
+    import numpy as np  # optional, only needed by this module
+except ImportError:
+    np = None
+
+curr_dir = os.path.dirname(os.path.abspath(__file__))
+GRAPH_DIR = os.path.join(curr_dir, "data", "graph")
+
+# graph name -> (url key of the records, key of the links)
+GRAPHS = {
+    "books": ("book_url", "similar_books"),
+    "authors": ("author_url", "related_authors"),
+}
+
+
+class Graph:
+    """
+    Directed graph in compressed sparse row form
+    The links of node i are indices[indptr[i]:indptr[i + 1]], nodes are the
+    canonical ids of the records followed by the ids only seen in links
+    """
+
+    def __init__(self, ids, indptr, indices, ranks=None):
+        """
+        :param ids: list of canonical ids, one per node
+        :param indptr: int array of num_nodes + 1 offsets into indices
+        :param indices: int array of the link targets
+        :param ranks: PageRank of every node, None if not computed yet
+        """
+        self.ids = ids
+        self.nodes = {id_: node for node, id_ in enumerate(ids)}  # canonical id -> node
+        self.indptr = indptr
+        self.indices = indices
+        self.ranks = ranks
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def num_edges(self):
+        return len(self.indices)
+
+    def node(self, url):
+        """
+        :param url: url or canonical id of a record
+        :return: node of the record, None if it isn't in the graph
+        """
+        return self.nodes.get(canonical_id(url))
+
+    def neighbors(self, url, hops=1):
+        """
+        Gets the records reachable in at most hops links
+        :param url: url or canonical id of a record
+        :param hops: max number of links
+        :return: list of canonical ids, nearest first (then in node order),
+            without the record itself
+        """
+        start = self.node(url)
+        if start is None:
+            return []
+        seen = np.zeros(len(self), dtype=bool)
+        seen[start] = True
+        frontier = np.array([start])
+        found = []
+        for _ in range(hops):
+            targets = self.links(frontier)
+            frontier = np.unique(targets[~seen[targets]])
+            if not len(frontier):
+                break
+            seen[frontier] = True
+            found.extend(frontier.tolist())
+        return [self.ids[node] for node in found]
+
+    def links(self, nodes):
+        """
+        Gathers the links of several nodes without a python loop
+        :param nodes: int array of nodes
+        :return: int array of their link targets
+        """
+        starts = self.indptr[nodes]
+        lengths = self.indptr[nodes + 1] - starts
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return self.indices[offsets + np.arange(lengths.sum())]
+
+    def in_degree(self):
+        """
+        :return: int array of the number of links to every node
+        """
+        return np.bincount(self.indices, minlength=len(self))
+
+    def out_degree(self):
+        """
+        :return: int array of the number of links of every node
+        """
+        return np.diff(self.indptr)
+
+    def pagerank(self, damping=0.85, tol=1e-10, max_iter=100):
+        """
+        Computes the PageRank of every node by power iteration
+        Rank of nodes without links is spread evenly over all nodes
+        :param damping: probability of following a link
+        :param tol: stops when the ranks change by less than tol (L1)
+        :param max_iter: max number of iterations
+        :return: float array of ranks, summing to 1 (also kept in ranks)
+        """
+        n = len(self)
+        if not n:
+            self.ranks = np.zeros(0)
+            return self.ranks
+        out = self.out_degree()
+        sources = np.repeat(np.arange(n), out)
+        weights = 1.0 / out[sources]
+        dangling = out == 0
+        ranks = np.full(n, 1.0 / n)
+        for _ in range(max_iter):
+            spread = np.bincount(self.indices, weights=ranks[sources] * weights, minlength=n)
+            new = damping * (spread + ranks[dangling].sum() / n) + (1 - damping) / n
+            change = np.abs(new - ranks).sum()
+            ranks = new
+            if change < tol:
+                break
+        self.ranks = ranks
+        return ranks
+
+    def top(self, scores, k=10):
+        """
+        :param scores: float array with one score per node
+        :param k: number of nodes
+        :return: list of (canonical id, score) of the k best nodes
+        """
+        best = np.argsort(-scores, kind="stable")[:k]
+        return [(self.ids[node], float(scores[node])) for node in best]
+
+    def save(self, path):
+        """
+        Saves the graph as .npy files (and ids.json) in the directory path
+        :param path: directory, created if needed
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "indptr.npy"), self.indptr)
+        np.save(os.path.join(path, "indices.npy"), self.indices)
+        if self.ranks is not None:
+            np.save(os.path.join(path, "pagerank.npy"), self.ranks)
+        with open(os.path.join(path, "ids.json"), "w") as file:
+            json.dump(self.ids, file)
+
+
+def load_graph(path, mmap=True):
+    """
+    Loads a graph saved by Graph.save
+    :param path: directory of the graph
+    :param mmap: whether to memory-map the arrays instead of reading them
+    :return: Graph
+    """
+    require_numpy()
+    mode = "r" if mmap else None
+    with open(os.path.join(path, "ids.json")) as file:
+        ids = json.load(file)
+    ranks_path = os.path.join(path, "pagerank.npy")
+    ranks = np.load(ranks_path, mmap_mode=mode) if os.path.exists(ranks_path) else None
+    return Graph(ids, np.load(os.path.join(path, "indptr.npy"), mmap_mode=mode),
+                 np.load(os.path.join(path, "indices.npy"), mmap_mode=mode), ranks)
+
+
+def build_graph(records, url_key, links_key):
+    """
+    Builds the graph of one kind of records
+    Duplicate links are dropped, links to unknown urls add nodes without links
+    :param records: iterable of records (dicts or store.CompactRecord)
+    :param url_key: key of the url field, e.g. "book_url"
+    :param links_key: key of the list of linked urls, e.g. "similar_books"
+    :return: Graph
+    """
+    require_numpy()
+    ids = []
+    nodes = {}  # canonical id -> node
+    links = []  # node -> list of linked canonical ids
+    for record in records:
+        url = record.get(url_key)
+        if not url or canonical_id(url) in nodes:
+            continue
+        nodes[canonical_id(url)] = len(ids)
+        ids.append(canonical_id(url))
+        targets = record.get(links_key)
+        links.append([canonical_id(target) for target in targets]
+                     if isinstance(targets, list) else [])
+    indptr = [0]
+    indices = []
+    for targets in links:
+        seen = set()
+        for id_ in targets:
+            if id_ not in nodes:
+                nodes[id_] = len(ids)
+                ids.append(id_)
+            if nodes[id_] not in seen:
+                seen.add(nodes[id_])
+                indices.append(nodes[id_])
+        indptr.append(len(indices))
+    indptr.extend([len(indices)] * (len(ids) + 1 - len(indptr)))  # nodes only seen in links
+    return Graph(ids, np.array(indptr, dtype=np.int64), np.array(indices, dtype=np.int64))
+
+
+def build_graphs(books, authors):
+    """
+    Builds the books and authors graphs and their PageRank
+    :param books: iterable of book records
+    :param authors: iterable of author records
+    :return: dict of graph name ("books" or "authors") -> Graph
+    """
+    graphs = {}
+    for name, records in (("books", books), ("authors", authors)):
+        graphs[name] = build_graph(records, *GRAPHS[name])
+        graphs[name].pagerank()
+    return graphs
+
+
+def save_graphs(graphs, path=GRAPH_DIR):
+    """
+    :param graphs: dict of graph name -> Graph
+    :param path: directory, every graph is saved in a subdirectory
+    """
+    for name, graph in graphs.items():
+        graph.save(os.path.join(path, name))
+
+
+def load_scores(path=GRAPH_DIR):
+    """
+    Gets the PageRank of the saved graphs as crawl priorities
+    :param path: directory the graphs were saved to
+    :return: dict of (kind, canonical id) -> score, kind being "books" or "authors"
+    """
+    scores = {}
+    for name in GRAPHS:
+        if not os.path.exists(os.path.join(path, name, "ids.json")):
+            continue
+        graph = load_graph(os.path.join(path, name))
+        ranks = graph.ranks if graph.ranks is not None else graph.pagerank()
+        scores.update(((name, id_), float(rank)) for id_, rank in zip(graph.ids, ranks))
+    return scores
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError("graph.py needs numpy (pip install numpy)")
+
+
+if __name__ == "__main__":
+    from db import iter_json_records
+
+    parser = argparse.ArgumentParser(description="builds the graphs of data/*.json")
+    parser.add_argument("--output", default=GRAPH_DIR, help="directory the graphs are saved to")
+    parser.add_argument("--top", type=int, default=10, help="number of top ranked records shown")
+    args = parser.parse_args()
+    built = build_graphs(iter_json_records(os.path.join(curr_dir, "data", "books.json")),
+                         iter_json_records(os.path.join(curr_dir, "data", "authors.json")))
+    save_graphs(built, args.output)
+    for graph_name, built_graph in built.items():
+        print("%s: %d nodes, %d links" % (graph_name, len(built_graph), built_graph.num_edges))
+        for id_, rank in built_graph.top(built_graph.ranks, args.top):
+            print("  %-60s %.5f" % (id_, rank))
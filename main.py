@@ -1,15 +1,13 @@
 """
 Main function and helpers
+The crawl itself is run by engine.Scraper
 """
 import argparse
-import os
 
-from dotenv import load_dotenv
-import settings
-
-from db import update_db_from_json, data_to_json, connect_to_db
-from scrape_authors import scrape_n_authors
-from scrape_books import scrape_n_books
+from db import update_db_from_json, connect_to_db, ensure_indexes, export_from_collection
+from engine import Scraper
+from profiles import PROFILES
+from scheduler import POLICIES
 
 
 def main():
@@ -19,37 +17,56 @@ def main():
     Otherwise, update after all the scraping is done from json files
     """
     args = get_args()
-    scrape_n_books(args.num_books, args.start_url, args.real_time)
-    scrape_n_authors(args.num_authors, args.real_time)
-
-    # Update after scraping
-    # get path and store data in json
-    if not args.real_time:
-        curr_dir = os.path.dirname(os.path.abspath(__file__))
-        books_path = os.path.join(curr_dir, "data", "books.json")
-        authors_path = os.path.join(curr_dir, "data", "authors.json")
-        data_to_json(books_path, settings.books)
-        data_to_json(authors_path, settings.authors)
-
-        update_db_from_json("books.json", "books")
-        update_db_from_json("authors.json", "authors")
+    with Scraper(compact=args.compact, workers=args.workers, rate=args.rate,
+                 adaptive=args.adaptive, max_rate=args.max_rate, retries=args.retries,
+                 connections=args.connections, timeout=args.timeout, cache=args.cache,
+                 replay=args.replay, cache_max_mb=args.cache_max_mb,
+                 cache_max_age_days=args.cache_max_age_days, parser=args.parser,
+                 parse_processes=args.parse_processes,
+                 parse_chunk_size=args.parse_chunk_size, profile=args.profile, seen=args.seen,
+                 seen_capacity=args.seen_capacity) as scraper:
+        scraper.run(args.num_books, args.num_authors, args.start_url, args.real_time,
+                    args.ndjson, args.sync, args.save_graph, args.graph, policy=args.policy,
+                    resume=args.resume, max_pages=args.max_pages, max_seconds=args.max_seconds,
+                    max_depth=args.max_depth, metrics_interval=args.metrics_interval,
+                    metrics_port=args.metrics_port, checkpoint_interval=args.checkpoint_interval)
 
 
 def restore_collections():
     """
     Restores db collections authors and books from json files
+    Upserts by book_id/author_id, so restoring twice doesn't duplicate documents
+    :return: dict of collection name -> inserted/updated/unchanged counts
     """
     db, client = connect_to_db()
-    books = db.books # creates new books collection
-    authors = db.authors # creates new authors collection
-    update_db_from_json("books.json", "books")
-    update_db_from_json("authors.json", "authors")
+    ensure_indexes(db) # creates the collections and their unique indexes
+    client.close()
+    return {"books": update_db_from_json("books.json", "books", sync=True),
+            "authors": update_db_from_json("authors.json", "authors", sync=True)}
+
+
+def backup_collections(partitions=4):
+    """
+    Exports db collections authors and books into json files (read by restore_collections)
+    :param partitions: number of id ranges of a collection exported in parallel
+    :return: dict of collection name -> number of exported documents
+    """
+    db, client = connect_to_db()
+    ensure_indexes(db)
+    counts = {name: export_from_collection(name + ".json", db[name], partitions=partitions)
+              for name in ("books", "authors")}
+    client.close()
+    return counts
 
 
 def get_args():
     """
     Gets command line inputs from user
-    :return: num_books, num_authors, start_url, real_time_update
+    :return: num_books, num_authors, start_url, real_time_update, ndjson, resume, sync,
+        workers, rate, adaptive, max_rate, retries, connections, timeout, cache, replay,
+        cache_max_mb, cache_max_age_days, parser, parse_processes, parse_chunk_size,
+        metrics_interval, metrics_port, checkpoint_interval, policy, max_pages, max_seconds,
+        max_depth, compact, seen, seen_capacity, save_graph, graph
     """
     parser = argparse.ArgumentParser()
     parser.add_argument("num_books", type=int,
@@ -59,11 +76,96 @@ def get_args():
     parser.add_argument("start_url", help="url to start scraping from", type=str)
     parser.add_argument("--real_time", action="store_true",
                         help="whether to update database in real time (default: False)")
+    parser.add_argument("--ndjson", action="store_true",
+                        help="stream records to data/*.ndjson while scraping (default: False)")
+    parser.add_argument("--resume", action="store_true",
+                        help="resume the crawl recorded in data/frontier.db, the pages "
+                             "finished since its last checkpoint (at most 100 pages or "
+                             "--checkpoint_interval seconds) are fetched again (default: False)")
+    parser.add_argument("--checkpoint_interval", type=float, default=5.0,
+                        help="max seconds between two checkpoints of data/frontier.db "
+                             "(default: 5)")
+    parser.add_argument("--sync", action="store_true",
+                        help="upsert by book_id/author_id instead of inserting (default: False)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of pages downloaded concurrently (default: 1)")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="max requests per second per host, the starting rate with "
+                             "--adaptive (default: no limit, 1 with --adaptive)")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="adapt the rate of every host to its responses, --rate is the "
+                             "starting rate (default: False)")
+    parser.add_argument("--max_rate", type=float, default=20.0,
+                        help="max requests per second per host with --adaptive (default: 20)")
+    parser.add_argument("--retries", type=int, default=2,
+                        help="retries of a request failing with a connection error, 429 or "
+                             "5xx, with backoff (default: 2)")
+    parser.add_argument("--connections", type=int, default=10,
+                        help="max number of open http connections (default: 10)")
+    parser.add_argument("--timeout", type=float, default=30,
+                        help="http timeout in seconds (default: 30)")
+    parser.add_argument("--cache", action="store_true",
+                        help="cache pages under data/cache and revalidate them (default: False)")
+    parser.add_argument("--replay", action="store_true",
+                        help="scrape from data/cache only, without network access (default: False)")
+    parser.add_argument("--cache_max_mb", type=int, default=1024,
+                        help="max size of the page cache in MB (default: 1024)")
+    parser.add_argument("--cache_max_age_days", type=float, default=30,
+                        help="max age of a cached page in days (default: 30)")
+    parser.add_argument("--parse_processes", type=int, default=0,
+                        help="number of processes extracting pages, 0 to extract "
+                             "in the fetch threads (default: 0)")
+    parser.add_argument("--parse_chunk_size", type=int, default=4,
+                        help="number of pages sent to a parse process at a time (default: 4)")
+    parser.add_argument("--parser", choices=["auto", "lxml", "bs4"], default="auto",
+                        help="html parser engine, auto uses lxml when installed (default: auto)")
+    parser.add_argument("--metrics_interval", type=float, default=0,
+                        help="seconds between two metrics snapshots appended to "
+                             "data/metrics.ndjson, 0 for none (default: 0)")
+    parser.add_argument("--metrics_port", type=int, default=0,
+                        help="serve Prometheus metrics on localhost:<port>/metrics, "
+                             "0 for none (default: 0)")
+    parser.add_argument("--policy", choices=["phases"] + list(POLICIES), default="phases",
+                        help="crawl order: phases scrapes all the books then all the "
+                             "authors, the others interleave them: "
+                             + "; ".join("%s: %s" % item for item in POLICIES.items())
+                             + " (default: phases)")
+    parser.add_argument("--max_pages", type=int, default=None,
+                        help="max number of book and author pages, with --policy other "
+                             "than phases (default: no limit)")
+    parser.add_argument("--max_seconds", type=float, default=None,
+                        help="seconds after which no new page is started, with --policy "
+                             "other than phases (default: no limit)")
+    parser.add_argument("--max_depth", type=int, default=None,
+                        help="max number of links from start_url, with --policy other "
+                             "than phases (default: no limit)")
+    parser.add_argument("--compact", action="store_true",
+                        help="keep records in compact form (interned urls, parsed numbers) "
+                             "to use less memory on large crawls (default: False)")
+    parser.add_argument("--seen", action="store_true",
+                        help="keep the pages discovered but not scraped yet out of memory, "
+                             "in Bloom filters (data/seen_*.bloom) and data/frontier.db, "
+                             "with --policy phases (default: False)")
+    parser.add_argument("--seen_capacity", type=int, default=1_000_000,
+                        help="number of urls of the first stage of the Bloom filters, "
+                             "larger stages are added when it fills (default: 1000000)")
+    parser.add_argument("--profile", choices=list(PROFILES), default="full",
+                        help="fields extracted from the pages: "
+                             + "; ".join("%s: %s" % (name, profile.description)
+                                         for name, profile in PROFILES.items())
+                             + " (default: full)")
+    parser.add_argument("--save_graph", action="store_true",
+                        help="save the similarity graphs and their PageRank after the crawl, "
+                             "needs numpy (default: False)")
+    parser.add_argument("--graph", default=None,
+                        help="directory of the graphs written by --save_graph and read by "
+                             "--policy pagerank (default: data/graph)")
     args = parser.parse_args()
     return args
 
 
 if __name__ == "__main__":
+    from dotenv import load_dotenv
+
     load_dotenv()
-    settings.init()
     main()
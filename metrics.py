@@ -0,0 +1,201 @@
+"""
+This module defines the metrics of the scraper: counters, gauges and timers
+for every stage (fetch, decode, parse, each extractor, registry merge, db write)
+Metrics can be written as periodic json snapshots and served in the
+Prometheus text format on a local http endpoint
+"""
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    """
+    Thread safe store of counters, gauges and timers
+    Every metric has a name and optional labels, e.g. incr("extract_errors", field="title")
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> value
+        self.gauges = {}  # (name, labels) -> value
+        self.timers = {}  # (name, labels) -> [count, total seconds, max seconds]
+        self.started = time.time()
+
+    def incr(self, name, value=1, **labels):
+        """
+        Adds value to a counter
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        """
+        Sets a gauge to value
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, seconds, **labels):
+        """
+        Records one duration of a timer
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                self.timers[key] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Times the body of a with statement
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """
+        Gets all the metrics as a json serializable dict
+        :return: dict of time, uptime, counters, gauges and timers
+        """
+        with self.lock:
+            counters = {metric_key(*key): value for key, value in self.counters.items()}
+            gauges = {metric_key(*key): value for key, value in self.gauges.items()}
+            timers = {metric_key(*key): {"count": count, "total": total, "max": max_,
+                                         "mean": total / count}
+                      for key, (count, total, max_) in self.timers.items()}
+        return {"time": time.time(), "uptime": time.time() - self.started,
+                "counters": counters, "gauges": gauges, "timers": timers}
+
+    def prometheus(self, prefix="scraper"):
+        """
+        Gets all the metrics in the Prometheus text exposition format
+        :param prefix: prefix of every metric name
+        :return: text as string
+        """
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append("%s_%s_total%s %s" % (prefix, name, label_text(labels), value))
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append("%s_%s%s %s" % (prefix, name, label_text(labels), value))
+            for (name, labels), (count, total, max_) in sorted(self.timers.items()):
+                lines.append("%s_%s_seconds_count%s %d" % (prefix, name, label_text(labels), count))
+                lines.append("%s_%s_seconds_sum%s %f" % (prefix, name, label_text(labels), total))
+                lines.append("%s_%s_seconds_max%s %f" % (prefix, name, label_text(labels), max_))
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.timers.clear()
+            self.started = time.time()
+
+
+def metric_key(name, labels):
+    """
+    :return: name with its labels, e.g. extract_errors{field="title"}
+    """
+    return name + label_text(labels)
+
+
+def label_text(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, value) for key, value in labels)
+
+
+METRICS = Metrics()  # metrics of this process
+
+
+def record_page_timings(kind, timings, metrics=METRICS):
+    """
+    Records the timings returned by extract.extract_page
+    (pages may be extracted in another process, so timings travel with the page)
+    :param kind: "book" or "author"
+    :param timings: dict of "parse" or field name -> seconds
+    :param metrics: Metrics to record into
+    """
+    for name, seconds in timings.items():
+        if name == "parse":
+            metrics.observe("parse", seconds, kind=kind)
+        else:
+            metrics.observe("extract", seconds, kind=kind, field=name)
+
+
+class SnapshotWriter:
+    """
+    Appends a json snapshot of the metrics to a file every interval seconds
+    """
+
+    def __init__(self, path, interval=10.0, metrics=METRICS):
+        """
+        :param path: ndjson file the snapshots are appended to
+        :param interval: seconds between two snapshots
+        :param metrics: Metrics to snapshot
+        """
+        self.path = path
+        self.interval = interval
+        self.metrics = metrics
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="metrics-snapshots", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        with open(self.path, "a") as file:
+            file.write(json.dumps(self.metrics.snapshot()) + "\n")
+
+    def stop(self):
+        """
+        Stops the thread and writes a last snapshot
+        """
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+
+
+def serve_metrics(port, metrics=METRICS, host="127.0.0.1"):
+    """
+    Serves the metrics in the Prometheus text format at http://host:port/metrics
+    :param port: port to listen on (0 for any free port)
+    :param metrics: Metrics to serve
+    :param host: interface to listen on, local only by default
+    :return: the http server (call shutdown() to stop it)
+    """
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
@@ -0,0 +1,161 @@
+"""
+This module defines the process pool that extracts pages off the main process
+Fetch threads hand raw html to the pool and get plain dicts back, the registries
+in settings are only ever touched by the parent process
+Run as a script to measure how parsing scales with the number of processes
+"""
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from extract import extract_page, get_engine
+
+
+def extract_pages(tasks):
+    """
+    Extracts a chunk of pages (runs in a worker process)
+    :param tasks: list of (kind, html, name, engine, fields)
+    :return: list of extracted pages
+    """
+    return [extract_page(*task) for task in tasks]
+
+
+class ParsePool:
+    """
+    Pool of extractor processes
+    Pages are sent in chunks of chunk_size, a chunk that doesn't fill up
+    is sent after linger seconds
+    """
+
+    def __init__(self, processes=None, chunk_size=4, linger=0.02):
+        """
+        :param processes: number of worker processes, None for one per core
+        :param chunk_size: number of pages sent to a worker at a time
+        :param linger: max seconds a page waits for its chunk to fill up
+        """
+        self.executor = ProcessPoolExecutor(processes)
+        self.chunk_size = max(1, chunk_size)
+        self.linger = linger
+        self.engine = get_engine().name  # workers don't see set_default_engine
+        self.lock = threading.Lock()
+        self.batch = []  # (future, task) waiting to be sent
+        self.timer = None
+
+    def submit(self, kind, html, name=None, fields=None):
+        """
+        Queues one page for extraction
+        :param kind: "book", "author" or "similar_authors"
+        :param html: html of the page
+        :param name: name of the author (author pages only)
+        :param fields: fields to extract, None for all (see extract.extract_page)
+        :return: Future of the extracted page
+        """
+        future = Future()
+        items = None
+        with self.lock:
+            self.batch.append((future, (kind, html, name, self.engine, fields)))
+            if len(self.batch) >= self.chunk_size:
+                items, self.batch = self.batch, []
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+            elif self.timer is None:
+                self.timer = threading.Timer(self.linger, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if items:
+            self.dispatch(items)
+        return future
+
+    def extract(self, kind, html, name=None, fields=None):
+        """
+        Extracts one page in the pool, blocks until it is done
+        :return: extracted page (see extract.extract_page)
+        """
+        return self.submit(kind, html, name, fields).result()
+
+    def flush(self):
+        """
+        Sends the pages waiting for their chunk to fill up
+        """
+        with self.lock:
+            items, self.batch = self.batch, []
+            self.timer = None
+        if items:
+            self.dispatch(items)
+
+    def dispatch(self, items):
+        """
+        Sends one chunk to a worker process
+        :param items: list of (future, task)
+        """
+        chunk = self.executor.submit(extract_pages, [task for _, task in items])
+
+        def done(chunk):
+            try:
+                results = chunk.result()
+            except Exception as error:
+                for future, _ in items:
+                    future.set_exception(error)
+                return
+            for (future, _), result in zip(items, results):
+                future.set_result(result)
+
+        chunk.add_done_callback(done)
+
+    def close(self):
+        """
+        Extracts the pages still waiting and stops the workers
+        """
+        self.flush()
+        self.executor.shutdown()
+
+
+def measure_scaling(pages, max_processes, chunk_size=4):
+    """
+    Times the extraction of the same pages with 1 to max_processes processes
+    :param pages: list of (kind, html, name)
+    :param max_processes: largest number of processes to try
+    :param chunk_size: number of pages sent to a worker at a time
+    :return: list of (processes, pages per second, speedup over 1 process)
+    """
+    results = []
+    for processes in range(1, max_processes + 1):
+        pool = ParsePool(processes, chunk_size)
+        pool.extract(*pages[0])  # start the workers before timing
+        start = time.perf_counter()
+        futures = [pool.submit(*page) for page in pages]
+        for future in futures:
+            future.result()
+        elapsed = time.perf_counter() - start
+        pool.close()
+        rate = len(pages) / elapsed
+        results.append((processes, rate, rate / results[0][1] if results else 1.0))
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    from cache import CACHE_DIR, PageCache
+
+    parser = argparse.ArgumentParser(description="measure parsing throughput over "
+                                                 "the pages in the page cache")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(),
+                        help="max number of processes (default: number of cores)")
+    parser.add_argument("--chunk_size", type=int, default=4,
+                        help="number of pages sent to a worker at a time (default: 4)")
+    parser.add_argument("--limit", type=int, default=500, help="max number of pages")
+    args = parser.parse_args()
+
+    page_cache = PageCache(CACHE_DIR)
+    urls = [row[0] for row in page_cache.conn.execute(
+        "SELECT url FROM pages WHERE url LIKE '%/book/show/%' OR url LIKE '%/author/show/%' "
+        "LIMIT ?", (args.limit,))]
+    cached = [(url, page_cache.get(url)) for url in urls]
+    pages = [("author" if "/author/show/" in url else "book", entry.html, "")
+             for url, entry in cached if entry is not None]
+    if not pages:
+        raise SystemExit("no pages in " + CACHE_DIR + ", run main.py with --cache first")
+    for processes, rate, speedup in measure_scaling(pages, args.processes, args.chunk_size):
+        print("%2d processes: %8.1f pages/s  x%.2f" % (processes, rate, speedup))
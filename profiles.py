@@ -0,0 +1,109 @@
+"""
+This module defines the scrape profiles, which fields of book and author pages a
+crawl needs
+A profile gives the extraction plan of every page kind: only the extractors of
+its fields run, the parser engines only collect the tags those extractors read
+(see extract.plan_tags), and the "Similar authors" page of an author is only
+fetched when the profile extracts similar_authors_url
+Records keep the fields a profile doesn't extract (e.g. on a refresh)
+"""
+import contextvars
+
+from extract import AUTHOR_FIELDS, BOOK_FIELDS
+
+
+class Profile:
+    """
+    Fields extracted from book and author pages
+    """
+
+    def __init__(self, name, book_fields=None, author_fields=None, description=""):
+        """
+        :param name: name of the profile
+        :param book_fields: fields of book pages (see extract.BOOK_FIELDS), None for all
+        :param author_fields: fields of author pages (see extract.AUTHOR_FIELDS), None for all
+        :param description: description shown by the command line help
+        """
+        for fields, spec in ((book_fields, BOOK_FIELDS), (author_fields, AUTHOR_FIELDS)):
+            unknown = set(fields or ()) - set(spec)
+            if unknown:
+                raise ValueError("unknown fields %s" % sorted(unknown))
+        self.name = name
+        self.book_fields = None if book_fields is None else tuple(book_fields)
+        self.author_fields = None if author_fields is None else tuple(author_fields)
+        self.description = description
+
+    def fields(self, kind):
+        """
+        Extraction plan of a page kind
+        :param kind: "book", "author" or "similar_authors"
+        :return: tuple of the fields to extract, None for all
+        """
+        if kind == "book":
+            return self.book_fields
+        if kind == "author":
+            return self.author_fields
+        return None  # only fetched when needed, see related_authors
+
+    def extracts(self, kind, field):
+        """
+        :param kind: "book" or "author"
+        :param field: name of a field
+        :return: True if the profile extracts field from pages of kind
+        """
+        fields = self.fields(kind)
+        return fields is None or field in fields
+
+    @property
+    def related_authors(self):
+        """
+        Whether the "Similar authors" pages are fetched
+        """
+        return self.extracts("author", "similar_authors_url")
+
+
+PROFILES = {
+    "full": Profile("full", description="every field and every link (default)"),
+    "ratings-only": Profile(
+        "ratings-only", ("rating", "rating_count", "review_count"),
+        ("rating", "rating_count", "review_count"),
+        "ratings only, no link discovery nor \"Similar authors\" pages, for refreshes"),
+    "graph-only": Profile(
+        "graph-only", ("author", "author_url", "similar_books"),
+        ("similar_authors_url", "author_books"),
+        "the links of the similarity graphs (similar books, author books, related authors)"),
+}
+
+_profile = contextvars.ContextVar("profile", default=PROFILES["full"])
+
+
+def get_profile(name=None):
+    """
+    :param name: name of a profile, None for the one of the current context
+    :return: Profile
+    """
+    if name is None:
+        return _profile.get()
+    if name not in PROFILES:
+        raise ValueError("unknown profile %r, one of %s" % (name, ", ".join(PROFILES)))
+    return PROFILES[name]
+
+
+def use_profile(profile):
+    """
+    Makes the scrapers use a profile in the current context (thread, or
+    contextvars.Context), e.g. while a Scraper runs
+    :param profile: Profile or name of a profile
+    :return: token for reset_profile
+    """
+    if not isinstance(profile, Profile):
+        profile = get_profile(profile)
+    return _profile.set(profile)
+
+
+def reset_profile(token):
+    """
+    Undoes use_profile
+    :param token: token returned by use_profile
+    """
+    _profile.reset(token)
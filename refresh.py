@@ -0,0 +1,350 @@
+"""
+This module defines the incremental refresh of scraped books and authors
+Existing records are read from data/*.json or the db and recrawled in order of
+staleness and volatility (popular records and records that changed before are
+checked more often). The sha256 of every page is kept in data/refresh.db, a
+page whose html didn't change is neither parsed nor written, and only the
+records whose fields changed go to the upsert path
+Run as a script to refresh the records that are due
+"""
+import argparse
+import hashlib
+import math
+import os
+import sqlite3
+import time
+
+import settings
+from crawler import crawl
+from db import KEYS, connect_to_db, data_to_json, iter_json_records, sync_documents
+from extract import extract_page
+from metrics import METRICS
+from profiles import PROFILES, get_profile, reset_profile, use_profile
+from scheduler import rating_count
+from scrape_authors import fetch_author_page, merge_author_page
+from scrape_books import fetch_book_page, merge_book
+
+curr_dir = os.path.dirname(os.path.abspath(__file__))
+REFRESH_PATH = os.path.join(curr_dir, "data", "refresh.db")
+SOURCES = {kind: os.path.join(curr_dir, "data", kind + ".json") for kind in KEYS}
+DAY = 24 * 60 * 60
+
+
+class RefreshState:
+    """
+    Hash and check history of every refreshed page, in an sqlite database
+    All rows are read at start, updates are buffered and written at checkpoints
+    """
+
+    def __init__(self, path=REFRESH_PATH, checkpoint_every=100):
+        """
+        :param path: path of the sqlite database
+        :param checkpoint_every: max number of buffered updates
+        """
+        self.checkpoint_every = checkpoint_every
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "kind TEXT NOT NULL, id TEXT NOT NULL, hash TEXT NOT NULL, "
+            "checked_at REAL NOT NULL, changed_at REAL NOT NULL, "
+            "checks INTEGER NOT NULL, changes INTEGER NOT NULL, PRIMARY KEY (kind, id))")
+        self.conn.commit()
+        self.pages = {}  # (kind, id) -> [hash, checked_at, changed_at, checks, changes]
+        for kind, id_, *row in self.conn.execute("SELECT * FROM pages"):
+            self.pages[(kind, id_)] = row
+        self.pending = set()  # (kind, id) updated since the last checkpoint
+
+    def get(self, kind, id_):
+        """
+        :return: [hash, checked_at, changed_at, checks, changes], None if never checked
+        """
+        return self.pages.get((kind, id_))
+
+    def hash(self, kind, id_):
+        """
+        :return: sha256 of the page when it was last checked, None if never checked
+        """
+        page = self.pages.get((kind, id_))
+        return page[0] if page else None
+
+    def update(self, kind, id_, digest, changed, now=None):
+        """
+        Records one check of a page
+        :param kind: "books" or "authors"
+        :param id_: book_id/author_id
+        :param digest: sha256 of the page
+        :param changed: whether the record changed
+        :param now: time of the check, None for now
+        """
+        now = time.time() if now is None else now
+        page = self.pages.get((kind, id_)) or [digest, now, now, 0, 0]
+        page[0] = digest
+        page[1] = now
+        page[3] += 1
+        if changed:
+            page[2] = now
+            page[4] += 1
+        self.pages[(kind, id_)] = page
+        self.pending.add((kind, id_))
+        if len(self.pending) >= self.checkpoint_every:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Writes the buffered updates in one transaction
+        """
+        rows = [key + tuple(self.pages[key]) for key in self.pending]
+        self.pending = set()
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  rows)
+
+    def close(self):
+        self.checkpoint()
+        self.conn.close()
+
+
+def page_hash(html):
+    """
+    :param html: html as string
+    :return: sha256 of the html as hex string
+    """
+    return hashlib.sha256(html.encode("utf-8")).hexdigest()
+
+
+def refresh_interval(record, page, base_interval=7 * DAY, min_interval=DAY,
+                     max_interval=90 * DAY):
+    """
+    Seconds between two checks of a record
+    The base interval is divided by the popularity of the record,
+    1 + log10(1 + rating_count), and by how often its checks found a change,
+    2 * (changes + 1) / (checks + 2) (1 without history)
+    :param record: scraped record
+    :param page: check history of the record (see RefreshState.get), None if never checked
+    :param base_interval: interval of an unrated record without history
+    :param min_interval: min interval
+    :param max_interval: max interval
+    :return: interval in seconds
+    """
+    popularity = 1 + math.log10(1 + rating_count(record.get("rating_count")))
+    checks, changes = (page[3], page[4]) if page else (0, 0)
+    change_rate = 2 * (changes + 1) / (checks + 2)
+    return min(max_interval, max(min_interval, base_interval / (popularity * change_rate)))
+
+
+def plan_refresh(registries, state, now=None, force=False, **intervals):
+    """
+    Gets the records due for a check, most overdue first
+    A record is due when the time since its last check reaches its
+    refresh_interval, records that were never checked are always due (and go first)
+    :param registries: dict of kind -> Registry of the existing records
+    :param state: RefreshState
+    :param now: current time, None for now
+    :param force: whether every record is due (still most overdue first)
+    :param intervals: base_interval, min_interval and max_interval of refresh_interval
+    :return: list of (kind, index in the registry)
+    """
+    now = time.time() if now is None else now
+    due = []
+    for kind, registry in registries.items():
+        for index, record in enumerate(registry):
+            id_ = record.get(KEYS[kind])
+            if not id_:
+                continue  # only discovered, never scraped
+            page = state.get(kind, id_)
+            age = now - page[1] if page else float("inf")
+            overdue = age / refresh_interval(record, page, **intervals)
+            if force or overdue >= 1:
+                due.append((-overdue, -rating_count(record.get("rating_count")), kind, index))
+    due.sort()
+    return [(kind, index) for _, _, kind, index in due]
+
+
+def load_records(source="json", compact=False):
+    """
+    Loads the existing records into settings.books and settings.authors
+    :param source: "json" for data/*.json, "db" for the db
+    :param compact: whether to keep records as store.CompactRecord
+    :return: dict of kind -> Registry
+    """
+    settings.init(compact)
+    registries = {"books": settings.books, "authors": settings.authors}
+    if source == "db":
+        db, client = connect_to_db()
+        try:
+            for kind, registry in registries.items():
+                for record in db[kind].find({}, {"_id": 0}, batch_size=1000):
+                    registry.append(record)
+        finally:
+            client.close()
+    else:
+        for kind, registry in registries.items():
+            for record in iter_json_records(SOURCES[kind]):
+                registry.append(record)
+    return registries
+
+
+def refresh(registries, due, state, workers=1, rate=None, parse_pool=None, profile=None):
+    """
+    Recrawls the due records
+    Pages are fetched by a pool of workers and hashed there, unchanged pages
+    are not parsed, changed ones are merged like in a crawl. related_authors
+    are kept (the "Similar authors" pages are not refreshed), and so are the
+    fields the profile doesn't extract
+    Books and authors discovered on the pages are not added, the registries only
+    hold the loaded records afterwards
+    :param registries: dict of kind -> Registry the records were loaded into
+    :param due: list of (kind, index in the registry), see plan_refresh
+    :param state: RefreshState
+    :param workers: number of pages downloaded at the same time
+    :param rate: max requests per second per host (None for no limit)
+    :param parse_pool: ParsePool to extract pages in, None to extract in the fetch threads
+    :param profile: Profile or name of the profile of the extraction (see profiles.py),
+        None for the one of the current context
+    :return: (dict of kind -> list of changed records, dict of counts)
+    """
+    changed = {kind: [] for kind in registries}
+    counts = {"unchanged": 0, "same_fields": 0, "changed": 0, "failed": 0}
+    ids = {}  # url -> (kind, id, author name), read by the fetch threads
+
+    def next_url(index):
+        if index >= len(due):
+            return None
+        kind, key = due[index]
+        record = registries[kind][key]
+        url = record[registries[kind].url_key]
+        ids[url] = (kind, record[KEYS[kind]], record.get("name"))
+        return url
+
+    def fetch(url):
+        kind, id_, name = ids[url]
+        html = fetch_book_page(url) if kind == "books" else fetch_author_page(url)
+        if html is None:
+            return None
+        digest = page_hash(html)
+        if digest == state.hash(kind, id_):
+            return digest, None  # same page, not parsed
+        page_kind = "book" if kind == "books" else "author"
+        fields = get_profile().fields(page_kind)
+        if parse_pool is not None:
+            return digest, parse_pool.extract(page_kind, html, name, fields)
+        return digest, extract_page(page_kind, html, name, fields=fields)
+
+    def process(index, url, result):
+        kind, key = due[index]
+        id_ = ids.pop(url)[1]
+        if result is None:
+            counts["failed"] += 1
+            METRICS.incr("refresh_pages", outcome="failed", kind=kind)
+            return
+        digest, page = result
+        if page is None:
+            state.update(kind, id_, digest, False)
+            counts["unchanged"] += 1
+            METRICS.incr("refresh_pages", outcome="unchanged", kind=kind)
+            return
+        record = registries[kind][key]
+        old = dict(record)
+        if kind == "books":
+            merge_book(url, page)
+        else:
+            merge_author_page(key, page)
+            record["related_authors"] = old.get("related_authors", [])
+        outcome = "changed" if dict(record) != old else "same_fields"
+        state.update(kind, id_, digest, outcome == "changed")
+        counts[outcome] += 1
+        METRICS.incr("refresh_pages", outcome=outcome, kind=kind)
+        if outcome == "changed":
+            changed[kind].append(record)
+
+    sizes = {kind: len(registry) for kind, registry in registries.items()}
+    token = use_profile(profile or get_profile())
+    try:
+        crawl(next_url, None, fetch, process, workers, rate)
+    finally:
+        reset_profile(token)
+        for kind, registry in registries.items():
+            registry.truncate(sizes[kind])  # records the merges discovered
+    state.checkpoint()
+    return changed, counts
+
+
+def save_changes(registries, changed, source="json", update_db=False):
+    """
+    Writes the refreshed records
+    With source "json", data/*.json files with changes are rewritten (atomically),
+    with source "db" or update_db, only the changed records are upserted
+    :param registries: dict of kind -> Registry
+    :param changed: dict of kind -> list of changed records
+    :param source: "json" or "db", where the records were loaded from
+    :param update_db: whether to upsert the changed records into the db
+    :return: dict of kind -> inserted/updated/unchanged counts, None without db writes
+    """
+    if source == "json":
+        for kind, records in changed.items():
+            if records:
+                data_to_json(SOURCES[kind] + ".tmp", registries[kind].records)
+                os.replace(SOURCES[kind] + ".tmp", SOURCES[kind])
+    if source != "db" and not update_db:
+        return None
+    db, client = connect_to_db()
+    try:
+        return {kind: sync_documents(records, db[kind]) for kind, records in changed.items()}
+    finally:
+        client.close()
+
+
+def get_args():
+    """
+    Gets command line inputs from user
+    """
+    parser = argparse.ArgumentParser(description="recrawls the scraped records that are due")
+    parser.add_argument("--source", choices=["json", "db"], default="json",
+                        help="where the records are read from and written back to "
+                             "(default: json, data/*.json)")
+    parser.add_argument("--update_db", action="store_true",
+                        help="also upsert the changed records into the db with --source json")
+    parser.add_argument("--kinds", nargs="+", choices=list(KEYS), default=list(KEYS),
+                        help="collections to refresh (default: both)")
+    parser.add_argument("--max_pages", type=int, default=None,
+                        help="max number of pages recrawled, most overdue first "
+                             "(default: no limit)")
+    parser.add_argument("--force", action="store_true",
+                        help="recrawl records that are not due yet (default: False)")
+    parser.add_argument("--base_days", type=float, default=7,
+                        help="days between two checks of an unrated record (default: 7)")
+    parser.add_argument("--min_days", type=float, default=1,
+                        help="min days between two checks of a record (default: 1)")
+    parser.add_argument("--max_days", type=float, default=90,
+                        help="max days between two checks of a record (default: 90)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of pages downloaded concurrently (default: 1)")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="max requests per second per host (default: no limit)")
+    parser.add_argument("--profile", choices=list(PROFILES), default="full",
+                        help="fields extracted from the pages, see profiles.py "
+                             "(default: full)")
+    parser.add_argument("--compact", action="store_true",
+                        help="keep records in compact form (default: False)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    args = get_args()
+    loaded = load_records(args.source, args.compact)
+    refresh_state = RefreshState()
+    try:
+        due_pages = plan_refresh({kind: loaded[kind] for kind in args.kinds}, refresh_state,
+                                 force=args.force, base_interval=args.base_days * DAY,
+                                 min_interval=args.min_days * DAY,
+                                 max_interval=args.max_days * DAY)[:args.max_pages]
+        changes, outcomes = refresh(loaded, due_pages, refresh_state, args.workers, args.rate,
+                                    profile=args.profile)
+    finally:
+        refresh_state.close()
+    print("%d pages due, %s" % (len(due_pages), outcomes))
+    print(save_changes(loaded, changes, args.source, args.update_db))
@@ -0,0 +1,222 @@
+"""
+This module defines the registries that hold all scraped books and authors
+Records are kept in insertion order and indexed by canonical id for fast lookups
+"""
+import itertools
+import re
+from urllib.parse import urlparse, urlunparse
+
+GOODREADS_HOST = "www.goodreads.com"
+GOODREADS_HOSTS = ("goodreads.com", "www.goodreads.com")
+
+
+def canonical_url(url):
+    """
+    Normalizes a goodreads url so that goodreads.com and www.goodreads.com
+    (and relative paths) all map to the same url
+    e.g. https://goodreads.com/book/show/1 -> https://www.goodreads.com/book/show/1
+    :param url: url to normalize
+    :return: canonical url as string
+    """
+    parsed = urlparse(url)
+    if parsed.netloc and parsed.netloc.lower() not in GOODREADS_HOSTS:
+        return url  # not a goodreads url, leave it alone
+    return urlunparse(("https", GOODREADS_HOST, parsed.path,
+                       parsed.params, parsed.query, ""))
+
+
+def canonical_id(url):
+    """
+    Gets the canonical id of a book or author url (the numeric id in the path)
+    e.g. https://www.goodreads.com/book/show/<book_id>
+    Falls back to the canonical url when the path has no numeric id
+    :param url: url of book or author
+    :return: canonical id as string
+    """
+    id_ = re.search("[0-9]+", urlparse(url).path)
+    if id_ is None:
+        return canonical_url(url)
+    return id_.group()
+
+
+class Registry:
+    """
+    Ordered collection of book or author records
+    Supports the list operations used by the scrapers (append, len, index, iterate)
+    and keeps dict indexes keyed by canonical id and by name
+    Pages found on crawled pages are reported with discover, with a seen.Discovered
+    they are queued on disk and get their records when the crawl gets to them (at)
+    """
+
+    def __init__(self, url_key, record_type=dict):
+        """
+        :param url_key: key of the url field in the records ("book_url" or "author_url")
+        :param record_type: type of the records, dict or a store.CompactRecord class
+        """
+        self.url_key = url_key
+        self.record_type = record_type
+        self.records = []  # records in insertion order
+        self.by_id = {}  # canonical id -> record
+        self.by_name = {}  # name -> first record with that name
+        self.discovered = None  # seen.Discovered, None to give discovered pages records
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __getitem__(self, index):
+        return self.records[index]
+
+    def __contains__(self, url):
+        return self.get(url) is not None
+
+    def get(self, url):
+        """
+        Gets a record by url (any url with the same canonical id matches)
+        :param url: url of book or author
+        :return: record if exists, None otherwise
+        """
+        return self.by_id.get(canonical_id(url))
+
+    def known(self, url):
+        """
+        :param url: url of book or author
+        :return: True if the page has a record or was discovered
+        """
+        if self.get(url) is not None:
+            return True
+        return self.discovered is not None and self.discovered.known(url)
+
+    def known_name(self, name):
+        """
+        :param name: name of author
+        :return: True if a record or a discovered page has that name
+        """
+        if self.get_by_name(name) is not None:
+            return True
+        return self.discovered is not None and self.discovered.known_name(_name_key(name))
+
+    def get_by_name(self, name):
+        """
+        Gets a record by name
+        :param name: name of author
+        :return: record if exists, None otherwise
+        """
+        return self.by_name.get(_name_key(name))
+
+    def append(self, record):
+        """
+        Adds a new record and indexes it
+        :param record: dict of book or author info (converted to record_type)
+        """
+        if not isinstance(record, self.record_type):
+            record = self.record_type(record)
+        self.records.append(record)
+        self.index(record)
+
+    def add(self, url, **fields):
+        """
+        Gets the record with the given url, creates it if it doesn't exist yet
+        :param url: url of book or author
+        :param fields: extra fields for a newly created record
+        :return: the existing or newly created record
+        """
+        record = self.get(url)
+        if record is None:
+            record = self.record_type(fields)
+            record[self.url_key] = canonical_url(url)
+            self.append(record)
+        return record
+
+    def discover(self, url, **fields):
+        """
+        Reports a page found on a crawled page, nothing happens if it is known already
+        Without discovered it gets its record right away (see add), with it the page
+        is queued and gets its record when the crawl gets to it (see at)
+        :param url: url of book or author
+        :param fields: extra fields for its record
+        """
+        if self.discovered is None:
+            self.add(url, **fields)
+        elif not self.known(url):
+            record = dict(fields)
+            record[self.url_key] = canonical_url(url)
+            name = fields.get("name")
+            self.discovered.push(record, _name_key(name) if name else None)
+
+    def at(self, index):
+        """
+        Gets the record at index of the crawl order, the next discovered page gets
+        its record when index is the end of the records
+        :param index: index of the record
+        :return: record, None if there is no such record (yet)
+        """
+        if index < len(self.records):
+            return self.records[index]
+        if self.discovered is None or index > len(self.records):
+            return None
+        record = self.discovered.pop()
+        if record is not None:
+            self.append(record)
+            record = self.records[-1]
+        return record
+
+    def pending(self):
+        """
+        :return: number of discovered pages without records yet
+        """
+        return 0 if self.discovered is None else len(self.discovered)
+
+    def queued_records(self):
+        """
+        :return: iterator of the discovered pages without records, as new dicts,
+            in discovery order
+        """
+        return iter(()) if self.discovered is None else self.discovered.remaining()
+
+    def output_records(self):
+        """
+        :return: iterator of the records, then of the discovered pages without
+            records, in discovery order (the records of the json output)
+        """
+        return itertools.chain(self.records, self.queued_records())
+
+    def truncate(self, length):
+        """
+        Removes the records added after the first length ones
+        :param length: number of records to keep
+        """
+        removed = self.records[length:]
+        del self.records[length:]
+        for record in removed:
+            url = record.get(self.url_key)
+            if url and self.by_id.get(canonical_id(url)) is record:
+                del self.by_id[canonical_id(url)]
+            name = record.get("name")
+            if name and self.by_name.get(_name_key(name)) is record:
+                del self.by_name[_name_key(name)]
+
+    def index(self, record):
+        """
+        (Re)indexes a record, e.g. after its url or name has been set
+        :param record: record already in the registry
+        """
+        url = record.get(self.url_key)
+        if url:
+            self.by_id.setdefault(canonical_id(url), record)
+        name = record.get("name")
+        if name:
+            self.by_name.setdefault(_name_key(name), record)
+
+
+def _name_key(name):
+    """
+    Gets a hashable key for an author name (older records store names as lists)
+    :param name: name as string or list
+    :return: name as string
+    """
+    if isinstance(name, list):
+        return "".join(str(part) for part in name)
+    return name
@@ -0,0 +1,299 @@
+"""
+This module defines the crawl scheduler that interleaves books and authors
+Pages of both kinds wait in one priority queue ordered by a policy, with a
+budget per kind and optional page, time and depth limits, so that a crawl
+cut short has scraped the most valuable records first
+"""
+import heapq
+import itertools
+import re
+import time
+
+import settings
+from crawler import crawl
+from db import update_db_from_data
+from metrics import METRICS
+from registry import canonical_id
+from scrape_authors import SimilarAuthorsTasks, fetch_and_extract_author, \
+    fetch_and_extract_similar_authors, merge_author_page
+from scrape_books import fetch_and_extract_book, merge_book
+
+# policy -> what is crawled first
+POLICIES = {
+    "fifo": "discovery order, books and authors interleaved",
+    "bfs": "smallest depth (number of links from start_url) first",
+    "indegree": "most linked to by the pages crawled so far first",
+    "rating": "linked to by the most rated pages first (rating_count)",
+    "pagerank": "highest PageRank in the graphs of a previous crawl first (graph.py)",
+}
+
+
+class Scheduler:
+    """
+    Priority queue over the records of the books and authors registries
+    New registry records are queued by discover, links between records are
+    reported with link (depth, in-degree and rating of the linking pages)
+    """
+
+    def __init__(self, registries, policy="bfs", budgets=None, max_pages=None,
+                 max_seconds=None, max_depth=None, scores=None):
+        """
+        :param registries: dict of kind ("books" or "authors") -> Registry
+        :param policy: one of POLICIES
+        :param budgets: dict of kind -> max number of pages, missing kinds are unlimited
+        :param max_pages: max number of pages of all kinds (None for no limit)
+        :param max_seconds: max seconds from the first pop (None for no limit)
+        :param max_depth: max depth of a crawled page (None for no limit)
+        :param scores: dict of (kind, canonical id) -> score for the pagerank policy
+            (see graph.load_scores), unknown records come after the scored ones
+        """
+        if policy not in POLICIES:
+            raise ValueError("unknown policy %r, expected one of %s" % (policy, ", ".join(POLICIES)))
+        self.registries = registries
+        self.policy = policy
+        self.budgets = budgets or {}
+        self.max_pages = max_pages
+        self.max_seconds = max_seconds
+        self.max_depth = max_depth
+        self.scores = scores or {}
+        self.heap = []  # (priority, seq, kind, index)
+        self.seq = itertools.count()  # ties are broken by discovery order
+        self.synced = {kind: 0 for kind in registries}  # registry records already queued
+        self.indexes = {}  # (kind, canonical id) -> index in the registry, once queued
+        self.depth = {}  # (kind, canonical id) -> depth
+        self.in_degree = {}  # (kind, canonical id) -> number of links
+        self.rating = {}  # (kind, canonical id) -> best rating count of a linking page
+        self.popped = set()  # (kind, canonical id) handed out already
+        self.counts = {kind: 0 for kind in registries}  # pages handed out per kind
+        self.started = None
+
+    def key(self, kind, index):
+        """
+        :return: (kind, canonical id) of the record at index in the registry of kind
+        """
+        return kind, canonical_id(self.registries[kind][index][self.registries[kind].url_key])
+
+    def priority(self, key):
+        if self.policy == "bfs":
+            return self.depth.get(key, 0)
+        if self.policy == "indegree":
+            return -self.in_degree.get(key, 0)
+        if self.policy == "rating":
+            return -self.rating.get(key, 0), -self.in_degree.get(key, 0)
+        if self.policy == "pagerank":
+            return -self.scores.get(key, 0.0), -self.in_degree.get(key, 0)
+        return 0
+
+    def discover(self, depth=0):
+        """
+        Queues the registry records added since the last call
+        :param depth: depth of the records that weren't reached by a link
+        """
+        for kind, registry in self.registries.items():
+            for index in range(self.synced[kind], len(registry)):
+                if registry[index].get(registry.url_key):
+                    key = self.key(kind, index)
+                    self.depth.setdefault(key, depth)
+                    self.indexes.setdefault(key, index)
+                    self.push(key, index)
+            self.synced[kind] = len(registry)
+
+    def link(self, parent, kind, urls, rating=None):
+        """
+        Records the links of a crawled page
+        :param parent: (kind, canonical id) of the crawled page
+        :param kind: kind of the linked records
+        :param urls: urls of the linked records, unknown urls are ignored
+        :param rating: rating count of the crawled page
+        """
+        depth = self.depth.get(parent, 0) + 1
+        count = rating_count(rating)
+        for url in urls or []:
+            if self.registries[kind].get(url) is None:
+                continue
+            key = (kind, canonical_id(url))
+            old = self.priority(key)
+            self.depth.setdefault(key, depth)
+            self.in_degree[key] = self.in_degree.get(key, 0) + 1
+            self.rating[key] = max(self.rating.get(key, 0), count)
+            if key in self.indexes and key not in self.popped and self.priority(key) != old:
+                self.push(key, self.indexes[key])  # the old entry becomes stale
+
+    def push(self, key, index):
+        heapq.heappush(self.heap, (self.priority(key), next(self.seq), key[0], index))
+
+    def pop(self):
+        """
+        Gets the next page to crawl
+        :return: (kind, index in the registry), None when the queue is empty
+            or a limit is reached
+        """
+        if self.started is None:
+            self.started = time.monotonic()
+        if self.max_seconds is not None and time.monotonic() - self.started >= self.max_seconds:
+            return None
+        if self.max_pages is not None and sum(self.counts.values()) >= self.max_pages:
+            return None
+        while self.heap:
+            priority, _, kind, index = heapq.heappop(self.heap)
+            key = self.key(kind, index)
+            if key in self.popped or priority != self.priority(key):
+                continue  # already crawled, or queued again with a new priority
+            if self.counts[kind] >= self.budgets.get(kind, float("inf")):
+                continue  # budget spent, never refills
+            if self.max_depth is not None and self.depth.get(key, 0) > self.max_depth:
+                continue
+            self.popped.add(key)
+            self.counts[kind] += 1
+            return kind, index
+        return None
+
+
+def rating_count(value):
+    """
+    :param value: rating count as scraped, e.g. "1,234", or None
+    :return: rating count as int, 0 when unknown
+    """
+    digits = re.sub("[^0-9]", "", str(value or ""))
+    return int(digits) if digits else 0
+
+
+def scrape_all(num_books, num_authors, start_url, real_time_update, workers=1, rate=None,
+               book_output=None, author_output=None, frontier=None, parse_pool=None,
+               policy="bfs", max_pages=None, max_seconds=None, max_depth=None, scores=None):
+    """
+    Scrapes books and authors in one crawl, in the order of the policy
+    Pages are downloaded by a pool of workers and merged in the order they were
+    scheduled, so results are deterministic for a given number of workers
+    "Similar authors" pages of crawled authors go first and are not limited
+    :param num_books: max number of books to scrape
+    :param num_authors: max number of authors to scrape
+    :param start_url: url to start scraping from
+    :param real_time_update: whether or not to update db after every scrape
+    :param workers: number of pages downloaded at the same time
+    :param rate: max requests per second per host (None for no limit)
+    :param book_output: function(book) called with every scraped book
+    :param author_output: function(author) called with every scraped author
+    :param frontier: Frontier recording the crawl, pages it has as done are skipped
+    :param parse_pool: ParsePool to extract pages in, None to extract in the fetch threads
+    :param policy: one of POLICIES
+    :param max_pages: max number of book and author pages (None for no limit)
+    :param max_seconds: seconds after which no new page is started (None for no limit)
+    :param max_depth: max number of links from start_url (None for no limit)
+    :param scores: scores of the pagerank policy (see Scheduler)
+    :return: Scheduler, with the number of pages crawled per kind in counts
+    """
+    registries = {"books": settings.books, "authors": settings.authors}
+    scheduler = Scheduler(registries, policy, {"books": num_books, "authors": num_authors},
+                          max_pages, max_seconds, max_depth, scores)
+    settings.books.add(start_url)
+    # a resumed crawl gets the depths and links of the pages it has done
+    for kind, registry in registries.items():
+        for record in registry:
+            if frontier is not None and frontier.is_done(kind, record[registry.url_key]):
+                link_record(scheduler, kind, record)
+    scheduler.discover()
+
+    tasks = []  # crawl order, (kind, index in the registry) or ("similar", url)
+    names = {}  # author url -> author name, read by the fetch threads
+    kinds = {}  # url -> kind, read by the fetch threads
+
+    def next_url(index):
+        similar_url = similar.pop()
+        if similar_url is not None:
+            tasks.append(("similar", similar_url))
+            return similar_url
+        task = scheduler.pop()
+        if task is None:
+            return None  # queue empty (for now) or limit reached
+        kind, key = task
+        record = registries[kind][key]
+        url = record[registries[kind].url_key]
+        tasks.append(task)
+        kinds[url] = kind
+        if kind == "authors":
+            names[url] = record["name"]
+        return url
+
+    def fetch(url):
+        if url in similar:
+            return fetch_and_extract_similar_authors(url, parse_pool)
+        kind = kinds.pop(url)
+        if frontier is not None:
+            frontier.mark_in_flight(kind, url)
+        if kind == "books":
+            return fetch_and_extract_book(url, parse_pool)
+        return fetch_and_extract_author(url, names.pop(url, None), parse_pool)
+
+    def process(index, url, page):
+        kind, key = tasks[index]
+        if kind == "similar":
+            similar.merge(url, page)
+        elif kind == "books":
+            process_book(key, url, page)
+        else:
+            process_author(key, url, page)
+        scheduler.discover()
+        METRICS.set_gauge("frontier_depth", len(scheduler.heap), kind="all")
+
+    def process_book(key, url, page):
+        METRICS.incr("pages_fetched" if page is not None else "fetch_errors", kind="book")
+        with METRICS.timer("merge", kind="book"):
+            book = merge_book(url, page, real_time_update)
+        if book is None:
+            if frontier is not None:
+                frontier.mark_failed("books", url)
+            return
+        link_record(scheduler, "books", book)
+        if book_output is not None:
+            book_output(book)
+        if frontier is not None:
+            frontier.mark_done("books", book)
+
+    def process_author(key, url, page):
+        METRICS.incr("pages_fetched" if page is not None else "fetch_errors", kind="author")
+        with METRICS.timer("merge", kind="author"):
+            author = merge_author_page(key, page)
+        if author is None:
+            if frontier is not None:
+                frontier.mark_failed("authors", url)
+            return
+        scheduler.link(("authors", canonical_id(url)), "books", author.get("author_books"),
+                       author.get("rating_count"))
+        similar.add(key, page["fields"].get("similar_authors_url", ""))
+
+    def complete(author):
+        scheduler.link(("authors", canonical_id(author["author_url"])), "authors",
+                       author.get("related_authors"), author.get("rating_count"))
+        if real_time_update:
+            update_db_from_data(author, "authors")
+        if author_output is not None:
+            author_output(author)
+        if frontier is not None:
+            frontier.mark_done("authors", author)
+
+    def skip(index):
+        kind, key = tasks[index]
+        return (kind != "similar" and frontier is not None
+                and frontier.is_done(kind, registries[kind][key][registries[kind].url_key]))
+
+    similar = SimilarAuthorsTasks(complete)
+    crawl(next_url, None, fetch, process, workers, rate, skip)
+    return scheduler
+
+
+def link_record(scheduler, kind, record):
+    """
+    Reports the links of a crawled book or author to the scheduler
+    :param scheduler: Scheduler
+    :param kind: "books" or "authors"
+    :param record: scraped record
+    """
+    parent = (kind, canonical_id(record[scheduler.registries[kind].url_key]))
+    rating = record.get("rating_count")
+    if kind == "books":
+        scheduler.link(parent, "books", record.get("similar_books"), rating)
+        scheduler.link(parent, "authors", record.get("author_url"), rating)
+    else:
+        scheduler.link(parent, "books", record.get("author_books"), rating)
+        scheduler.link(parent, "authors", record.get("related_authors"), rating)
@@ -3,44 +3,102 @@ This module defines functions needed to scrape information about book authors fr
 Then store the data into json or db
 """
 import os
-from urllib.request import urlopen
-from bs4 import BeautifulSoup
+from collections import deque
 import settings
+from crawler import crawl
 from db import update_db_from_data
-from scrape_books import get_id, get_book_by_url
+from eventlog import ScopedLog
+from extract import AUTHOR_FIELDS, extract_page
+from fetcher import fetch_html
+from metrics import METRICS, record_page_timings
+from profiles import get_profile
+from registry import canonical_url
+from scrape_books import get_id
 
 curr_dir = os.path.dirname(os.path.abspath(__file__))
 log_path = os.path.join(curr_dir, "logs", "scrape_authors_log.log")
-LOG_FILE = open(log_path, "w+")
+LOG = ScopedLog("scrape_authors", log_path)  # opened on the first error
+# scraped fields of an author record, in order
+AUTHOR_ORDER = ("author_id", "rating", "rating_count", "review_count", "image_url",
+                "related_authors", "author_books")
 
 
-def scrape_one_author(index):
+def scrape_one_author(index, real_time=False):
     """
     Scraps info about one author at settings.authors[index]
     name, author_url, author_id, rating, rating_count, review_count, image_url
     related_authors, author_books
+    :param index: index of author in settings.authors
+    :param real_time: whether or not to update db after the scrape
+    :return: None when exception, author object with scraped info otherwise
     """
-    global curr_url
-    author = settings.authors[index]
-    url = author["author_url"]
-    curr_url = url
+    url = settings.authors[index]["author_url"]
+    html = fetch_author_page(url)
+    return parse_author(index, html, real_time)
+
+
+def fetch_and_extract_author(url, name, parse_pool=None):
+    """
+    Downloads and extracts one author page
+    Safe to call from worker threads, does not touch settings
+    :param url: url of author
+    :param name: name of author (used to find the author image)
+    :param parse_pool: ParsePool to extract in, None to extract in this thread
+    :return: extracted page (see extract.extract_page), None when exception
+    """
+    html = fetch_author_page(url)
+    if html is None:
+        return None
+    fields = get_profile().fields("author")
+    if parse_pool is not None:
+        return parse_pool.extract("author", html, name, fields)
+    return extract_page("author", html, name, fields=fields)
 
+
+def fetch_author_page(url):
+    """
+    Downloads the html of one author page
+    Safe to call from worker threads, does not touch settings
+    :param url: url of author
+    :return: html as string, None when exception
+    """
     try:
-        page = urlopen(url)
+        return fetch_html(url)
     except:
-        LOG_FILE.write("Error opening book url: " + url + "\n")  # log bad urls
+        LOG.error("Error opening author url", url, event="fetch")  # log bad urls
         return None
 
-    html = page.read().decode("utf-8")
-    soup = BeautifulSoup(html, "html.parser")
 
-    author["author_id"] = get_id(url)
-    author["rating"] = get_author_rating(soup)
-    author["rating_count"] = get_author_rating_count(soup)
-    author["review_count"] = get_author_review_count(soup)
-    author["image_url"] = get_author_image_url(soup, author["name"])
-    author["related_authors"] = get_related_authors(soup)
-    author["author_books"] = get_author_books(soup)
+def parse_author(index, html, real_time=False):
+    """
+    Extracts info of the author at settings.authors[index] from its html
+    :param index: index of author in settings.authors
+    :param html: html of the author page, None if the download failed
+    :param real_time: whether or not to update db after the scrape
+    :return: None when html is None, author object with scraped info otherwise
+    """
+    if html is None:
+        return None
+    name = settings.authors[index]["name"]
+    page = extract_page("author", html, name, fields=get_profile().fields("author"))
+    return merge_author(index, page, real_time)
+
+
+def merge_author(index, page, real_time=False):
+    """
+    Merges one extracted author page into settings.authors and settings.books
+    The "Similar authors" page is fetched here, if the profile extracts its url
+    :param index: index of author in settings.authors
+    :param page: extracted page (see extract.extract_page), None if the download failed
+    :param real_time: whether or not to update db after the scrape
+    :return: None when page is None, author object with scraped info otherwise
+    """
+    author = merge_author_page(index, page)
+    if author is None:
+        return None
+    similar_url = page["fields"].get("similar_authors_url")
+    if similar_url:
+        author["related_authors"] = scrape_related_authors(similar_url, author["author_url"])
 
     if real_time:
         update_db_from_data(author, "authors")
@@ -50,10 +108,46 @@ def scrape_one_author(index):
     return author
 
 
-def get_author_rating(soup):
+def merge_author_page(index, page):
+    """
+    Merges one extracted author page into settings.authors and settings.books
+    related_authors is left empty, the "Similar authors" page is merged by
+    merge_related_authors
+    Fields that were not extracted (see profiles.py) keep their values
+    :param index: index of author in settings.authors
+    :param page: extracted page (see extract.extract_page), None if the download failed
+    :return: None when page is None, author object with scraped info otherwise
+    """
+    if page is None:
+        return None
+
+    record_page_timings("author", page.get("timings", {}))
+    author = settings.authors[index]
+    url = author["author_url"]
+    fields = page["fields"]
+    for field in page["errors"]:
+        LOG.error("Error getting " + AUTHOR_FIELDS[field][1], url, event="extract",
+                  field=field)
+
+    values = dict(fields, author_id=get_id(url))
+    if "similar_authors_url" in fields:
+        values["related_authors"] = []
+    for field in AUTHOR_ORDER:
+        if field in values:
+            author[field] = values[field]
+
+    # update settings.book, new books if not seen yet
+    for book_url in page["discovered"]:
+        settings.books.discover(book_url)
+
+    return author
+
+
+def get_author_rating(soup, url):
     """
     Gets author rating
     :param soup: soup object
+    :param url: url of current page (for logging)
     :return: author rating as string
     """
 
@@ -61,98 +155,149 @@ def get_author_rating(soup):
         rating_tag = soup.find("span", class_="average")
         rating = rating_tag.contents[0]
     except:
-        LOG_FILE.write("Error getting author rating at: " + curr_url + "\n")
+        LOG.error("Error getting author rating", url)
         return ""
     return rating
 
 
-def get_author_rating_count(soup):
+def get_author_rating_count(soup, url):
     """
     Gets author rating count
     :param soup: soup object
+    :param url: url of current page (for logging)
     :return: author rating count as string
     """
     try:
         rating_count_tag = soup.find("span", itemprop="ratingCount")
         rating_count = rating_count_tag["content"]
     except:
-        LOG_FILE.write("Error getting author rating count at: " + curr_url + "\n")
+        LOG.error("Error getting author rating count", url)
         return ""
     return rating_count
 
 
-def get_author_review_count(soup):
+def get_author_review_count(soup, url):
     """
     Gets author review count
     :param soup: soup object
+    :param url: url of current page (for logging)
     :return: author review count as string
     """
     try:
         review_count_tag = soup.find("span", itemprop="reviewCount")
         review_count = review_count_tag["content"]
     except:
-        LOG_FILE.write("Error getting author review count at: " + curr_url + "\n")
+        LOG.error("Error getting author review count", url)
         return ""
     return review_count
 
 
-def get_author_image_url(soup, name):
+def get_author_image_url(soup, name, url):
     """
     Gets author image url
     :param soup: soup object
     :param name: author name
+    :param url: url of current page (for logging)
     :return: author image url as string
     """
     try:
         image_url_tag = soup.find("img", alt=name)
         image_url = image_url_tag["src"]
     except:
-        LOG_FILE.write("Error getting author image url at: " + curr_url + "\n")
+        LOG.error("Error getting author image url", url)
         return ""
     return image_url
 
 
-def get_related_authors(soup):
+def get_related_authors(soup, url):
     """
     Gets a list of related authors urls
     :param soup: soup object
+    :param url: url of current page (for logging)
     :return: list of related authors
     """
     try:
         related_authors_tag = soup.find("a", text="Similar authors")
         path = related_authors_tag["href"]
-        url = "https://goodreads.com" + path
-        related_authors_soup = get_soup(url)
+        similar_url = canonical_url(path)
+        related_authors_soup = get_soup(similar_url)
         author_name_tags = related_authors_soup.find_all("span", itemprop="name")
         related_authors = [] # list of related author urls
 
         for i in range(1, len(author_name_tags)):
             tag = author_name_tags[i]
             name = tag.contents
-            author = if_author_exists(name)
-            if not author:
-                author = {"name": name}
-                settings.authors.append(author) # create new entries for new authors
             author_url = get_author_url(tag)
-            author["author_url"] = author_url
-            if author not in related_authors: # avoid adding duplicate authors
+            settings.authors.discover(author_url, name=name) # new authors if not seen yet
+            if author_url not in related_authors: # avoid adding duplicate authors
                 related_authors.append(author_url)
 
     except:
-        LOG_FILE.write("Error getting related author at: " + curr_url + "\n")
+        LOG.error("Error getting related author", url)
         return []
 
     return related_authors
 
 
+def scrape_related_authors(similar_url, url):
+    """
+    Scrapes the "Similar authors" page of an author
+    Adds new authors to settings.authors
+    :param similar_url: url of the similar authors page
+    :param url: url of the author (for logging)
+    :return: list of related author urls
+    """
+    return merge_related_authors(fetch_and_extract_similar_authors(similar_url), url)
+
+
+def fetch_and_extract_similar_authors(similar_url, parse_pool=None):
+    """
+    Downloads and extracts one "Similar authors" page
+    Safe to call from worker threads, does not touch settings
+    :param similar_url: url of the similar authors page
+    :param parse_pool: ParsePool to extract in, None to extract in this thread
+    :return: extracted page (see extract.extract_page), None when exception
+    """
+    try:
+        html = fetch_html(similar_url)
+    except:
+        return None
+    if parse_pool is not None:
+        return parse_pool.extract("similar_authors", html)
+    return extract_page("similar_authors", html)
+
+
+def merge_related_authors(page, url):
+    """
+    Merges one extracted "Similar authors" page into settings.authors
+    :param page: extracted page, None if the download failed
+    :param url: url of the author (for logging)
+    :return: list of related author urls
+    """
+    if page is None or page["errors"]:
+        LOG.error("Error getting related author", url)
+        return []
+    record_page_timings("similar_authors", page.get("timings", {}))
+
+    related_authors = [] # list of related author urls
+    seen = set() # canonical urls, the page may list an author under several urls
+    for name, author_url in page["fields"]["related_authors"]:
+        settings.authors.discover(author_url, name=name) # new authors if not seen yet
+        if canonical_url(author_url) not in seen: # avoid adding duplicate authors
+            seen.add(canonical_url(author_url))
+            related_authors.append(author_url)
+    return related_authors
+
+
 def get_soup(url):
     """
     Gets the soup (parsed html) from a url
     :param url: url to get soup of
     :return: soup of the given url
     """
-    page = urlopen(url)
-    html = page.read().decode("utf-8")
+    from bs4 import BeautifulSoup
+
+    html = fetch_html(url)
     soup = BeautifulSoup(html, "html.parser")
     return soup
 
@@ -163,10 +308,7 @@ def if_author_exists(name):
     :param name: name of author
     :return: author object if exists, None otherwise
     """
-    for author in settings.authors:
-        if author["name"] == name:
-            return author
-    return None
+    return settings.authors.get_by_name(name)
 
 
 def get_author_url(tag):
@@ -179,10 +321,11 @@ def get_author_url(tag):
     return parent_tag["href"]
 
 
-def get_author_books(soup):
+def get_author_books(soup, url):
     """
     Gets all the books written by this author
     :param soup: soup object
+    :param url: url of current page (for logging)
     :return: list of books written by the author
     """
     try:
@@ -192,34 +335,155 @@ def get_author_books(soup):
         for parent in parents:
             tag = parent.find("span", itemprop="name")
             path = tag.parent["href"]
-            url = "https://goodreads.com" + path
-            # update settings.book
-            book = get_book_by_url(url)
-            if not book:
-                book = {"book_url": url} # create new book object with url
-                settings.books.append(book)
+            book_url = canonical_url(path)
+            # update settings.book, new book if not seen yet
+            settings.books.discover(book_url)
 
-            similar_books.append(url)
+            similar_books.append(book_url)
 
     except:
-        LOG_FILE.write("Error getting author books at: " + curr_url + "\n")  # log bad author books
+        LOG.error("Error getting author books", url)  # log bad author books
         return []
 
     return similar_books
 
 
-def scrape_n_authors(num_authors, real_time_update):
+class SimilarAuthorsTasks:
+    """
+    "Similar authors" pages waiting to be crawled as tasks of their own
+    Every url is fetched once, authors sharing a page wait for the same task
+    """
+
+    def __init__(self, complete):
+        """
+        :param complete: function(author) called when the related authors of an
+            author are merged (or right away when it has no similar authors page)
+        """
+        self.complete = complete
+        self.queue = deque()  # urls to crawl
+        self.urls = set()  # urls ever queued, read by the fetch threads
+        self.waiting = {}  # url -> indexes of the authors waiting for it
+        self.related = {}  # url -> related author urls, once merged
+
+    def __contains__(self, url):
+        return url in self.urls
+
+    def __len__(self):
+        return len(self.queue)
+
+    def add(self, index, similar_url):
+        """
+        Attaches the "Similar authors" page of a merged author page
+        :param index: index of author in settings.authors
+        :param similar_url: url of the similar authors page, "" if there is none
+        """
+        author = settings.authors[index]
+        if not similar_url:
+            self.complete(author)
+        elif similar_url in self.related:
+            author["related_authors"] = list(self.related[similar_url])
+            self.complete(author)
+        elif similar_url in self.waiting:
+            self.waiting[similar_url].append(index)
+        else:
+            self.waiting[similar_url] = [index]
+            self.urls.add(similar_url)
+            self.queue.append(similar_url)
+
+    def pop(self):
+        """
+        :return: url of the next page to crawl, None if there is none
+        """
+        return self.queue.popleft() if self.queue else None
+
+    def merge(self, similar_url, page):
+        """
+        Merges a crawled page into the authors waiting for it
+        :param similar_url: url of the similar authors page
+        :param page: extracted page, None if the download failed
+        """
+        METRICS.incr("pages_fetched" if page is not None else "fetch_errors",
+                     kind="similar_authors")
+        indexes = self.waiting.pop(similar_url)
+        with METRICS.timer("merge", kind="similar_authors"):
+            self.related[similar_url] = merge_related_authors(
+                page, settings.authors[indexes[0]]["author_url"])
+        for index in indexes:
+            author = settings.authors[index]
+            author["related_authors"] = list(self.related[similar_url])
+            self.complete(author)
+
+
+def scrape_n_authors(num_authors, real_time_update, workers=1, rate=None, output=None,
+                     frontier=None, parse_pool=None):
     """
     Scrapes num_authors number of authors
+    Pages are downloaded by a pool of workers, but parsed in discovery order
+    "Similar authors" pages are crawled as tasks of their own, each url once,
+    an author is complete (output, db, frontier) when its related authors are merged
     Updates db after every scraping if real_time_update is on
     :param num_authors: number of authors to scrape
     :param real_time_update: whether or not db is updated after every scrape
+    :param workers: number of pages downloaded at the same time
+    :param rate: max requests per second per host (None for no limit)
+    :param output: function(author) called with every scraped author, e.g. NdjsonWriter.write
+    :param frontier: Frontier recording the crawl, authors it has as done are skipped
+    :param parse_pool: ParsePool to extract pages in, None to extract in the fetch threads
     """
-    global LOG_FILE
-    global real_time
-    real_time = real_time_update
-
-    index = 0
-    while index < num_authors:
-        scrape_one_author(index)
-        index += 1
+    names = {}  # url -> author name, read by the fetch threads
+    tasks = []  # crawl order, ("author", index in settings.authors) or ("similar", url)
+    next_author = 0  # index in settings.authors of the next author to crawl
+
+    def next_url(index):
+        nonlocal next_author
+        similar_url = similar.pop()
+        if similar_url is not None:
+            tasks.append(("similar", similar_url))
+            return similar_url
+        author = settings.authors.at(next_author) if next_author < num_authors else None
+        if author is not None:
+            names[author["author_url"]] = author["name"]
+            tasks.append(("author", next_author))
+            next_author += 1
+            return author["author_url"]
+        return None  # frontier exhausted (for now)
+
+    def fetch(url):
+        if url in similar:
+            return fetch_and_extract_similar_authors(url, parse_pool)
+        if frontier is not None:
+            frontier.mark_in_flight("authors", url)
+        return fetch_and_extract_author(url, names.pop(url, None), parse_pool)
+
+    def process(index, url, page):
+        kind, key = tasks[index]
+        if kind == "similar":
+            similar.merge(url, page)
+            return
+        METRICS.incr("pages_fetched" if page is not None else "fetch_errors", kind="author")
+        with METRICS.timer("merge", kind="author"):
+            author = merge_author_page(key, page)
+        METRICS.set_gauge("frontier_depth",
+                          len(settings.authors) + settings.authors.pending() - key - 1,
+                          kind="author")
+        if author is None:
+            if frontier is not None:
+                frontier.mark_failed("authors", url)
+            return
+        similar.add(key, page["fields"].get("similar_authors_url", ""))
+
+    def complete(author):
+        if real_time_update:
+            update_db_from_data(author, "authors")
+        if output is not None:
+            output(author)
+        if frontier is not None:
+            frontier.mark_done("authors", author)
+
+    def skip(index):
+        kind, key = tasks[index]
+        return (kind == "author" and frontier is not None
+                and frontier.is_done("authors", settings.authors[key]["author_url"]))
+
+    similar = SimilarAuthorsTasks(complete)
+    crawl(next_url, None, fetch, process, workers, rate, skip)
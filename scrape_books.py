@@ -4,15 +4,22 @@ Then store the data into json or db
 """
 import os
 import re
-from urllib.parse import urlparse
-from urllib.request import urlopen
-from bs4 import BeautifulSoup
 import settings
+from crawler import crawl
 from db import update_db_from_data
+from eventlog import ScopedLog
+from extract import BOOK_FIELDS, extract_page
+from fetcher import fetch_html
+from metrics import METRICS, record_page_timings
+from profiles import get_profile
+from registry import canonical_id, canonical_url
 
 curr_dir = os.path.dirname(os.path.abspath(__file__))
 log_path = os.path.join(curr_dir, "logs", "scrape_books_log.log")
-LOG_FILE = open(log_path, "w+")
+LOG = ScopedLog("scrape_books", log_path)  # opened on the first error
+# fields of a book record after book_url, in order
+BOOK_ORDER = ("title", "book_id", "isbn", "author", "author_url", "rating", "rating_count",
+              "review_count", "image_url", "similar_books")
 
 
 def get_id(url):
@@ -22,11 +29,7 @@ def get_id(url):
     :param url:
     :return:
     """
-    parsed_url = urlparse(url)
-    path = parsed_url.path
-    id_ = re.search("[0-9]+", path)
-    id_ = id_.group()
-    return id_
+    return canonical_id(url)
 
 
 def get_next_book_url(index):
@@ -37,52 +40,97 @@ def get_next_book_url(index):
     return settings.books[index]["book_url"]
 
 
-def scrape_one_book(url):
+def scrape_one_book(url, real_time=False):
     """
     Scrapes info of one book and the author (if doesn't exist already)
     info: book_url, title, book_id, isbn, author, author_url, rating, rating_count
     review_count, image_url, similar_books
     :param url: url of current book
+    :param real_time: whether or not to update db after the scrape
     :return: None when exception, book object with scraped info otherwise
     """
-    global CURR_URL
-    CURR_URL = url
-    global REAL_TIME
+    html = fetch_book_page(url)
+    return parse_book(url, html, real_time)
 
+
+def fetch_and_extract_book(url, parse_pool=None):
+    """
+    Downloads and extracts one book page
+    Safe to call from worker threads, does not touch settings
+    :param url: url of book
+    :param parse_pool: ParsePool to extract in, None to extract in this thread
+    :return: extracted page (see extract.extract_page), None when exception
+    """
+    html = fetch_book_page(url)
+    if html is None:
+        return None
+    fields = get_profile().fields("book")
+    if parse_pool is not None:
+        return parse_pool.extract("book", html, fields=fields)
+    return extract_page("book", html, fields=fields)
+
+
+def fetch_book_page(url):
+    """
+    Downloads the html of one book page
+    Safe to call from worker threads, does not touch settings
+    :param url: url of book
+    :return: html as string, None when exception
+    """
     try:
-        page = urlopen(url)
+        return fetch_html(url)
     except:
-        LOG_FILE.write("Error opening book url: " + url + "\n")  # log bad urls
+        LOG.error("Error opening book url", url, event="fetch")  # log bad urls
         return None
 
-    book = get_book_by_url(url)
-    if book is None:
-        book = {}
-        settings.books.append(book)
-    html = page.read().decode("utf-8")
-    soup = BeautifulSoup(html, "html.parser")
 
-    book["book_url"] = url
-    book["title"] = get_title(soup)
-    book["book_id"] = get_id(url)
-    book["isbn"] = get_isbn(soup)
+def parse_book(url, html, real_time=False):
+    """
+    Extracts info of one book from its html and merges it into settings.books
+    :param url: url of current book
+    :param html: html of the book page, None if the download failed
+    :param real_time: whether or not to update db after the scrape
+    :return: None when html is None, book object with scraped info otherwise
+    """
+    if html is None:
+        return None
+    return merge_book(url, extract_page("book", html, fields=get_profile().fields("book")),
+                      real_time)
 
-    author_names = get_author(soup)
-    book["author"] = author_names  # list of author names of this book
 
-    book_author_urls = get_author_url(soup)
-    book["author_url"] = book_author_urls
+def merge_book(url, page, real_time=False):
+    """
+    Merges one extracted book page into settings.books and settings.authors
+    Fields that were not extracted (see profiles.py) keep their values
+    :param url: url of current book
+    :param page: extracted page (see extract.extract_page), None if the download failed
+    :param real_time: whether or not to update db after the scrape
+    :return: None when page is None, book object with scraped info otherwise
+    """
+    if page is None:
+        return None
+
+    record_page_timings("book", page.get("timings", {}))
+    book = settings.books.add(url)
+    fields = page["fields"]
+    for field in page["errors"]:
+        LOG.error("Error getting " + BOOK_FIELDS[field][1], url, event="extract",
+                  field=field)
 
-    book["rating"] = get_book_rating(soup)
-    book["rating_count"] = get_book_rating_count(soup)
-    book["review_count"] = get_book_review_count(soup)
-    book["image_url"] = get_book_image_url(soup)
-    book["similar_books"] = get_similar_books(soup)  # list of urls of similar books
+    book["book_url"] = canonical_url(url)
+    # author: list of author names of this book, similar_books: list of urls of similar books
+    values = dict(fields, book_id=get_id(url))
+    for field in BOOK_ORDER:
+        if field in values:
+            book[field] = values[field]
 
     # update global lists books and authors
-    update_authors(author_names, book_author_urls)
+    for book_url in page["discovered"]:
+        settings.books.discover(book_url)  # new book if not seen yet
+    if "author" in fields and "author_url" in fields:
+        update_authors(book["author"], book["author_url"])
 
-    if REAL_TIME:
+    if real_time:
         update_db_from_data(book, "books")
 
     # If not real time, write into json after all the scraping, update db in main from json
@@ -90,10 +138,11 @@ def scrape_one_book(url):
     return book
 
 
-def get_title(soup):
+def get_title(soup, url):
     """
     Extracts and processes book titles
     :param soup: soup object
+    :param url: url of current page (for logging)
     :return: title in string
     """
     try:
@@ -101,31 +150,33 @@ def get_title(soup):
         title = title_tag.contents[0]  # raw title between tags
         title = title.strip()  # remove leading and trailing spaces
     except:
-        LOG_FILE.write("Error getting book title at: " + CURR_URL + "\n")
+        LOG.error("Error getting book title", url)
         return ""
     return title
 
 
-def get_isbn(soup):
+def get_isbn(soup, url):
     """
     Extracts and processes book isbn's
     isbn could be "null"
     :param soup: soup object
+    :param url: url of current page (for logging)
     :return: isbn in string
     """
     try:
         isbn_tag = soup.find("meta", property="books:isbn")
         isbn = isbn_tag["content"]
     except:
-        LOG_FILE.write("Error getting book isbn at: " + CURR_URL + "\n")
+        LOG.error("Error getting book isbn", url)
         return ""
     return isbn
 
 
-def get_book_rating(soup):
+def get_book_rating(soup, url):
     """
     Extracts and processes book ratings
     :param soup: soup object
+    :param url: url of current page (for logging)
     :return: rating in string
     """
     try:
@@ -133,101 +184,99 @@ def get_book_rating(soup):
         rating = rating_tag.contents[0]
         rating = rating.strip()  # removes leading and trailing newlines and whitespaces
     except:
-        LOG_FILE.write("Error getting book rating at: " + CURR_URL + "\n")
+        LOG.error("Error getting book rating", url)
         return ""
     return rating
 
 
-def get_book_rating_count(soup):
+def get_book_rating_count(soup, url):
     """
     Extracts book rating counts
     :param soup: soup object
+    :param url: url of current page (for logging)
     :return: book rating count in string
     """
     try:
         rating_count_tag = soup.find("meta", itemprop="ratingCount")
         rating_count = rating_count_tag["content"]
     except:
-        LOG_FILE.write("Error getting book rating count at: " + CURR_URL + "\n")
+        LOG.error("Error getting book rating count", url)
         return ""
     return rating_count
 
 
-def get_book_review_count(soup):
+def get_book_review_count(soup, url):
     """
     Extracts book review counts
     :param soup: soup object
+    :param url: url of current page (for logging)
     :return: book review count in string
     """
     try:
         review_count_tag = soup.find("meta", itemprop="reviewCount")
         review_count = review_count_tag["content"]
     except:
-        LOG_FILE.write("Error getting book review count at: " + CURR_URL + "\n")
+        LOG.error("Error getting book review count", url)
         return ""
     return review_count
 
 
-def get_book_image_url(soup):
+def get_book_image_url(soup, url):
     """
     Extracts image url for this book
     :param soup: soup object
+    :param url: url of current page (for logging)
     :return: book image url in string
     """
     try:
         image_url_tag = soup.find("img", id="coverImage")
         image_url = image_url_tag["src"]
     except:
-        LOG_FILE.write("Error getting book image url at: " + CURR_URL + "\n")
+        LOG.error("Error getting book image url", url)
         return ""
     return image_url
 
 
-def get_similar_books(soup):
+def get_similar_books(soup, url):
     """
     Extracts similar books' urls
     :param soup: soup object
+    :param url: url of current page (for logging)
     :return: list of urls of similar books
     """
     try:
         related_work_tag = soup.find("div", id=re.compile("^relatedWorks"))
         similar_books_tags = related_work_tag.find_all("li", class_="cover")
     except:
-        LOG_FILE.write("Error getting similar books at: " + CURR_URL + "\n")
+        LOG.error("Error getting similar books", url)
         return []
     similar_books = []
 
     for tag in similar_books_tags:
         img_tag = tag.find("img")
         url_tag = img_tag.parent
-        url = url_tag["href"]
+        book_url = url_tag["href"]
+        settings.books.discover(book_url)  # new book if not seen yet
 
-        book = get_book_by_url(url)
-        if book is None:
-            book = {"book_url": url}  # create new book object if doesn't exist yet
-            settings.books.append(book)  # Add new book to settings.books
-
-        similar_books.append(url)
+        similar_books.append(book_url)
 
     return similar_books
 
 
 def get_book_by_url(url):
     """
-    Gets url of book from settings.book
+    Gets book with the given url from settings.books
     :param url: url of book
     :return: book object if exists, None otherwise
     """
-    for book in settings.books:
-        if book["book_url"] == url:
-            return book
-    return None
+    return settings.books.get(url)
 
 
-def get_author(soup):
+def get_author(soup, url):
     """
     Extracts and processes book's author and author_url
     :param soup:
+    :param url: url of current page (for logging)
     :return: list of authors (could have more than one author)
     """
     author_names = []
@@ -238,16 +287,17 @@ def get_author(soup):
             author_name = tag.contents[0]
             author_names.append(author_name)
     except:
-        LOG_FILE.write("Error getting author at: " + CURR_URL + "\n")
+        LOG.error("Error getting author", url)
         return ""
     return author_names
 
 
-def get_author_url(soup):
+def get_author_url(soup, url):
     """
     Extracts author urls from current book page
     Corresponds to entries in the author_names list
     :param soup: soup object
+    :param url: url of current page (for logging)
     :return: list of urls corresponding to authors in the list of authors
     """
     try:
@@ -255,10 +305,10 @@ def get_author_url(soup):
         url_tags = soup.find_all("a", class_="authorName")
 
         for tag in url_tags:
-            url = tag["href"]
-            author_urls.append(url)
+            author_url = tag["href"]
+            author_urls.append(author_url)
     except:
-        LOG_FILE.write("Error getting  at: " + CURR_URL + "\n")
+        LOG.error("Error getting author url", url)
         return ""
 
     return author_urls
@@ -273,40 +323,63 @@ def update_authors(names, author_urls):
     """
     for i in range(0, len(names)):
         name = names[i]
-        if if_new_author(name):
-            new_author = {"name": name, "author_url": author_urls[i]}
-            settings.authors.append(new_author)
+        if not settings.authors.known(author_urls[i]) and if_new_author(name):
+            settings.authors.discover(author_urls[i], name=name)
 
 
 def if_new_author(name):
     """
     Checks if the author is new (not in the authors list already)
     :param name: name of author
-    :return: True if author exists in list, False otherwise
+    :return: False if author exists in list, True otherwise
     """
-    for author in settings.authors:
-        if name == author["name"]:
-            return False
-    return True
+    return not settings.authors.known_name(name)
 
 
-def scrape_n_books(num_books, start_url, real_time_update):
+def scrape_n_books(num_books, start_url, real_time_update, workers=1, rate=None,
+                   output=None, frontier=None, parse_pool=None):
     """
     Scrapes info of num_books books and their authors
+    Pages are downloaded by a pool of workers, but parsed in discovery order
+    so the results are the same as a sequential crawl
     Updates db after every scraping if real_time_update is on
     :param num_books: number of books to be scraped
     :param start_url: url to start scraping from
     :param real_time_update: whether or not to update db after every scrape
-    """
-    global CURR_URL # keeps track of current url
-    CURR_URL = ""
-    global REAL_TIME
-    REAL_TIME = real_time_update
-
-    url = start_url
-    index = 0
-    # keep scraping until num books have been scraped
-    while index < num_books:
-        scrape_one_book(url)
-        index += 1
-        url = get_next_book_url(index)
+    :param workers: number of pages downloaded at the same time
+    :param rate: max requests per second per host (None for no limit)
+    :param output: function(book) called with every scraped book, e.g. NdjsonWriter.write
+    :param frontier: Frontier recording the crawl, books it has as done are skipped
+    :param parse_pool: ParsePool to extract pages in, None to extract in the fetch threads
+    """
+    settings.books.discover(start_url)
+
+    def next_url(index):
+        book = settings.books.at(index)
+        if book is not None:
+            return book["book_url"]
+        return None  # frontier exhausted (for now)
+
+    def fetch(url):
+        if frontier is not None:
+            frontier.mark_in_flight("books", url)
+        return fetch_and_extract_book(url, parse_pool)
+
+    def process(index, url, page):
+        METRICS.incr("pages_fetched" if page is not None else "fetch_errors", kind="book")
+        with METRICS.timer("merge", kind="book"):
+            book = merge_book(url, page, real_time_update)
+        METRICS.set_gauge("frontier_depth",
+                          len(settings.books) + settings.books.pending() - index - 1, kind="book")
+        if book is not None and output is not None:
+            output(book)
+        if frontier is not None:
+            if book is None:
+                frontier.mark_failed("books", url)
+            else:
+                frontier.mark_done("books", book)
+
+    def skip(index):
+        return frontier is not None and frontier.is_done("books", get_next_book_url(index))
+
+    crawl(next_url, num_books, fetch, process, workers, rate, skip)
@@ -0,0 +1,351 @@
+"""
+This module defines the seen set of the books and authors registries, so pages
+that were discovered but not crawled yet need no registry records
+SeenSet is a scalable Bloom filter in a memory-mapped file: every stage is a bit
+array sized for its capacity and false positive rate, a full stage is followed by
+one twice as large with half the rate, so the overall rate stays below
+error_rate / (1 - tightening) however many urls are added
+Discovered puts it in front of the on-disk queue of the frontier: a negative
+answer is exact, a positive one is checked against the database, which counts
+the false positives
+The file is kept across runs, a resumed crawl reopens it instead of rehashing
+every url (it is rebuilt from the frontier if it is missing)
+"""
+import argparse
+import hashlib
+import json
+import math
+import mmap
+import os
+import re
+import tempfile
+import tracemalloc
+
+from registry import canonical_id
+
+MAGIC = b"GRSEEN01"
+HEADER_SIZE = 4096  # magic, then the json header padded with spaces
+NAME_PREFIX = "name:"  # names share the filter with the canonical ids
+
+
+class SeenSet:
+    """
+    Scalable Bloom filter of strings (canonical ids) backed by a memory-mapped file
+    Not thread safe, like the registries it is used by
+    """
+
+    def __init__(self, path, capacity=1_000_000, error_rate=0.001, growth=2, tightening=0.5):
+        """
+        Opens the filter at path, creates it if it doesn't exist
+        The parameters of an existing filter are the ones it was created with
+        :param path: path of the file
+        :param capacity: number of keys of the first stage
+        :param error_rate: false positive rate of the first stage
+        :param growth: capacity of a stage / capacity of the previous stage
+        :param tightening: false positive rate of a stage / rate of the previous stage
+        """
+        self.path = path
+        if not os.path.exists(path) or os.path.getsize(path) < HEADER_SIZE:
+            self.header = {"capacity": capacity, "error_rate": error_rate, "growth": growth,
+                           "tightening": tightening, "stages": [], "false_positives": 0,
+                           "positives": 0}
+            with open(path, "wb") as file:
+                file.truncate(HEADER_SIZE)
+            self.mmap = self.map()
+            self.add_stage()
+        else:
+            self.mmap = self.map()
+            if self.mmap[:len(MAGIC)] != MAGIC:
+                self.mmap.close()
+                raise ValueError("%s is not a seen set" % path)
+            self.header = json.loads(self.mmap[len(MAGIC):HEADER_SIZE])
+
+    def map(self):
+        with open(self.path, "r+b") as file:
+            return mmap.mmap(file.fileno(), 0)
+
+    @property
+    def stages(self):
+        return self.header["stages"]
+
+    def add_stage(self):
+        """
+        Appends an empty stage to the file, larger and stricter than the last one
+        """
+        number = len(self.stages)
+        capacity = int(self.header["capacity"] * self.header["growth"] ** number)
+        error_rate = self.header["error_rate"] * self.header["tightening"] ** number
+        bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        bits += -bits % 64  # whole 8 byte words
+        offset = HEADER_SIZE + sum(stage["bits"] // 8 for stage in self.stages)
+        self.stages.append({"offset": offset, "bits": bits, "capacity": capacity,
+                            "hashes": max(1, round(bits / capacity * math.log(2))),
+                            "count": 0})
+        self.mmap.close()
+        with open(self.path, "r+b") as file:
+            file.truncate(offset + bits // 8)  # zero filled
+        self.mmap = self.map()
+        self.flush()
+
+    def positions(self, stage, key):
+        """
+        Bits of key in a stage (double hashing of a 128 bit blake2b digest)
+        """
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        bits = stage["bits"]
+        return [(first + i * second) % bits for i in range(stage["hashes"])]
+
+    def stage_contains(self, stage, key):
+        offset = stage["offset"]
+        for position in self.positions(stage, key):
+            if not self.mmap[offset + (position >> 3)] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __contains__(self, key):
+        """
+        :param key: string
+        :return: False if key was never added, True if it was or (rarely) if it wasn't
+        """
+        return any(self.stage_contains(stage, key) for stage in self.stages)
+
+    def add(self, key):
+        """
+        Adds a key
+        :param key: string
+        :return: True if the key was new to the filter, False if it (maybe) was in it
+        """
+        if key in self:
+            return False
+        stage = self.stages[-1]
+        if stage["count"] >= stage["capacity"]:
+            self.add_stage()
+            stage = self.stages[-1]
+        offset = stage["offset"]
+        for position in self.positions(stage, key):
+            self.mmap[offset + (position >> 3)] |= 1 << (position & 7)
+        stage["count"] += 1
+        return True
+
+    def record_check(self, found):
+        """
+        Records the exact check of a positive answer
+        :param found: whether the key really was there, False for a false positive
+        """
+        self.header["positives"] += 1
+        if not found:
+            self.header["false_positives"] += 1
+
+    def __len__(self):
+        return sum(stage["count"] for stage in self.stages)
+
+    def expected_error_rate(self):
+        """
+        :return: false positive rate expected from the fill of the stages
+        """
+        negative = 1.0
+        for stage in self.stages:
+            fill = 1 - math.exp(-stage["hashes"] * stage["count"] / stage["bits"])
+            negative *= 1 - fill ** stage["hashes"]
+        return 1 - negative
+
+    def stats(self):
+        """
+        :return: dict of number of keys, stages, size, expected false positive rate,
+            checked positives, false positives found by the exact checks and their
+            rate among the new keys
+        """
+        return {"keys": len(self), "stages": len(self.stages),
+                "bytes": len(self.mmap), "expected_error_rate": self.expected_error_rate(),
+                "positives": self.header["positives"],
+                "false_positives": self.header["false_positives"],
+                "false_positive_rate": self.header["false_positives"]
+                / max(1, len(self) + self.header["false_positives"])}
+
+    def flush(self):
+        """
+        Writes the header and the bits to the file
+        """
+        header = json.dumps(self.header).encode("utf-8")
+        if len(MAGIC) + len(header) > HEADER_SIZE:
+            raise ValueError("too many stages for the header of %s" % self.path)
+        self.mmap[:HEADER_SIZE] = (MAGIC + header).ljust(HEADER_SIZE)
+        self.mmap.flush()
+
+    def clear(self):
+        """
+        Removes every key, keeps the parameters
+        """
+        self.header.update(stages=[], false_positives=0, positives=0)
+        self.mmap.close()
+        with open(self.path, "r+b") as file:
+            file.truncate(HEADER_SIZE)
+        self.mmap = self.map()
+        self.add_stage()
+
+    def close(self):
+        self.flush()
+        self.mmap.close()
+
+
+class Discovered:
+    """
+    Pages of one kind that were discovered but not crawled yet, kept out of memory:
+    their canonical ids and names in a SeenSet, their records queued in the frontier
+    (see Registry.discover and Registry.at)
+    """
+
+    def __init__(self, kind, seen, frontier):
+        """
+        :param kind: "books" or "authors"
+        :param seen: SeenSet of the canonical ids and names of the pages of kind
+        :param frontier: frontier.Frontier with queue, the queue and the exact checks
+        """
+        self.kind = kind
+        self.seen = seen
+        self.frontier = frontier
+
+    def known(self, url):
+        """
+        :param url: url of book or author
+        :return: True if a page with the same canonical id was pushed
+        """
+        id_ = canonical_id(url)
+        if id_ not in self.seen:
+            return False  # never seen, no false negatives
+        found = self.frontier.has(self.kind, url)  # exact check of the positive
+        self.seen.record_check(found)
+        return found
+
+    def known_name(self, name):
+        """
+        :param name: name key (see registry._name_key)
+        :return: True if a page with that name was pushed
+        """
+        if NAME_PREFIX + name not in self.seen:
+            return False
+        found = self.frontier.has_name(self.kind, name)
+        self.seen.record_check(found)
+        return found
+
+    def push(self, record, name=None):
+        """
+        Queues a page that is not known yet
+        :param record: record of the page (its url and the fields known so far)
+        :param name: name key of the page, None for none
+        """
+        self.seen.add(canonical_id(record[self.frontier.registries[self.kind].url_key]))
+        if name is not None:
+            self.seen.add(NAME_PREFIX + name)
+        self.frontier.push(self.kind, record, name)
+
+    def pop(self):
+        """
+        :return: record (dict) of the next queued page, None if there is none
+        """
+        return self.frontier.pop(self.kind)
+
+    def remaining(self):
+        """
+        :return: iterator of the records (dicts) still queued, in discovery order
+        """
+        return self.frontier.queued(self.kind)
+
+    def __len__(self):
+        return self.frontier.count_queued(self.kind)
+
+    def rebuild(self):
+        """
+        Adds the canonical ids and names of the frontier to the seen set, e.g. when
+        its file was lost
+        """
+        for id_, name in self.frontier.keys(self.kind):
+            self.seen.add(id_ if name is None else NAME_PREFIX + name)
+
+
+def measure_memory(books, authors, copies=1):
+    """
+    Measures the memory held by the registries of a crawl that scraped the records
+    of books and authors that have scraped fields, the others being discovered only:
+    dict and compact records, then with the discovered pages in a seen set and the
+    frontier queue (dict and compact records)
+    Every copy gets other ids, like a crawl copies times as large
+    The bits of the seen sets are in mapped files, not on the heap, their size is
+    given apart
+    :param books: list of book dicts
+    :param authors: list of author dicts
+    :param copies: number of copies of the records
+    :return: dict of mode -> bytes on the heap, and "seen_file" -> bytes of the seen sets
+    """
+    from frontier import Frontier
+    from registry import Registry
+    from store import compact_record_types
+
+    show = re.compile("/show/([0-9]+)")
+
+    def copy(value, n):
+        if isinstance(value, str):
+            return show.sub(lambda match: "/show/%d0%s" % (n, match.group(1)), value)
+        if isinstance(value, list):
+            return [copy(item, n) for item in value]
+        return value
+
+    results = {}
+    for mode in ("dict", "compact", "seen", "seen_compact"):
+        directory = tempfile.mkdtemp()
+        tracemalloc.start()
+        types = compact_record_types() if mode.endswith("compact") else (dict, dict)
+        registries = {"books": Registry("book_url", types[0]),
+                      "authors": Registry("author_url", types[1])}
+        frontier = None
+        if mode.startswith("seen"):
+            frontier = Frontier(registries, os.path.join(directory, "frontier.db"), queue=True)
+            for kind, registry in registries.items():
+                registry.discovered = Discovered(
+                    kind, SeenSet(os.path.join(directory, kind + ".bloom"), 100_000), frontier)
+        for n in range(1, copies + 1):
+            for (kind, registry), records in zip(registries.items(), (books, authors)):
+                scraped = "title" if kind == "books" else "author_id"
+                for record in records:
+                    record = {key: copy(value, n) for key, value in record.items()}
+                    if scraped in record or frontier is None:
+                        registry.append(record)
+                    else:
+                        url = record.pop(registry.url_key)
+                        registry.discover(url, **record)
+        if frontier is not None:
+            frontier.checkpoint()
+        results[mode] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        if frontier is not None:
+            results["seen_file"] = sum(len(registry.discovered.seen.mmap)
+                                       for registry in registries.values())
+            for registry in registries.values():
+                registry.discovered.seen.close()
+            frontier.close()
+        del registries, types, frontier
+    return results
+
+
+if __name__ == "__main__":
+    curr_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(
+        description="memory used by registries with and without a seen set")
+    parser.add_argument("--copies", type=int, default=10,
+                        help="number of copies of data/books.json and data/authors.json")
+    args = parser.parse_args()
+    with open(os.path.join(curr_dir, "data", "books.json")) as file:
+        book_records = json.load(file)
+    with open(os.path.join(curr_dir, "data", "authors.json")) as file:
+        author_records = json.load(file)
+    sizes = measure_memory(book_records, author_records, args.copies)
+    count = (len(book_records) + len(author_records)) * args.copies
+    for mode in ("dict", "compact", "seen", "seen_compact"):
+        print("%-13s %8.1f MB  %6d bytes/record  %.2f of dict" % (
+            mode, sizes[mode] / 2 ** 20, sizes[mode] / count, sizes[mode] / sizes["dict"]))
+    discovered = (sum("title" not in book for book in book_records)
+                  + sum("author_id" not in author for author in author_records)) * args.copies
+    print("%d of %d records discovered only, seen set files: %.1f MB mapped" % (
+        discovered, count, sizes["seen_file"] / 2 ** 20))
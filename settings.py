@@ -1,5 +1,59 @@
-def init():
-    global books # list stores all books
-    global authors # list stores all authors
-    books = []
-    authors = []
\ No newline at end of file
+"""
+This module holds the books and authors registries the scrapers work on
+settings.books and settings.authors are the registries of the running
+engine.Scraper (see use_registries), or else the ones created by init()
+"""
+import contextvars
+
+from registry import Registry
+from store import compact_record_types
+
+_registries = contextvars.ContextVar("registries", default=None)  # (books, authors)
+_default = None  # (books, authors) of the last init()
+
+
+def make_registries(compact=False):
+    """
+    :param compact: whether to keep records as store.CompactRecord instead of dicts
+        (with their own url Interner)
+    :return: new (books, authors) registries
+    """
+    book_type, author_type = compact_record_types() if compact else (dict, dict)
+    return Registry("book_url", book_type), Registry("author_url", author_type)
+
+
+def init(compact=False):
+    """
+    :param compact: whether to keep records as store.CompactRecord instead of dicts
+    """
+    global _default
+    _default = make_registries(compact)
+    _registries.set(_default)
+
+
+def use_registries(books, authors):
+    """
+    Makes settings.books and settings.authors refer to the given registries in
+    the current context (thread, or contextvars.Context), e.g. while a Scraper runs
+    :param books: books Registry
+    :param authors: authors Registry
+    :return: token for reset_registries
+    """
+    return _registries.set((books, authors))
+
+
+def reset_registries(token):
+    """
+    Undoes use_registries
+    :param token: token returned by use_registries
+    """
+    _registries.reset(token)
+
+
+def __getattr__(name):
+    if name not in ("books", "authors"):
+        raise AttributeError("module 'settings' has no attribute %r" % name)
+    registries = _registries.get() or _default
+    if registries is None:
+        raise AttributeError("settings.%s is not set, call settings.init() first" % name)
+    return registries[0] if name == "books" else registries[1]
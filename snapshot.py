@@ -0,0 +1,367 @@
+"""
+This module defines the snapshot format of books and authors, for lookups by id
+without loading a whole data/*.json file
+A snapshot is two files:
+- <name>.snap: the records as ndjson, sorted by book_id/author_id and cut into
+  blocks of about block_bytes, every block compressed on its own (zstd, or gzip
+  when zstandard is not installed)
+- <name>.snap.idx: a header, the file offset of every block and the sorted ids
+  with the (block, offset in the block) of their record, as fixed size arrays
+  that are memory-mapped and binary searched
+Records whose id is not numeric (or that have no id) are stored after the
+sorted ones and listed in the header. The position of every record in the
+source file is kept, so snapshot_to_json gives back the data_to_json output
+Run as a script to build, query or convert snapshots
+"""
+import argparse
+import bisect
+import gzip
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from db import KEYS, URL_KEYS, iter_json_records, write_json_items
+from registry import canonical_id
+from store import to_dict
+
+try:
+    import zstandard  # optional, smaller and faster blocks than gzip
+except ImportError:
+    zstandard = None
+
+curr_dir = os.path.dirname(os.path.abspath(__file__))
+SOURCES = {kind: os.path.join(curr_dir, "data", kind + ".json") for kind in KEYS}
+SNAPSHOTS = {kind: os.path.join(curr_dir, "data", kind + ".snap") for kind in KEYS}
+MAGIC = b"GRSNAP01"
+MAX_KEY = 2 ** 64 - 1  # ids are stored as unsigned 64 bit integers
+
+
+def index_path(path):
+    """
+    :return: path of the index file of the snapshot at path
+    """
+    return path + ".idx"
+
+
+def compress(data, codec):
+    if codec == "zstd":
+        require_zstandard()
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return gzip.compress(data, compresslevel=6, mtime=0)
+
+
+def decompress(data, codec):
+    if codec == "zstd":
+        require_zstandard()
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def require_zstandard():
+    if zstandard is None:
+        raise ImportError("zstd snapshots need zstandard, pip install zstandard")
+
+
+def record_key(record, kind):
+    """
+    :param record: record as dict
+    :param kind: "books" or "authors"
+    :return: (numeric id or None, id as string or None), the id of a record
+        without book_id/author_id is the canonical id of its url
+    """
+    id_ = record.get(KEYS[kind])
+    if not id_ and record.get(URL_KEYS[kind]):
+        id_ = canonical_id(record[URL_KEYS[kind]])
+    if not id_:
+        return None, None
+    id_ = str(id_)
+    if id_.isdigit() and int(id_) <= MAX_KEY:
+        return int(id_), id_
+    return None, id_
+
+
+def write_snapshot(path, records, kind, block_bytes=64 * 1024, codec=None):
+    """
+    Writes records into a snapshot
+    The records are sorted in memory (as compact json lines), both files are
+    written to temporary files that replace the previous snapshot once complete
+    :param path: path of the snapshot, the index goes to path + ".idx"
+    :param records: iterable of records
+    :param kind: "books" or "authors"
+    :param block_bytes: uncompressed size of a block, smaller blocks make lookups
+        faster and compression worse
+    :param codec: "zstd" or "gzip", None for zstd when zstandard is installed
+    :return: number of records written
+    """
+    codec = codec or ("zstd" if zstandard is not None else "gzip")
+    if codec not in ("zstd", "gzip"):
+        raise ValueError("unknown codec %r" % codec)
+    sorted_lines = []  # (numeric id, position, json line)
+    other_lines = []  # (id or None, position, json line)
+    for position, record in enumerate(records):
+        record = to_dict(record)
+        key, id_ = record_key(record, kind)
+        line = json.dumps(record).encode("utf-8") + b"\n"
+        if key is None:
+            other_lines.append((id_, position, line))
+        else:
+            sorted_lines.append((key, position, line))
+    sorted_lines.sort(key=lambda item: item[:2])
+
+    block_offsets = array("Q", [0])
+    keys, positions, blocks, offsets = array("Q"), array("I"), array("I"), array("I")
+    others = []  # [id, block, offset, position]
+    buffer = bytearray()
+    with open(path + ".tmp", "wb") as data_file:
+        def flush():
+            data_file.write(compress(bytes(buffer), codec))
+            block_offsets.append(data_file.tell())
+            buffer.clear()
+
+        for key, position, line in sorted_lines:
+            keys.append(key)
+            positions.append(position)
+            blocks.append(len(block_offsets) - 1)
+            offsets.append(len(buffer))
+            buffer += line
+            if len(buffer) >= block_bytes:
+                flush()
+        for id_, position, line in other_lines:
+            others.append([id_, len(block_offsets) - 1, len(buffer), position])
+            buffer += line
+            if len(buffer) >= block_bytes:
+                flush()
+        if buffer:
+            flush()
+
+    header = json.dumps({"kind": kind, "codec": codec, "byteorder": sys.byteorder,
+                         "records": len(keys), "blocks": len(block_offsets) - 1,
+                         "others": others}).encode("utf-8")
+    with open(index_path(path) + ".tmp", "wb") as index_file:
+        index_file.write(MAGIC + struct.pack("<I", len(header)) + header)
+        index_file.write(b"\0" * (-index_file.tell() % 8))  # 8 byte aligned arrays
+        for values in (block_offsets, keys, positions, blocks, offsets):
+            values.tofile(index_file)
+    os.replace(path + ".tmp", path)
+    os.replace(index_path(path) + ".tmp", index_path(path))
+    return len(keys) + len(others)
+
+
+class Snapshot:
+    """
+    Reader of a snapshot
+    The index is memory-mapped, a lookup is a binary search of the ids followed
+    by the decompression of one block. The last block read is kept, so scans
+    decompress every block once
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the snapshot (not of its index)
+        """
+        self.path = path
+        with open(index_path(path), "rb") as index_file:
+            self.mmap = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(MAGIC)] != MAGIC:
+            self.mmap.close()
+            raise ValueError("%s is not a snapshot index" % index_path(path))
+        start = len(MAGIC) + 4
+        header_size = struct.unpack_from("<I", self.mmap, len(MAGIC))[0]
+        self.header = json.loads(self.mmap[start:start + header_size])
+        if self.header["byteorder"] != sys.byteorder:
+            self.mmap.close()
+            raise ValueError("%s was written on a %s endian machine"
+                             % (index_path(path), self.header["byteorder"]))
+        self.kind = self.header["kind"]
+        self.codec = self.header["codec"]
+        self.others = {id_: (block, offset) for id_, block, offset, _ in
+                       reversed(self.header["others"]) if id_ is not None}
+        # zero copy views of the arrays
+        self.views = []
+        position = start + header_size + (-(start + header_size) % 8)
+        count = self.header["records"]
+        for name, code, size, length in (("block_offsets", "Q", 8, self.header["blocks"] + 1),
+                                         ("keys", "Q", 8, count), ("positions", "I", 4, count),
+                                         ("blocks", "I", 4, count), ("offsets", "I", 4, count)):
+            view = memoryview(self.mmap)[position:position + size * length]
+            self.views.append(view)
+            self.views.append(view.cast(code))
+            setattr(self, name, self.views[-1])
+            position += size * length
+        self.data_file = open(path, "rb")
+        self.block = (None, b"")  # (number, data) of the last block read
+
+    def __len__(self):
+        return self.header["records"] + len(self.header["others"])
+
+    def read_block(self, number):
+        """
+        :param number: number of the block
+        :return: decompressed block
+        """
+        if self.block[0] != number:
+            start, end = self.block_offsets[number], self.block_offsets[number + 1]
+            self.data_file.seek(start)
+            self.block = (number, decompress(self.data_file.read(end - start), self.codec))
+        return self.block[1]
+
+    def read_record(self, block, offset):
+        data = self.read_block(block)
+        return json.loads(data[offset:data.index(b"\n", offset)])
+
+    def get(self, id_):
+        """
+        :param id_: book_id/author_id (int or str)
+        :return: record with this id (the first one if there are several), None if missing
+        """
+        id_ = str(id_)
+        if not (id_.isdigit() and int(id_) <= MAX_KEY):
+            location = self.others.get(id_)
+            return self.read_record(*location) if location else None
+        index = bisect.bisect_left(self.keys, int(id_))
+        if index == len(self.keys) or self.keys[index] != int(id_):
+            return None
+        return self.read_record(self.blocks[index], self.offsets[index])
+
+    def __contains__(self, id_):
+        return self.get(id_) is not None
+
+    def scan(self, start=None, stop=None):
+        """
+        Yields the records with a numeric id in [start, stop), by increasing id
+        :param start: first id (int or str), None to start from the smallest id
+        :param stop: id to stop at (excluded), None to go to the largest id
+        :return: generator of dicts
+        """
+        low = 0 if start is None else bisect.bisect_left(self.keys, int(start))
+        high = len(self.keys) if stop is None else bisect.bisect_left(self.keys, int(stop))
+        for index in range(low, high):
+            yield self.read_record(self.blocks[index], self.offsets[index])
+
+    def ids(self):
+        """
+        :return: generator of the numeric ids (as strings), sorted, without reading blocks
+        """
+        return (str(key) for key in self.keys)
+
+    def __iter__(self):
+        """
+        Yields every record, by increasing id, then the ones without a numeric id
+        """
+        yield from self.scan()
+        for _, block, offset, _ in self.header["others"]:
+            yield self.read_record(block, offset)
+
+    def iter_lines(self):
+        """
+        Yields (position in the source file, json line) of every record, in file order
+        """
+        count = self.header["records"]
+        positions = list(self.positions) + [other[3] for other in self.header["others"]]
+        index = 0
+        for number in range(self.header["blocks"]):
+            for line in self.read_block(number).splitlines():
+                yield positions[index], line
+                index += 1
+        if index != count + len(self.header["others"]):
+            raise ValueError("%s doesn't match its index" % self.path)
+
+    def close(self):
+        self.data_file.close()
+        for view in reversed(self.views):
+            view.release()
+        self.views = []
+        self.mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def json_to_snapshot(json_file, path, kind, **options):
+    """
+    Converts a json or ndjson file (data_to_json/data_to_ndjson output) into a snapshot
+    :param json_file: path of the file, read one record at a time
+    :param path: path of the snapshot
+    :param kind: "books" or "authors"
+    :param options: block_bytes and codec of write_snapshot
+    :return: number of records
+    """
+    return write_snapshot(path, iter_json_records(json_file), kind, **options)
+
+
+def snapshot_to_json(path, json_file):
+    """
+    Converts a snapshot back into a json file, the records in their original order
+    The file is the same as the one the snapshot was made from with data_to_json
+    :param path: path of the snapshot
+    :param json_file: path of the json file, replaced once complete
+    :return: number of records
+    """
+    with Snapshot(path) as snapshot:
+        lines = [None] * len(snapshot)
+        for position, line in snapshot.iter_lines():
+            lines[position] = line
+    with open(json_file + ".tmp", "w+") as write_file:
+        if not lines:
+            write_file.write("[]")
+        else:
+            write_file.write("[\n")
+            write_json_items(write_file, (json.loads(line) for line in lines))
+            write_file.write("\n]")
+    os.replace(json_file + ".tmp", json_file)
+    return len(lines)
+
+
+def get_args():
+    """
+    Gets command line inputs from user
+    """
+    parser = argparse.ArgumentParser(description="builds and reads snapshots of data/*.json")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="convert data/<kind>.json into data/<kind>.snap")
+    build.add_argument("--kinds", nargs="+", choices=list(KEYS), default=list(KEYS),
+                       help="collections to convert (default: both)")
+    build.add_argument("--codec", choices=["zstd", "gzip"], default=None,
+                       help="block compression (default: zstd if installed, else gzip)")
+    build.add_argument("--block_kb", type=int, default=64,
+                       help="uncompressed size of a block in KB (default: 64)")
+    get = commands.add_parser("get", help="print the records with the given ids")
+    get.add_argument("kind", choices=list(KEYS))
+    get.add_argument("ids", nargs="+")
+    get.set_defaults(limit=None)
+    scan = commands.add_parser("scan", help="print the records with ids in [start, stop)")
+    scan.add_argument("kind", choices=list(KEYS))
+    scan.add_argument("--start", type=int, default=None, help="first id (default: smallest)")
+    scan.add_argument("--stop", type=int, default=None, help="id to stop at (default: none)")
+    scan.add_argument("--limit", type=int, default=None, help="max number of records")
+    to_json = commands.add_parser("to_json", help="convert data/<kind>.snap into a json file")
+    to_json.add_argument("kind", choices=list(KEYS))
+    to_json.add_argument("json_file", help="path of the json file to write")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_args()
+    if args.command == "build":
+        for name in args.kinds:
+            print("%s: %d records" % (name, json_to_snapshot(
+                SOURCES[name], SNAPSHOTS[name], name, block_bytes=args.block_kb * 1024,
+                codec=args.codec)))
+    elif args.command == "to_json":
+        print("%d records" % snapshot_to_json(SNAPSHOTS[args.kind], args.json_file))
+    else:
+        with Snapshot(SNAPSHOTS[args.kind]) as reader:
+            if args.command == "get":
+                found = (reader.get(record_id) for record_id in args.ids)
+            else:
+                found = reader.scan(args.start, args.stop)
+            for number, found_record in enumerate(found):
+                if args.limit is not None and number >= args.limit:
+                    break
+                print(json.dumps(found_record))
@@ -0,0 +1,306 @@
+"""
+This module defines the compact records of the books and authors registries
+Urls are interned into integer ids, url lists are stored as array('I') and
+numeric strings (rating, rating_count, review_count) are parsed once, records
+use __slots__ and read like the usual dicts (the scraped strings), the parsed
+numbers are read with CompactRecord.number
+Every pair of registries (see compact_record_types) has its own Interner, which
+is freed with them
+Run as a script to compare the memory used by dict and compact registries
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import tracemalloc
+from array import array
+from collections.abc import MutableMapping
+
+NUMBER = re.compile("(0|[1-9][0-9]*)(\\.[0-9]+)?$")
+
+
+class Interner:
+    """
+    Two way mapping between urls and integer ids
+    """
+
+    def __init__(self):
+        self.ids = {}  # url -> id
+        self.urls = []  # id -> url
+
+    def __len__(self):
+        return len(self.urls)
+
+    def intern(self, url):
+        """
+        :param url: url as string
+        :return: id of url, a new id the first time url is seen
+        """
+        id_ = self.ids.get(url)
+        if id_ is None:
+            id_ = self.ids[url] = len(self.urls)
+            self.urls.append(url)
+        return id_
+
+    def lookup(self, id_):
+        """
+        :param id_: id returned by intern
+        :return: url as string
+        """
+        return self.urls[id_]
+
+
+def pack_url(urls, value):
+    return urls.intern(value) if isinstance(value, str) else value
+
+
+def unpack_url(urls, value):
+    return urls.lookup(value) if isinstance(value, int) else value
+
+
+def pack_urls(urls, value):
+    if isinstance(value, list) and all(isinstance(url, str) for url in value):
+        return array("I", [urls.intern(url) for url in value])
+    return value  # e.g. "" when the field couldn't be extracted
+
+
+def unpack_urls(urls, value):
+    return [urls.lookup(id_) for id_ in value] if isinstance(value, array) else value
+
+
+def pack_number(urls, value):
+    """
+    Parses a numeric string if it can be given back unchanged, e.g. "4.57" or "2422944"
+    (but not "4.50", "" or "1,234", which are kept as strings)
+    """
+    if isinstance(value, str) and NUMBER.match(value):
+        number = float(value) if "." in value else int(value)
+        if str(number) == value:
+            return number
+    return value
+
+
+def unpack_number(urls, value):
+    return str(value) if isinstance(value, (int, float)) else value
+
+
+def pack_text(urls, value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def unpack_value(urls, value):
+    return value
+
+
+# codec name -> (pack, unpack), called with the Interner of the record type
+CODECS = {
+    "url": (pack_url, unpack_url),
+    "urls": (pack_urls, unpack_urls),
+    "number": (pack_number, unpack_number),
+    "text": (pack_text, unpack_value),
+    "value": (unpack_value, unpack_value),
+}
+
+
+class CompactRecord(MutableMapping):
+    """
+    Record that stores the fields of FIELDS in slots, packed by their codec
+    Behaves like the dict records (same keys, same values, fields in FIELDS order
+    followed by any other key), the scraped values are assumed to be strings like
+    the extractors return, numbers are given back as strings (see number)
+    """
+    FIELDS = ()  # (field, codec name), in the key order of the dict records
+    URLS = None  # Interner of the urls of the records of this type
+    __slots__ = ("extra",)
+
+    def __init__(self, fields=()):
+        """
+        :param fields: dict of field -> value to start with
+        """
+        self.extra = None  # keys not in FIELDS
+        self.update(fields)
+
+    def __getitem__(self, key):
+        codec = self.CODECS.get(key)
+        if codec is None:
+            if self.extra is None:
+                raise KeyError(key)
+            return self.extra[key]
+        try:
+            value = getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+        return codec[1](self.URLS, value)
+
+    def __setitem__(self, key, value):
+        codec = self.CODECS.get(key)
+        if codec is None:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+        else:
+            setattr(self, key, codec[0](self.URLS, value))
+
+    def __delitem__(self, key):
+        if key in self.CODECS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self.extra is None:
+            raise KeyError(key)
+        else:
+            del self.extra[key]
+
+    def __iter__(self):
+        for key, _ in self.FIELDS:
+            if hasattr(self, key):
+                yield key
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, dict(self))
+
+    def number(self, key):
+        """
+        Gets a numeric field without converting it back to a string
+        :param key: rating, rating_count or review_count
+        :return: int or float, None if the field is missing or not a plain number
+        """
+        value = getattr(self, key, None) if key in self.CODECS else None
+        return value if isinstance(value, (int, float)) else None
+
+
+def compact_record_type(name, fields, urls=None):
+    """
+    Creates a CompactRecord subclass with one slot per field
+    :param name: name of the class
+    :param fields: list of (field, codec name), in key order
+    :param urls: Interner of the urls, None for a new one
+    :return: the class
+    """
+    return type(name, (CompactRecord,), {
+        "FIELDS": tuple(fields),
+        "CODECS": {field: CODECS[codec] for field, codec in fields},
+        "URLS": urls if urls is not None else Interner(),
+        "__slots__": tuple(field for field, _ in fields),
+    })
+
+
+BOOK_FIELDS = [
+    ("book_url", "url"),
+    ("title", "value"),
+    ("book_id", "value"),
+    ("isbn", "value"),
+    ("author", "value"),
+    ("author_url", "urls"),
+    ("rating", "number"),
+    ("rating_count", "number"),
+    ("review_count", "number"),
+    ("image_url", "value"),
+    ("similar_books", "urls"),
+]
+AUTHOR_FIELDS = [
+    ("name", "text"),
+    ("author_url", "url"),
+    ("author_id", "value"),
+    ("rating", "number"),
+    ("rating_count", "number"),
+    ("review_count", "number"),
+    ("image_url", "value"),
+    ("related_authors", "urls"),
+    ("author_books", "urls"),
+]
+
+
+def compact_record_types():
+    """
+    Creates the record types of a pair of books and authors registries, which
+    share a new Interner
+    :return: (book record type, author record type)
+    """
+    urls = Interner()
+    return (compact_record_type("BookRecord", BOOK_FIELDS, urls),
+            compact_record_type("AuthorRecord", AUTHOR_FIELDS, urls))
+
+
+BookRecord, AuthorRecord = compact_record_types()  # for records outside registries
+
+
+def to_dict(record):
+    """
+    Gets a record in its exported shape (a plain json serializable dict)
+    :param record: dict or CompactRecord
+    :return: dict
+    """
+    return record if isinstance(record, dict) else dict(record)
+
+
+def number(record, key):
+    """
+    Gets a numeric field of a dict or compact record as a number
+    :param record: dict or CompactRecord
+    :param key: rating, rating_count or review_count
+    :return: int or float, None if the field is missing or not a plain number
+    """
+    if isinstance(record, CompactRecord):
+        return record.number(key)
+    value = pack_number(None, record.get(key))
+    return value if isinstance(value, (int, float)) else None
+
+
+def measure_memory(books, authors, copies=1):
+    """
+    Measures the memory held by registries of the given records, as dicts and compact
+    Every copy gets other ids, like a crawl copies times as large
+    :param books: list of book dicts
+    :param authors: list of author dicts
+    :param copies: number of copies of the records
+    :return: dict of "dict"/"compact" -> bytes
+    """
+    from registry import Registry
+
+    show = re.compile("/show/([0-9]+)")
+
+    def copy(value, n):
+        if isinstance(value, str):
+            return show.sub(lambda match: "/show/%d0%s" % (n, match.group(1)), value)
+        if isinstance(value, list):
+            return [copy(item, n) for item in value]
+        return value
+
+    results = {}
+    for mode in ("dict", "compact"):
+        tracemalloc.start()
+        types = (dict, dict) if mode == "dict" else compact_record_types()
+        registries = (Registry("book_url", types[0]), Registry("author_url", types[1]))
+        for n in range(1, copies + 1):
+            for registry, records in zip(registries, (books, authors)):
+                for record in records:
+                    registry.append({key: copy(value, n) for key, value in record.items()})
+        results[mode] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del registries, types
+    return results
+
+
+if __name__ == "__main__":
+    curr_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="memory used by dict and compact registries")
+    parser.add_argument("--copies", type=int, default=10,
+                        help="number of copies of data/books.json and data/authors.json")
+    args = parser.parse_args()
+    with open(os.path.join(curr_dir, "data", "books.json")) as file:
+        book_records = json.load(file)
+    with open(os.path.join(curr_dir, "data", "authors.json")) as file:
+        author_records = json.load(file)
+    sizes = measure_memory(book_records, author_records, args.copies)
+    count = (len(book_records) + len(author_records)) * args.copies
+    for mode, size in sizes.items():
+        print("%-8s %8.1f MB  %6d bytes/record" % (mode, size / 2 ** 20, size / count))
+    print("compact / dict: %.2f" % (sizes["compact"] / sizes["dict"]))
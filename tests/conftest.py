@@ -0,0 +1,7 @@
+"""
+The modules of the scraper are flat modules at the root of the repository
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,98 @@
+"""
+Records real goodreads pages into tests/fixtures/recorded, test_extract.py runs
+the parity of every engine with the original extractors on each of them
+Pages are fetched live, or copied from the page cache of a crawl run with --cache
+
+usage: python tests/record_pages.py [--cache data/cache] URL [URL ...]
+"""
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup  # noqa: E402
+
+from cache import PageCache  # noqa: E402
+from fetcher import Fetcher  # noqa: E402
+from registry import canonical_id  # noqa: E402
+
+RECORDED = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "recorded")
+NAMES = os.path.join(RECORDED, "names.json")
+
+
+def page_name(url):
+    """
+    :param url: url of a book or author page
+    :return: name of its fixture, e.g. book_1 or author_1077326
+    """
+    kind = "author" if "/author/show/" in url else "book"
+    return "%s_%s" % (kind, canonical_id(url))
+
+
+def author_name(html):
+    """
+    :param html: html of an author page
+    :return: name of the author, as the scrapers pass it to the extractors
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    span = soup.select_one("h1.authorName span[itemprop=name]") or soup.find("h1")
+    return span.get_text().strip() if span else ""
+
+
+def load_names():
+    """
+    :return: dict of fixture name -> name of the author of the recorded author pages
+    """
+    if not os.path.exists(NAMES):
+        return {}
+    with open(NAMES, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def record(urls, cache_path=None):
+    """
+    Saves the pages of urls, skips the ones not in the cache
+    :param urls: urls of book and author pages
+    :param cache_path: path of a page cache to copy the pages from, fetches them if None
+    :return: list of the saved fixture names
+    """
+    os.makedirs(RECORDED, exist_ok=True)
+    cache = PageCache(cache_path) if cache_path else None
+    fetcher = None if cache else Fetcher()
+    names = load_names()
+    saved = []
+    for url in urls:
+        if cache:
+            entry = cache.get(url)
+            if entry is None:
+                print("not cached: %s" % url)
+                continue
+            html = entry.html
+        else:
+            html = fetcher.fetch(url)
+        name = page_name(url)
+        with open(os.path.join(RECORDED, name + ".html"), "w", encoding="utf-8") as file:
+            file.write(html)
+        if name.startswith("author_"):
+            names[name] = author_name(html)
+        saved.append(name)
+    with open(NAMES, "w", encoding="utf-8") as file:
+        json.dump(names, file, indent=2, sort_keys=True)
+    if cache:
+        cache.close()
+    return saved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record goodreads pages as test fixtures")
+    parser.add_argument("urls", nargs="+", help="urls of book and author pages")
+    parser.add_argument("--cache", help="path of the page cache to copy the pages from")
+    args = parser.parse_args()
+    for name in record(args.urls, args.cache):
+        print("recorded %s" % name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""
+Tests of the columnar store of ratings (analytics.py)
+"""
+import pytest
+
+import analytics
+
+np = pytest.importorskip("numpy")
+
+BOOK_URL = "https://www.goodreads.com/book/show/%s"
+
+
+def test_author_aggregates_over_cached_links(tmp_path):
+    books = analytics.build_table([
+        {"book_id": "1", "rating": "4.00", "rating_count": "10", "review_count": "1"},
+        {"book_id": "2", "rating": "", "rating_count": "5", "review_count": "2"},
+        {"book_id": "10", "rating": "3.00", "rating_count": "1,000", "review_count": "3"},
+    ], "books")
+    authors = analytics.build_table([
+        {"author_id": "7", "author_books": [BOOK_URL % 1, BOOK_URL % 10, BOOK_URL % 99]},
+        {"author_id": "8", "author_books": [BOOK_URL % 2, BOOK_URL % 10]},
+        {"author_id": "9", "author_books": ""},
+    ], "authors")
+    authors.save(str(tmp_path / "authors"))
+    authors, _ = analytics.load_table(str(tmp_path / "authors"))
+    assert isinstance(authors.links[1], np.memmap)
+    assert list(authors.links[2]) == ["1", "10", "99", "2"]  # interned once
+    aggregates = analytics.author_aggregates(authors, books)
+    assert aggregates["books"].tolist() == [2, 2, 0]
+    assert aggregates["rated_books"].tolist() == [2, 1, 0]
+    assert aggregates["mean_rating"][:2].tolist() == [3.5, 3.0]
+    assert np.isnan(aggregates["mean_rating"][2])
+    assert aggregates["total_rating_count"].tolist() == [1010, 1005, 0]
+
+
+def test_cache_of_an_older_format_is_rebuilt(tmp_path):
+    (tmp_path / "meta.json").write_text('{"ids": [], "source": null, "links": []}')
+    assert analytics.load_table(str(tmp_path)) == (None, None)
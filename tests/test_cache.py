@@ -0,0 +1,46 @@
+"""
+Tests of the page cache (cache.py)
+"""
+import os
+import threading
+import time
+
+from cache import PageCache
+
+URL = "https://www.goodreads.com/book/show/%d"
+
+
+def test_put_and_evict_in_parallel(tmp_path):
+    cache = PageCache(str(tmp_path), max_bytes=0)  # evict() drops every page
+    errors = []
+    stop = threading.Event()
+
+    def put():
+        try:
+            while not stop.is_set():
+                for number in range(20):
+                    cache.put(URL % number, "<html>%d</html>" % (number % 3))
+        except Exception as error:
+            errors.append(error)
+
+    def evict():
+        try:
+            while not stop.is_set():
+                cache.evict()
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=put) for _ in range(4)] + [threading.Thread(target=evict)]
+    for thread in threads:
+        thread.start()
+    time.sleep(1)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    # every page left in the index has its blob
+    for (digest,) in cache.conn.execute("SELECT digest FROM pages"):
+        assert os.path.exists(cache.blob_path(digest))
+    cache.put(URL % 1, "<html>1</html>")
+    assert cache.get(URL % 1).html == "<html>1</html>"
+    cache.close()
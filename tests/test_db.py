@@ -0,0 +1,75 @@
+"""
+Tests of the db sync (db.py), on mongomock
+"""
+import pytest
+
+import db
+
+mongomock = pytest.importorskip("mongomock")
+
+
+@pytest.fixture
+def library():
+    return mongomock.MongoClient().library
+
+
+def test_discovered_records_do_not_overwrite_scraped_ones(library):
+    scraped = {"name": "John Williams", "author_url": "https://www.goodreads.com/author/show/616",
+               "author_id": "616", "rating": "4.1"}
+    stub = {"name": ["John   Williams"], "author_url": "https://goodreads.com/author/show/616.J_W"}
+    for docs in ([scraped, stub], [stub, scraped]):
+        library.authors.drop()
+        db.sync_documents(docs, library.authors)
+        stored = library.authors.find_one({"author_id": "616"}, {"_id": 0})
+        assert stored["name"] == "John Williams" and stored["rating"] == "4.1"
+        assert db.sync_documents(docs, library.authors) == {"inserted": 0, "updated": 0,
+                                                            "unchanged": 2}
+
+
+@pytest.mark.parametrize("kind", ["books", "authors"])
+def test_sync_is_idempotent(library, kind):
+    path = "%s/%s.json" % (db.os.path.dirname(db.os.path.abspath(db.__file__)) + "/data", kind)
+    first = db.sync_from_json(path, library[kind])
+    assert first["inserted"] == library[kind].count_documents({})
+    second = db.sync_from_json(path, library[kind])
+    assert second["inserted"] == second["updated"] == 0
+
+
+class BrokenCollection:
+    def bulk_write(self, requests, ordered=True):
+        raise ValueError("not a mongo error")
+
+
+class BrokenClient:
+    library = {name: BrokenCollection() for name in db.COLLECTIONS}
+
+    def close(self):
+        pass
+
+
+def test_writer_raises_the_error_that_stopped_it():
+    writer = db.BatchWriter(client=BrokenClient(), batch_size=1, flush_interval=0.01,
+                            max_queue=2)
+    with pytest.raises(ValueError):
+        for number in range(100):  # would block forever on the full queue
+            writer.write({"title": str(number)}, "books")
+    assert not writer.thread.is_alive()
+    with pytest.raises(ValueError):
+        writer.close()
+    assert writer.counters["failed"] >= 1
+
+
+def test_export_keeps_the_default_file_mode(library, tmp_path):
+    library.books.insert_many([{"book_id": str(number), "title": "Book"}
+                               for number in range(1, 101)])
+    path = str(tmp_path / "books.json")
+    umask = db.current_umask()
+    assert db.export_from_collection(path, library.books, partitions=4) == 100
+    assert db.os.stat(path).st_mode & 0o777 == 0o666 & ~umask
+
+
+def test_partitions_are_even_in_string_order(library):
+    library.books.insert_many([{"book_id": str(number)} for number in range(1, 101)])
+    queries = db.partition_queries(library.books, "book_id", {}, 4)
+    sizes = [library.books.count_documents(query) for query in queries]
+    assert sum(sizes) == 100 and max(sizes) - min(sizes) <= 1
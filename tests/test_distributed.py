@@ -0,0 +1,140 @@
+"""
+Tests of the distributed crawl (distributed.py)
+The queue tests run on mongomock, test_local_processes runs several worker
+processes against the local mongod of MONGO_TEST_URI (default
+mongodb://localhost:27017) and is skipped when none is reachable
+"""
+import multiprocessing
+import os
+import time
+
+import pytest
+
+import distributed
+from bench import FixtureServer, FixtureSite
+from fetcher import Fetcher, set_fetcher
+from registry import GOODREADS_HOST
+
+mongomock = pytest.importorskip("mongomock")
+
+MONGO_TEST_URI = os.getenv("MONGO_TEST_URI", "mongodb://localhost:27017")
+TEST_DB = "library_test_distributed"
+
+
+@pytest.fixture(scope="module")
+def site():
+    return FixtureSite(page_kb=1)
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient().library
+
+
+def start_url(site):
+    return next(iter(site.books.values()))["book_url"]
+
+
+def test_released_page_is_not_renewed_by_the_heartbeat(db, site):
+    distributed.reset_queue(db, 10, 0, start_url(site))
+    queue = distributed.LeaseQueue(db, owner="a", lease_seconds=0.3)
+    page = queue.claim()
+    queue.release(page)
+    queue.heartbeat()  # must not renew the released page
+    other = distributed.LeaseQueue(db, owner="b", lease_seconds=0.3)
+    again = other.claim()
+    assert again is not None and again["_id"] == page["_id"]
+    assert again["attempts"] == 2
+    assert db.crawl_counters.find_one({"_id": "books"})["used"] == 1  # budget kept
+
+
+def test_heartbeat_renews_pages_in_progress(db, site):
+    distributed.reset_queue(db, 10, 0, start_url(site))
+    queue = distributed.LeaseQueue(db, owner="a", lease_seconds=0.2)
+    page = queue.claim()
+    time.sleep(0.3)
+    queue.heartbeat()
+    assert distributed.LeaseQueue(db, owner="b").claim() is None
+    queue.complete([page])
+    assert db.crawl_queue.find_one({"_id": page["_id"]})["state"] == distributed.DONE
+
+
+def test_expired_page_fails_after_max_attempts(db, site):
+    distributed.reset_queue(db, 10, 0, start_url(site))
+    for attempt in range(3):
+        page = distributed.LeaseQueue(db, owner="crash%d" % attempt, lease_seconds=0.01).claim()
+        assert page is not None  # leased, then the worker dies
+        time.sleep(0.02)
+    queue = distributed.LeaseQueue(db, owner="a", max_attempts=3)
+    assert queue.claim() is None
+    assert db.crawl_queue.find_one({"_id": page["_id"]})["state"] == distributed.FAILED
+    assert db.crawl_counters.find_one({"_id": "books"})["used"] == 0
+    assert not queue.unfinished()
+
+
+def test_workers_split_the_crawl(db, site):
+    with FixtureServer(site) as server:
+        set_fetcher(Fetcher(hosts={GOODREADS_HOST: server.origin,
+                                   "goodreads.com": server.origin}))
+        distributed.reset_queue(db, 40, 10, start_url(site), num_shards=4)
+        queues = [distributed.LeaseQueue(db, owner="a", shards=[0, 1]),
+                  distributed.LeaseQueue(db, owner="b", shards=[2, 3])]
+        for _ in range(10):
+            for queue in queues:
+                if queue.unfinished():
+                    distributed.run_worker(db, queue, workers=4, poll_interval=0.01)
+            if not any(queue.unfinished() for queue in queues):
+                break
+        set_fetcher(None)
+    assert db.books.count_documents({}) == 40
+    assert db.authors.count_documents({}) == 10
+    status = queues[0].status()
+    assert status["books"][distributed.LEASED] == status["authors"][distributed.LEASED] == 0
+
+
+def run_process(origin, shards):
+    """
+    One worker process of test_local_processes
+    """
+    from pymongo import MongoClient
+
+    set_fetcher(Fetcher(hosts={GOODREADS_HOST: origin, "goodreads.com": origin}))
+    client = MongoClient(MONGO_TEST_URI)
+    try:
+        db = client[TEST_DB]
+        distributed.run_worker(db, distributed.LeaseQueue(db, shards=shards), workers=4,
+                               poll_interval=0.05)
+    finally:
+        client.close()
+
+
+def test_local_processes(site):
+    pymongo = pytest.importorskip("pymongo")
+    client = pymongo.MongoClient(MONGO_TEST_URI, serverSelectionTimeoutMS=500)
+    try:
+        client.admin.command("ping")
+    except pymongo.errors.PyMongoError:
+        pytest.skip("no mongod at %s" % MONGO_TEST_URI)
+    db = client[TEST_DB]
+    db.books.drop()
+    db.authors.drop()
+    distributed.reset_queue(db, 60, 15, start_url(site), num_shards=4)
+    client.close()  # no client across fork
+    with FixtureServer(site) as server:
+        context = multiprocessing.get_context("fork")
+        processes = [context.Process(target=run_process, args=(server.origin, shards))
+                     for shards in ([0, 1], [2, 3], None)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(120)
+        assert all(process.exitcode == 0 for process in processes)
+    client = pymongo.MongoClient(MONGO_TEST_URI)
+    try:
+        db = client[TEST_DB]
+        assert db.books.count_documents({}) == 60
+        assert db.authors.count_documents({}) == 15
+        assert db.crawl_queue.count_documents({"state": distributed.LEASED}) == 0
+    finally:
+        client.drop_database(TEST_DB)
+        client.close()
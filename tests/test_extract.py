@@ -0,0 +1,96 @@
+"""
+Tests of the page extraction (extract.py) against the original extractors of
+scrape_books and scrape_authors, on the pages of tests/fixtures
+The legacy_* pages are hand-written in the pre 2022 goodreads layout, the pages
+saved by tests/record_pages.py in tests/fixtures/recorded are real ones
+"""
+import glob
+import json
+import os
+
+import pytest
+
+from extract import ENGINES, HAS_LXML, check_parity, extract_page
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+RECORDED = os.path.join(FIXTURES, "recorded")
+URLS = {
+    "book_29056083": "https://www.goodreads.com/book/show/29056083",
+    "book_1": "https://www.goodreads.com/book/show/1",
+    "book_49041": "https://www.goodreads.com/book/show/49041",
+    "book_unknown": "https://www.goodreads.com/book/show/999999999",
+    "author_1077326": "https://www.goodreads.com/author/show/1077326",
+    "author_3389": "https://www.goodreads.com/author/show/3389",
+    "author_unknown": "https://www.goodreads.com/author/show/999999999",
+    "legacy_book_1": "https://www.goodreads.com/book/show/1",
+    "legacy_author_1077326": "https://www.goodreads.com/author/show/1077326",
+}
+NAMES = {
+    "https://www.goodreads.com/author/show/1077326": "J.K. Rowling",
+    "https://www.goodreads.com/author/show/3389": "Stephen King",
+    "https://www.goodreads.com/author/show/999999999": "Author 999999999",
+}
+
+
+def fixture_page(name):
+    with open(os.path.join(FIXTURES, name + ".html"), encoding="utf-8") as file:
+        return URLS[name], file.read()
+
+
+def recorded_pages():
+    """
+    :return: list of pytest params of (url, html) of the recorded pages
+    """
+    params = []
+    for path in sorted(glob.glob(os.path.join(RECORDED, "*.html"))):
+        name = os.path.basename(path)[:-len(".html")]
+        kind, id_ = name.split("_", 1)
+        with open(path, encoding="utf-8") as file:
+            params.append(pytest.param(
+                ("https://www.goodreads.com/%s/show/%s" % (kind, id_), file.read()), id=name))
+    return params or [pytest.param(None, marks=pytest.mark.skip(
+        reason="no recorded pages, record some with tests/record_pages.py"))]
+
+
+def recorded_names():
+    """
+    :return: dict of canonical author url -> name of the recorded author pages
+    """
+    path = os.path.join(RECORDED, "names.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as file:
+        names = json.load(file)  # fixture name -> author name
+    return {"https://www.goodreads.com/author/show/%s" % name.split("_", 1)[1]: author
+            for name, author in names.items()}
+
+
+@pytest.mark.parametrize("engine", list(ENGINES))
+@pytest.mark.parametrize("name", list(URLS))
+def test_parity_with_original_extractors(name, engine):
+    if engine == "lxml" and not HAS_LXML:
+        pytest.skip("lxml is not installed")
+    assert check_parity([fixture_page(name)], NAMES, [engine]) == []
+
+
+@pytest.mark.parametrize("engine", list(ENGINES))
+@pytest.mark.parametrize("page", recorded_pages())
+def test_parity_on_recorded_pages(page, engine):
+    if engine == "lxml" and not HAS_LXML:
+        pytest.skip("lxml is not installed")
+    assert check_parity([page], recorded_names(), [engine]) == []
+
+
+@pytest.mark.parametrize("engine", list(ENGINES))
+def test_extract_page(engine):
+    if engine == "lxml" and not HAS_LXML:
+        pytest.skip("lxml is not installed")
+    _, html = fixture_page("book_29056083")
+    page = extract_page("book", html, engine=engine)
+    assert page["errors"] == []
+    assert page["fields"]["author"] == ["John Tiffany", "Jack Thorne", "J.K. Rowling"]
+    assert page["discovered"] == page["fields"]["similar_books"] != []
+    _, html = fixture_page("author_1077326")
+    page = extract_page("author", html, "J.K. Rowling", engine)
+    assert page["errors"] == []
+    assert page["discovered"] == page["fields"]["author_books"] != []
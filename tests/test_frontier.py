@@ -0,0 +1,52 @@
+"""
+Tests of the crawl frontier (frontier.py)
+"""
+import sqlite3
+
+from frontier import DISCOVERED, DONE, Frontier
+from registry import Registry
+
+BOOK_URL = "https://www.goodreads.com/book/show/%d"
+
+
+def stored_states(path):
+    """
+    :return: dict of id -> state, as a process reopening the database after a crash sees it
+    """
+    conn = sqlite3.connect(path)
+    try:
+        return dict(conn.execute("SELECT id, state FROM frontier WHERE kind = 'books'"))
+    finally:
+        conn.close()
+
+
+def test_first_done_page_is_checkpointed(tmp_path):
+    path = str(tmp_path / "frontier.db")
+    books = Registry("book_url")
+    frontier = Frontier({"books": books}, path, checkpoint_every=100, checkpoint_interval=3600)
+    for number in range(1, 71):
+        books.add(BOOK_URL % number)
+    frontier.mark_done("books", books[0])
+    # no close, the crawl crashed
+    states = stored_states(path)
+    assert states["1"] == DONE
+    assert len(states) == 70 and list(states.values()).count(DISCOVERED) == 69
+
+
+def test_resume_restores_done_pages(tmp_path):
+    path = str(tmp_path / "frontier.db")
+    books = Registry("book_url")
+    frontier = Frontier({"books": books}, path, checkpoint_every=10, checkpoint_interval=3600)
+    for number in range(1, 71):
+        books.add(BOOK_URL % number)
+    for record in books[:35]:
+        record["title"] = "Book"
+        frontier.mark_done("books", record)
+    # the first change and the next 30 are checkpointed, the last 4 are lost
+    frontier.conn.close()
+    restored = Registry("book_url")
+    frontier = Frontier({"books": restored}, path)
+    assert frontier.load()["books"] == {DISCOVERED: 39, "in_flight": 0, DONE: 31, "failed": 0}
+    assert frontier.is_done("books", BOOK_URL % 31) and not frontier.is_done("books", BOOK_URL % 32)
+    assert restored[0]["title"] == "Book"
+    frontier.close()
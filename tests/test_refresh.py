@@ -0,0 +1,39 @@
+"""
+Tests of the refresh of scraped records (refresh.py), against bench.FixtureServer
+"""
+import pytest
+
+import settings
+from bench import FixtureServer, FixtureSite
+from fetcher import Fetcher, reset_fetcher, use_fetcher
+from refresh import RefreshState, plan_refresh, refresh
+from registry import GOODREADS_HOST
+
+
+@pytest.fixture
+def site_fetcher():
+    site = FixtureSite(page_kb=0)
+    server = FixtureServer(site)
+    server.thread.start()
+    fetcher = Fetcher(hosts={GOODREADS_HOST: server.origin, "goodreads.com": server.origin})
+    token = use_fetcher(fetcher)
+    yield site
+    reset_fetcher(token)
+    fetcher.close()
+    server.httpd.shutdown()
+
+
+def test_refresh_adds_no_discovered_records(site_fetcher, tmp_path):
+    settings.init()
+    registries = {"books": settings.books, "authors": settings.authors}
+    book = dict(site_fetcher.books["1"], rating="0.01")  # changed since the scrape
+    registries["books"].append(book)
+    state = RefreshState(str(tmp_path / "refresh.db"))
+    due = plan_refresh(registries, state)
+    assert due == [("books", 0)]
+    changed, counts = refresh(registries, due, state)
+    state.close()
+    assert counts["changed"] == 1 and changed["books"] == [registries["books"][0]]
+    assert registries["books"][0]["rating"] == site_fetcher.books["1"]["rating"]
+    assert len(registries["books"]) == 1 and len(registries["authors"]) == 0
+    assert registries["books"].get(book["similar_books"][0]) is None
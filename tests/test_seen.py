@@ -0,0 +1,89 @@
+"""
+Tests of the seen set (seen.py) and of crawls that keep the discovered pages
+out of memory, against bench.FixtureServer
+"""
+import filecmp
+import glob
+import os
+
+import pytest
+
+from bench import FixtureServer, FixtureSite
+from db import data_to_json
+from engine import Scraper
+from fetcher import Fetcher
+from registry import GOODREADS_HOST
+from seen import SeenSet
+
+START_URL = "https://www.goodreads.com/book/show/1"
+
+
+def test_seen_set_grows_and_survives_reopening(tmp_path):
+    path = str(tmp_path / "seen.bloom")
+    seen = SeenSet(path, capacity=1000, error_rate=0.01)
+    keys = [str(n) for n in range(5000)]
+    added = sum(seen.add(key) for key in keys)  # False for the false positives
+    assert added > 4900
+    assert all(key in seen for key in keys)  # no false negatives
+    assert seen.stats()["stages"] > 1
+    seen.close()
+    seen = SeenSet(path)
+    assert len(seen) == added and all(key in seen for key in keys)
+    false_positives = sum(str(n) in seen for n in range(5000, 25000))
+    assert false_positives / 20000 < 0.02
+    assert 0 < seen.expected_error_rate() < 0.02
+    seen.close()
+
+
+@pytest.fixture
+def site_fetcher():
+    server = FixtureServer(FixtureSite(page_kb=0))
+    server.thread.start()
+    yield lambda: Fetcher(hosts={GOODREADS_HOST: server.origin, "goodreads.com": server.origin})
+    server.httpd.shutdown()
+
+
+def crawl(fetcher, directory, seen, num_books=20, num_authors=5, resume=False):
+    with Scraper(workers=4, data_dir=directory, log_dir=directory, fetcher=fetcher,
+                 seen=seen) as scraper:
+        scraper.crawl(num_books, num_authors, START_URL, resume=resume)
+        for kind, registry in scraper.registries.items():
+            data_to_json(os.path.join(directory, kind + ".json"), registry.output_records())
+        return len(scraper.books), len(scraper.authors), scraper.seen_stats()
+
+
+def same_output(first, second):
+    return all(filecmp.cmp(os.path.join(first, name), os.path.join(second, name), shallow=False)
+               for name in ("books.json", "authors.json"))
+
+
+def test_seen_crawl_keeps_only_crawled_records(site_fetcher, tmp_path):
+    plain, seen = str(tmp_path / "plain"), str(tmp_path / "seen")
+    os.makedirs(plain)
+    os.makedirs(seen)
+    books, authors, _ = crawl(site_fetcher(), plain, False)
+    assert books > 20 and authors > 5  # discovered pages have records
+    books, authors, stats = crawl(site_fetcher(), seen, True)
+    assert (books, authors) == (20, 5)
+    assert stats["books"]["queued"] > 0 and stats["books"]["false_positive_rate"] < 0.01
+    assert same_output(plain, seen)
+
+
+def test_seen_crawl_resumes_without_its_filters(site_fetcher, tmp_path):
+    plain, seen = str(tmp_path / "plain"), str(tmp_path / "seen")
+    os.makedirs(plain)
+    os.makedirs(seen)
+    crawl(site_fetcher(), plain, False)
+    crawl(site_fetcher(), seen, True, num_books=10, num_authors=0)
+    for path in glob.glob(os.path.join(seen, "seen_*.bloom")):
+        os.remove(path)  # rebuilt from the frontier
+    books, authors, stats = crawl(site_fetcher(), seen, True, resume=True)
+    assert (books, authors) == (20, 5)
+    assert same_output(plain, seen)
+
+
+def test_seen_needs_the_phases_policy(tmp_path):
+    with Scraper(data_dir=str(tmp_path), log_dir=str(tmp_path), fetcher=object(),
+                 seen=True) as scraper:
+        with pytest.raises(ValueError):
+            scraper.crawl(1, 1, START_URL, policy="bfs")
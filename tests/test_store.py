@@ -0,0 +1,52 @@
+"""
+Tests of the compact records (store.py)
+"""
+import json
+import os
+
+import pytest
+
+import db
+import settings
+from store import AuthorRecord, BookRecord, number, to_dict
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+
+
+def test_compact_records_read_like_dict_records():
+    fields = {"book_url": "https://www.goodreads.com/book/show/1", "rating": "4.57",
+              "rating_count": "2422944", "review_count": "1,234"}
+    book = BookRecord(fields)
+    assert dict(book) == to_dict(book) == fields
+    assert book.number("rating") == 4.57 and book.number("rating_count") == 2422944
+    assert book.number("review_count") is None  # not a number it could give back unchanged
+    for record in (book, fields):
+        assert number(record, "rating_count") == 2422944 and number(record, "isbn") is None
+
+
+def test_every_pair_of_registries_has_its_own_interner():
+    first = settings.make_registries(compact=True)
+    second = settings.make_registries(compact=True)
+    first[0].add("https://www.goodreads.com/book/show/1")
+    assert first[0].record_type.URLS is first[1].record_type.URLS
+    assert len(first[0].record_type.URLS) == 1
+    assert len(second[0].record_type.URLS) == 0
+
+
+@pytest.mark.parametrize("kind, record_type", [("books", BookRecord), ("authors", AuthorRecord)])
+def test_export_gives_the_records_back(kind, record_type):
+    with open(os.path.join(DATA, kind + ".json")) as file:
+        records = json.load(file)
+    exported = [to_dict(record_type(record)) for record in records]
+    assert json.dumps(exported) == json.dumps(records)
+
+
+def test_synced_compact_records_keep_strings():
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().library.books
+    book = BookRecord({"book_url": "https://www.goodreads.com/book/show/1", "book_id": "1",
+                       "rating": "4.57", "rating_count": "2422944"})
+    db.sync_documents([book], collection)
+    stored = collection.find_one({"book_id": "1"}, {"_id": 0})
+    assert stored["rating"] == "4.57" and stored["rating_count"] == "2422944"
+    assert db.sync_documents([book], collection)["unchanged"] == 1
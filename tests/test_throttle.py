@@ -0,0 +1,100 @@
+"""
+Tests of the circuit breaker of the throttle and the retrying fetcher (throttle.py)
+"""
+import time
+
+import pytest
+
+import settings
+from bench import FixtureServer, FixtureSite
+from fetcher import Fetcher, FetchError, reset_fetcher, use_fetcher
+from registry import GOODREADS_HOST
+from scrape_books import scrape_n_books
+from throttle import CircuitOpen, RetryingFetcher, Throttle
+
+URL = "https://www.goodreads.com/book/show/1"
+
+
+def open_breaker(throttle):
+    for _ in range(throttle.failure_threshold):
+        throttle.record(URL, "error", probe=throttle.wait(URL))
+    assert throttle.stats()["www.goodreads.com"]["circuit"] == "open"
+
+
+def test_open_breaker_raises_instead_of_waiting():
+    throttle = Throttle(failure_threshold=2, cooldown=30.0)
+    open_breaker(throttle)
+    start = time.monotonic()
+    with pytest.raises(CircuitOpen) as error:
+        throttle.wait(URL)
+    assert time.monotonic() - start < 1.0
+    assert 29.0 < error.value.retry_in <= 30.0
+    assert isinstance(error.value, FetchError)
+
+
+def test_only_the_probe_closes_the_breaker():
+    throttle = Throttle(failure_threshold=2, cooldown=0.05)
+    in_flight = throttle.wait(URL)  # sent before the breaker opened
+    open_breaker(throttle)
+    time.sleep(0.06)
+    probe = throttle.wait(URL)
+    assert probe is not None
+    with pytest.raises(CircuitOpen):
+        throttle.wait(URL)  # one probe at a time
+    throttle.record(URL, "ok", probe=in_flight)
+    assert throttle.stats()["www.goodreads.com"]["circuit"] == "half_open"
+    throttle.record(URL, "ok", probe=probe)
+    assert throttle.stats()["www.goodreads.com"]["circuit"] == "closed"
+    assert throttle.wait(URL) is None
+
+
+def test_failed_probe_reopens_the_breaker():
+    throttle = Throttle(failure_threshold=2, cooldown=0.05)
+    open_breaker(throttle)
+    time.sleep(0.06)
+    throttle.record(URL, "error", probe=throttle.wait(URL))
+    assert throttle.stats()["www.goodreads.com"]["circuit"] == "open"
+
+
+class FailingFetcher:
+    def __init__(self):
+        self.requests = 0
+
+    def get(self, url, headers=None):
+        self.requests += 1
+        raise OSError("connection refused")
+
+    def stats(self):
+        return {}
+
+
+def test_retrying_fetcher_waits_for_the_probe_of_an_open_breaker():
+    fetcher = FailingFetcher()
+    retrying = RetryingFetcher(fetcher, Throttle(failure_threshold=2, cooldown=0.05),
+                               retries=3, backoff=0.0)
+    start = time.monotonic()
+    with pytest.raises(FetchError) as error:
+        retrying.fetch(URL)
+    assert not isinstance(error.value, CircuitOpen)
+    assert fetcher.requests == 4  # every try was sent, two of them as probes
+    assert time.monotonic() - start >= 0.1
+    stats = retrying.stats()
+    assert stats["circuit_open"] >= 2 and stats["gave_up"] == 1
+
+
+def test_crawl_finishes_through_an_open_breaker():
+    site = FixtureSite(page_kb=0)
+    start_url = next(iter(site.books.values()))["book_url"]
+    with FixtureServer(site, error_rate=0.5, seed=1) as server:
+        fetcher = Fetcher(hosts={GOODREADS_HOST: server.origin, "goodreads.com": server.origin})
+        retrying = RetryingFetcher(fetcher, Throttle(failure_threshold=2, cooldown=0.05),
+                                   retries=20, backoff=0.0)
+        token = use_fetcher(retrying)
+        try:
+            settings.init()
+            scrape_n_books(10, start_url, False, workers=4)
+        finally:
+            reset_fetcher(token)
+            retrying.close()
+    assert retrying.stats()["circuit_open"] > 0
+    assert len([book for book in settings.books if "title" in book]) == 10
@@ -0,0 +1,288 @@
+"""
+This module defines the adaptive throttle and the retrying fetch layer
+Every host has its own request rate, raised additively while requests succeed
+and cut multiplicatively when the server pushes back (429/503, AIMD), a
+Retry-After pauses the host, and a circuit breaker stops requests to a host
+that keeps failing until a probe request succeeds again (Throttle.wait refuses
+requests with CircuitOpen meanwhile, RetryingFetcher waits for the probe slot)
+Transient failures are retried with exponential backoff and full jitter
+"""
+import email.utils
+import http.client
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+from fetcher import FetchError
+from metrics import METRICS
+
+THROTTLE_CODES = (429, 503)  # the server asks us to slow down
+RETRY_CODES = (429, 500, 502, 503, 504)  # worth another try
+MAX_RETRY_AFTER = 300.0  # longest Retry-After honored, in seconds
+PROBE_POLL = 1.0  # longest sleep between two tries of a breaker that is not closed
+
+
+class CircuitOpen(FetchError):
+    """
+    Raised instead of waiting when the circuit breaker of the host is open
+    """
+
+    def __init__(self, url, retry_in):
+        """
+        :param url: url that was not requested
+        :param retry_in: seconds until the breaker lets a probe request through
+        """
+        super().__init__(url, None, "circuit breaker open, retry in %.1fs" % retry_in)
+        self.retry_in = retry_in
+
+
+class HostState:
+    """
+    Throttle state of one host
+    """
+
+    def __init__(self, rate):
+        self.rate = rate  # requests per second, None for no pacing
+        self.next_time = 0.0  # earliest time the next request may start
+        self.failures = 0  # consecutive failures
+        self.open_until = 0.0  # circuit breaker: 0 closed, else open until then
+        self.probe = None  # half open: token of the one probe request in flight
+        self.probe_until = 0.0  # a probe that never recorded its outcome is replaced then
+
+
+class Throttle:
+    """
+    Per host AIMD rate limiter, Retry-After pauses and circuit breaker
+    Thread safe, callers wait() before every request and record() its outcome with
+    the token wait() returned
+    """
+
+    def __init__(self, rate=None, max_rate=20.0, min_rate=0.2, increase=0.5, decrease=0.5,
+                 failure_threshold=5, cooldown=30.0, adaptive=True):
+        """
+        :param rate: starting requests per second per host (None for no pacing)
+        :param max_rate: max requests per second per host
+        :param min_rate: min requests per second per host
+        :param increase: requests per second added for every second of successes
+        :param decrease: factor the rate is multiplied by when the server pushes back
+        :param failure_threshold: consecutive failures that open the circuit breaker
+        :param cooldown: seconds the circuit breaker stays open before a probe
+        :param adaptive: whether to adapt the rate (False keeps rate fixed)
+        """
+        self.rate = rate
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.adaptive = adaptive
+        self.hosts = {}  # host -> HostState
+        self.lock = threading.Lock()
+
+    def state(self, url):
+        host = urlparse(url).netloc
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = HostState(self.rate)
+        return state
+
+    def wait(self, url):
+        """
+        Blocks until the rate of the host of url allows a request
+        Doesn't wait for an open circuit breaker, raises CircuitOpen instead
+        :param url: url about to be requested
+        :return: probe token to pass to record() if the request is the probe of a
+            half open breaker, None otherwise
+        """
+        with self.lock:
+            state = self.state(url)
+            now = time.monotonic()
+            probe = None
+            if state.open_until > now:
+                raise CircuitOpen(url, state.open_until - now)
+            if state.open_until:  # half open, one probe at a time
+                if state.probe is not None and state.probe_until > now:
+                    raise CircuitOpen(url, state.probe_until - now)
+                probe = state.probe = object()
+                state.probe_until = now + self.cooldown
+            start = max(now, state.next_time)
+            if state.rate:
+                state.next_time = start + 1.0 / state.rate
+        if start > now:
+            time.sleep(start - now)
+        return probe
+
+    def record(self, url, outcome, retry_after=None, probe=None):
+        """
+        Records the outcome of a request
+        While the breaker is open or half open, only the outcome of its probe
+        closes or reopens it, requests sent before it opened don't
+        :param url: url that was requested
+        :param outcome: "ok", "throttled" (429/503) or "error" (other transient failure)
+        :param retry_after: seconds the server asked to wait, None if it didn't
+        :param probe: token returned by wait() for this request
+        """
+        with self.lock:
+            state = self.state(url)
+            now = time.monotonic()
+            is_probe = probe is not None and probe is state.probe
+            if is_probe:
+                state.probe = None
+            breaker = is_probe or not state.open_until  # whether the outcome counts
+            if outcome == "ok":
+                if breaker:
+                    state.failures = 0
+                    state.open_until = 0.0  # a successful probe closes the breaker
+                if self.adaptive and state.rate:
+                    state.rate = min(self.max_rate, state.rate + self.increase / state.rate)
+            else:
+                if self.adaptive and state.rate and outcome == "throttled":
+                    state.rate = max(self.min_rate, state.rate * self.decrease)
+                if retry_after:
+                    state.next_time = max(state.next_time, now + retry_after)
+                if breaker:
+                    state.failures += 1
+                    if is_probe or state.failures >= self.failure_threshold:
+                        if not state.open_until:
+                            METRICS.incr("circuit_opened", host=urlparse(url).netloc)
+                        state.open_until = now + self.cooldown
+            METRICS.set_gauge("host_rate", state.rate or 0, host=urlparse(url).netloc)
+
+    def stats(self):
+        """
+        :return: dict of host -> rate, consecutive failures and breaker state
+        """
+        with self.lock:
+            now = time.monotonic()
+            return {host: {"rate": state.rate, "failures": state.failures,
+                           "circuit": ("open" if state.open_until > now
+                                       else "half_open" if state.open_until else "closed")}
+                    for host, state in self.hosts.items()}
+
+
+class RetryingFetcher:
+    """
+    Wraps a Fetcher with a Throttle and retries transient failures
+    (connection errors, timeouts, 429 and 5xx) with exponential backoff and jitter
+    """
+
+    def __init__(self, fetcher, throttle=None, retries=3, backoff=0.5, max_backoff=30.0):
+        """
+        :param fetcher: Fetcher used for the requests
+        :param throttle: Throttle shared by all requests, None for one without pacing
+        :param retries: max number of retries of a request
+        :param backoff: base delay of the first retry in seconds
+        :param max_backoff: max delay between two tries in seconds
+        """
+        self.fetcher = fetcher
+        self.throttle = throttle or Throttle()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.counters = {"retries": 0, "gave_up": 0, "circuit_open": 0}
+
+    def get(self, url, headers=None):
+        """
+        Sends a GET request (see Fetcher.get), retrying transient failures
+        While the breaker of the host is open, waits until it lets a probe through
+        (waiting doesn't use up a try, a failed probe does)
+        :param url: url to request
+        :param headers: extra headers for this request
+        :return: Response, whose status is not retryable or the last one
+        """
+        for attempt in range(self.retries + 1):
+            probe = self.wait(url)
+            try:
+                response = self.fetcher.get(url, headers)
+            except (OSError, http.client.HTTPException) as error:
+                self.throttle.record(url, "error", probe=probe)
+                failure = FetchError(url, None, str(error))
+                response = None
+            except Exception:
+                # e.g. too many redirects, not retried
+                self.throttle.record(url, "error", probe=probe)
+                raise
+            else:
+                if response.status not in RETRY_CODES:
+                    self.throttle.record(url, "ok", probe=probe)
+                    return response
+                outcome = "throttled" if response.status in THROTTLE_CODES else "error"
+                self.throttle.record(url, outcome,
+                                     parse_retry_after(response.headers.get("retry-after")),
+                                     probe)
+            if attempt == self.retries:
+                break
+            self.count("retries")
+            METRICS.incr("fetch_retries")
+            # full jitter, a Retry-After is enforced by the throttle
+            time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+        self.count("gave_up")
+        if response is None:
+            raise failure
+        return response
+
+    def wait(self, url):
+        """
+        Waits for the throttle of the host of url, and for its breaker to close or
+        let a probe through
+        :param url: url about to be requested
+        :return: probe token of Throttle.wait
+        """
+        while True:
+            try:
+                return self.throttle.wait(url)
+            except CircuitOpen as error:
+                self.count("circuit_open")
+                METRICS.incr("circuit_open_waits", host=urlparse(url).netloc)
+                # polls, the probe in flight may close the breaker any time
+                time.sleep(min(error.retry_in, PROBE_POLL))
+
+    def fetch(self, url, headers=None):
+        """
+        Gets the html of a page
+        :param url: url of page
+        :param headers: extra headers for this request
+        :return: html as string
+        """
+        with METRICS.timer("fetch"):
+            response = self.get(url, headers)
+        if response.status != 200:
+            raise FetchError(url, response.status)
+        return response.text()
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        """
+        :return: counters of the wrapped fetcher, retries and the throttle state
+        """
+        stats = self.fetcher.stats()
+        with self.lock:
+            stats.update(self.counters)
+        stats["hosts"] = self.throttle.stats()
+        return stats
+
+    def close(self):
+        self.fetcher.close()
+
+
+def parse_retry_after(value):
+    """
+    :param value: Retry-After header, seconds or an http date
+    :return: seconds to wait (at most MAX_RETRY_AFTER), None without a valid header
+    """
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(MAX_RETRY_AFTER, max(0.0, seconds))